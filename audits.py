@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Single pass audit runner.
+
+Each audit helper in data.py used to re-parse the whole OSM file and keep every element in
+memory.  An AuditRunner streams the file once, clearing elements as it goes (like get_element),
+and hands every secondary tag to the auditors registered for its key.  An auditor only keeps its
+own results, so the parse itself runs in constant memory regardless of the size of the input.
+
+    runner = AuditRunner()
+    street_types = runner.register(StreetTypeAuditor(CCR))
+    cities = runner.register(CityAuditor())
+    runner.run(OSM_PATH)
+    street_types.result()
+"""
+
+import collections
+import xml.etree.cElementTree as ET
+
+import compressed
+import crossref
+import pbf
+
+
+class Auditor(object):
+    """Base auditor: receives the secondary tags of the elements it is interested in
+
+    keys lists the tag "k" values to receive, None receives every tag.
+    """
+
+    element_tags = ('node', 'way')
+    keys = None
+
+    def audit_tag(self, element_tag, key, value):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+
+class StreetTypeAuditor(Auditor):
+    """Street names whose street type is not in the cross reference (data.audit)"""
+
+    keys = ('addr:street',)
+
+    def __init__(self, CCR):
+        self.CCR = CCR
+        self.street_types = collections.defaultdict(set)
+
+    def audit_tag(self, element_tag, key, value):
+        m = crossref.street_type_re.search(value)
+        if m:
+            street_type = m.group()
+            if not self.CCR.is_known_street_type(street_type):
+                self.street_types[street_type].add(value)
+
+    def result(self):
+        return self.street_types
+
+
+class StreetNameCounter(Auditor):
+    """Number of addr:street tags on ways (data.count_street_name)"""
+
+    element_tags = ('way',)
+    keys = ('addr:street',)
+
+    def __init__(self):
+        self.count = 0
+
+    def audit_tag(self, element_tag, key, value):
+        self.count += 1
+
+    def result(self):
+        return self.count
+
+
+class NewStreetNameAuditor(Auditor):
+    """Street names and what update_name turns them into (data.dispnewnames)"""
+
+    keys = ('addr:street',)
+
+    def __init__(self, CCR):
+        self.CCR = CCR
+        self.new_names = collections.defaultdict(set)
+
+    def audit_tag(self, element_tag, key, value):
+        self.new_names[value].add(self.CCR.update_name(value))
+
+    def result(self):
+        return self.new_names
+
+
+class CityAuditor(Auditor):
+    """Distinct addr:city values (data.citieslist)"""
+
+    keys = ('addr:city',)
+
+    def __init__(self):
+        self.attriblist = collections.defaultdict(set)
+
+    def audit_tag(self, element_tag, key, value):
+        self.attriblist[key].add(value)
+
+    def result(self):
+        return self.attriblist
+
+
+class NewCityNameAuditor(Auditor):
+    """City names and what update_city_name turns them into (data.dispnewcitynames)"""
+
+    keys = ('addr:city',)
+
+    def __init__(self, CCR):
+        self.CCR = CCR
+        self.new_city_names = collections.defaultdict(set)
+
+    def audit_tag(self, element_tag, key, value):
+        self.new_city_names[value].add(self.CCR.update_city_name(value))
+
+    def result(self):
+        return self.new_city_names
+
+
+class AuditRunner(object):
+    """Feed every registered auditor from a single streaming pass over an OSM file"""
+
+    def __init__(self):
+        self.auditors = []
+
+    def register(self, auditor):
+        self.auditors.append(auditor)
+        return auditor
+
+    def _dispatch_table(self):
+        # element tag -> tag key -> auditors, with None holding the auditors that take every key
+        table = {}
+        for auditor in self.auditors:
+            for element_tag in auditor.element_tags:
+                by_key = table.setdefault(element_tag, {})
+                for key in (auditor.keys if auditor.keys is not None else (None,)):
+                    by_key.setdefault(key, []).append(auditor)
+        return table
+
+    def _audit_element(self, by_key, elem):
+        every_key = by_key.get(None, ())
+        for tag in elem.iter('tag'):
+            key = tag.attrib['k']
+            auditors = by_key.get(key)
+            if auditors is None and not every_key:
+                continue
+            value = tag.attrib['v']
+            for auditor in auditors or ():
+                auditor.audit_tag(elem.tag, key, value)
+            for auditor in every_key:
+                auditor.audit_tag(elem.tag, key, value)
+
+    def run(self, osm_file):
+        """Stream osm_file once and return the number of elements audited"""
+        table = self._dispatch_table()
+        count = 0
+
+        if pbf.is_pbf(osm_file):
+            for elem in pbf.PbfReader(osm_file).iter_elements(tuple(table)):
+                count += 1
+                self._audit_element(table[elem.tag], elem)
+            return count
+
+        source = compressed.open_input(osm_file) if isinstance(osm_file, basestring) else osm_file
+        try:
+            context = ET.iterparse(source, events=('start', 'end'))
+            _, root = next(context)
+            for event, elem in context:
+                if event != 'end':
+                    continue
+                by_key = table.get(elem.tag)
+                if by_key is not None:
+                    count += 1
+                    self._audit_element(by_key, elem)
+                if elem.tag in ('node', 'way', 'relation'):
+                    root.clear()
+        finally:
+            if source is not osm_file:
+                source.close()
+        return count
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the cleaning pipeline in data.py.
+
+bench_pipeline measures the throughput of handle_tags, update_name, update_city_name,
+shape_element, validate_element and process_map on an OSM file (a synthetic one from synthetic.py
+unless a file is given).  The results can be saved as a baseline and later runs compared against
+it, failing (exit status 1) when a throughput drops by more than the tolerance:
+
+    python benchmark.py --save-baseline baseline.json
+    python benchmark.py --baseline baseline.json --tolerance 0.2
+
+Baselines are only comparable on the same machine and input.  --micro also runs the detailed
+comparisons of the old and new implementations.
+"""
+
+import argparse
+import codecs
+import collections
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import cerberus
+
+import data
+import crossref
+import fastvalidator
+import parsers
+import synthetic
+import writers
+
+
+def time_per_call(func, values, repeat=3):
+    """Best time in microseconds for one call of func over values"""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for value in values:
+            func(value)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / len(values) * 1e6
+
+
+#Street and city values shaped like the ones handle_tags sees (already upper case).
+def sample_tag_values(StCR, CityCR):
+    street_names = ["100 WEST " + common_name for common_name in StCR["CommonName"].values]
+    street_names += ["200 EAST " + usps_name + "." for usps_name in StCR["USPSName"].values]
+    street_names += ["300 NOWHERE XYZ%d" % i for i in range(100)]
+    city_names = list(CityCR["OriginalName"].values) + ["NOWHERE %d" % i for i in range(20)]
+    return street_names, city_names
+
+
+#Per tag cost of the DataFrame lookups against the compiled cross reference.
+def bench_cross_reference(repeat=3):
+    StCR = data.createStCR()
+    CityCR = data.createCityCR()
+    CCR = crossref.CrossReference.from_frames(StCR, CityCR)
+    street_names, city_names = sample_tag_values(StCR, CityCR)
+
+    for name in street_names:
+        assert data.update_name(name, StCR) == CCR.update_name(name), name
+    for name in city_names:
+        assert data.update_city_name(name, CityCR) == CCR.update_city_name(name), name
+
+    results = [
+        ("update_name (DataFrame)",
+         time_per_call(lambda n: data.update_name(n, StCR), street_names, repeat)),
+        ("update_name (CrossReference)",
+         time_per_call(CCR.update_name, street_names, repeat)),
+        ("update_city_name (DataFrame)",
+         time_per_call(lambda n: data.update_city_name(n, CityCR), city_names, repeat)),
+        ("update_city_name (CrossReference)",
+         time_per_call(CCR.update_city_name, city_names, repeat)),
+    ]
+    for label, usec in results:
+        print "%-36s %10.2f us/tag" % (label, usec)
+    return results
+
+
+#Shaping time against cerberus, FastValidator and batch FastValidator validation per element.
+def bench_validation(osm_file, repeat=3):
+    elements = [data.shape_element(element)
+                for element in data.get_element(osm_file, tags=('node', 'way'))]
+    cerberus_validator = cerberus.Validator()
+    fast_validator = fastvalidator.FastValidator(data.SCHEMA)
+
+    def shape_all():
+        for element in data.get_element(osm_file, tags=('node', 'way')):
+            data.shape_element(element)
+
+    def time_once(func):
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            func()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return best / len(elements) * 1e6
+
+    results = [
+        ("get_element + shape_element", time_once(shape_all)),
+        ("validate_element (cerberus)", time_once(
+            lambda: [data.validate_element(el, cerberus_validator) for el in elements])),
+        ("validate_element (FastValidator)", time_once(
+            lambda: [data.validate_element(el, fast_validator) for el in elements])),
+        ("validate_elements (batch)", time_once(
+            lambda: data.validate_elements(elements, fast_validator))),
+    ]
+    for label, usec in results:
+        print "%-36s %10.2f us/element" % (label, usec)
+    return results
+
+
+#Rows/sec writing the tag rows of osm_file with UnicodeDictWriter and BufferedCsvWriter, to files
+#opened the way process_map opens them.
+def bench_writers(osm_file, buffer_rows=writers.BUFFER_ROWS, repeat=3):
+    rows = []
+    for element in data.get_element(osm_file, tags=('node', 'way')):
+        el = data.shape_element(element)
+        rows.extend(el.node_tags if element.tag == 'node' else el.way_tags)
+    dict_rows = [dict(zip(row._fields, row)) for row in rows]
+
+    def write_dicts(f):
+        writer = data.UnicodeDictWriter(f, data.NODE_TAGS_FIELDS)
+        writer.writeheader()
+        for row in dict_rows:
+            writer.writerow(row)
+
+    def write_tuples(f):
+        writer = writers.BufferedCsvWriter(f, data.NODE_TAGS_FIELDS, buffer_rows)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+        writer.flush()
+
+    results = []
+    outputs = []
+    for label, func in (("UnicodeDictWriter", write_dicts), ("BufferedCsvWriter", write_tuples)):
+        best = None
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        for _ in range(repeat):
+            with codecs.open(path, 'wb') as f:
+                start = time.time()
+                func(f)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        with open(path, 'rb') as f:
+            outputs.append(f.read())
+        os.remove(path)
+        results.append((label, len(rows) / best))
+    assert outputs[0] == outputs[1], "BufferedCsvWriter output differs from UnicodeDictWriter"
+
+    for label, rate in results:
+        print "%-36s %10.0f rows/sec" % (label, rate)
+    return results
+
+
+#Run func() in a child process. Returns its result and how far the child's peak RSS grew, in KB.
+def with_peak_memory(func):
+    def child(queue):
+        start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result = func()
+        queue.put((result, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start))
+
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=child, args=(queue,))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+#Elements/sec and peak memory of each parser backend, parsing alone and shaping as process_map
+#does (shape_element, or the expat callbacks of data.expat_shaped_elements).
+def bench_parsers(osm_file, repeat=3):
+    def parse(parser, shape):
+        def run():
+            best = None
+            for _ in range(repeat):
+                start = time.time()
+                count = 0
+                if shape:
+                    elements = data.shaped_elements(osm_file, False, parser)
+                else:
+                    elements = data.get_element(osm_file, tags=('node', 'way'), parser=parser)
+                for _ in elements:
+                    count += 1
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            return count / best
+        return run
+
+    results = []
+    for parser in sorted(parsers.PARSERS):
+        for shape in (False, True):
+            rate, peak_kb = with_peak_memory(parse(parser, shape))
+            label = "%s%s" % (parser, " + shaping" if shape else "")
+            results.append((label, rate, peak_kb))
+
+    for label, rate, peak_kb in results:
+        print "%-36s %10.0f elements/sec %8d KB peak" % (label, rate, peak_kb)
+    return results
+
+
+#Best of repeat runs of func(), as items per second.
+def throughput(func, items, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return items / best if best else float('inf')
+
+
+#Throughput of each stage of the pipeline and of process_map as a whole on osm_file.
+def bench_pipeline(osm_file, repeat=3):
+    CCR = data.compiled_cross_reference()
+    elements = list(data.get_element(osm_file, tags=('node', 'way')))
+    key_values = [(tag.attrib['k'], tag.attrib['v']) for element in elements
+                  for tag in element.iter('tag')]
+    street_names = [value.upper() for key, value in key_values if key == 'addr:street']
+    city_names = [value.upper() for key, value in key_values if key == 'addr:city']
+    shaped = [data.shape_element(element) for element in elements]
+    validator = fastvalidator.FastValidator(data.SCHEMA)
+
+    def run_process_map():
+        cwd = os.getcwd()
+        work_dir = tempfile.mkdtemp(prefix='benchmark_')
+        try:
+            os.chdir(work_dir)
+            data.process_map(osm_file, validate=True)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = collections.OrderedDict()
+    results['handle_tags'] = throughput(
+        lambda: [data.handle_tags(key, value) for key, value in key_values],
+        len(key_values), repeat)
+    results['update_name'] = throughput(
+        lambda: [CCR.update_name(name) for name in street_names], len(street_names), repeat)
+    results['update_city_name'] = throughput(
+        lambda: [CCR.update_city_name(name) for name in city_names], len(city_names), repeat)
+    results['shape_element'] = throughput(
+        lambda: [data.shape_element(element) for element in elements], len(elements), repeat)
+    results['validate_element'] = throughput(
+        lambda: [data.validate_element(el, validator) for el in shaped], len(shaped), repeat)
+    results['process_map'] = throughput(run_process_map, len(elements), repeat)
+
+    units = {'handle_tags': 'tags', 'update_name': 'names', 'update_city_name': 'names'}
+    for label, rate in results.items():
+        print "%-36s %10.0f %s/sec" % (label, rate, units.get(label, 'elements'))
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Names of the results more than tolerance (a fraction) below their baseline throughput"""
+    regressions = []
+    for label, rate in results.items():
+        base_rate = baseline.get(label)
+        if base_rate is None:
+            continue
+        change = rate / base_rate - 1.0
+        flag = "REGRESSION" if change < -tolerance else ""
+        print "%-36s %+9.1f%% %s" % (label, change * 100, flag)
+        if flag:
+            regressions.append(label)
+    return regressions
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Benchmark the cleaning pipeline")
+    arg_parser.add_argument('osm_file', nargs='?',
+                            help="OSM file to run on (default: a synthetic file)")
+    arg_parser.add_argument('--nodes', type=int, default=50000, help="synthetic nodes")
+    arg_parser.add_argument('--ways', type=int, default=10000, help="synthetic ways")
+    arg_parser.add_argument('--seed', type=int, default=0, help="synthetic random seed")
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('--save-baseline', metavar='FILE', help="save the results as a baseline")
+    arg_parser.add_argument('--baseline', metavar='FILE', help="compare the results to a baseline")
+    arg_parser.add_argument('--tolerance', type=float, default=0.2,
+                            help="allowed drop in throughput (default 0.2 = 20%%)")
+    arg_parser.add_argument('--micro', action='store_true',
+                            help="also run the cross reference / validation / writer / parser "
+                                 "comparisons")
+    args = arg_parser.parse_args()
+
+    data.compileCR(data.createStCR(), data.createCityCR())
+    temp_dir = None
+    if args.osm_file:
+        osm_file = os.path.abspath(args.osm_file)
+        run_input = {'file': osm_file}
+    else:
+        temp_dir = tempfile.mkdtemp(prefix='benchmark_')
+        osm_file = os.path.join(temp_dir, 'synthetic.osm')
+        synthetic.generate(osm_file, args.nodes, args.ways, seed=args.seed)
+        synthetic.check_tag_density(osm_file, nodes=args.nodes, ways=args.ways)
+        run_input = {'synthetic': {'nodes': args.nodes, 'ways': args.ways, 'seed': args.seed,
+                                   'version': synthetic.VERSION}}
+
+    try:
+        results = bench_pipeline(osm_file, args.repeat)
+        if args.micro:
+            bench_cross_reference(args.repeat)
+            bench_validation(osm_file, args.repeat)
+            bench_writers(osm_file, repeat=args.repeat)
+            bench_parsers(osm_file, args.repeat)
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'wb') as f:
+            json.dump({'input': run_input, 'results': results}, f, indent=1)
+    if args.baseline:
+        with open(args.baseline, 'rb') as f:
+            baseline = json.load(f)
+        if baseline['input'] != run_input:
+            print "Warning: the baseline was measured on {0}".format(baseline['input'])
+        if compare_to_baseline(results, baseline['results'], args.tolerance):
+            sys.exit(1)
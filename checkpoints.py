@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Checkpoints for resuming process_map.
+
+With checkpoint=True process_map shapes the file one element aligned segment at a time (see
+osmchunks.py) and after each segment flushes the csv files to disk and records:
+
+{'input': '/data/las-vegas.osm',     # absolute path and size of the input
+ 'input_size': 3221225472,
+ 'offset': 1073741824,               # byte offset of the first element not yet written
+ 'last_element': ['way', '123456'],  # last element written
+ 'elements': 5012345,                # elements written so far
+ 'outputs': [['nodes.csv', 412345678], ...],  # csv file lengths at this point
+ 'complete': False}
+
+process_map(..., resume=True) truncates the csv files back to the recorded lengths, seeks to the
+recorded offset and carries on from there.  The checkpoint file is replaced atomically, so it
+always describes a consistent set of outputs.
+"""
+
+import json
+import os
+
+CHECKPOINT_BYTES = 32 * 1024 * 1024  # Bytes of XML shaped between checkpoints
+
+
+def replace_file(source, target):
+    """Rename source over target, which may already exist"""
+    # Python 2's os.rename fails on Windows when the target exists (there is no os.replace)
+    if os.name == 'nt' and os.path.exists(target):
+        os.remove(target)
+    os.rename(source, target)
+
+
+def load_checkpoint(path, file_in):
+    """The saved checkpoint for file_in, None if there is none"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        state = json.load(f)
+    if state['input'] != os.path.abspath(file_in) or \
+            state['input_size'] != os.path.getsize(file_in):
+        raise ValueError("Checkpoint {0} is for {1} ({2} bytes), not {3}".format(
+            path, state['input'], state['input_size'], file_in))
+    return state
+
+
+def truncate_outputs(state):
+    """Cut the output files back to their lengths at the checkpoint"""
+    for name, length in state['outputs']:
+        with open(name, 'r+b') as f:
+            f.truncate(length)
+
+
+class Checkpointer(object):
+    """Saves checkpoints for one process_map run over out_files"""
+
+    def __init__(self, path, file_in, out_files, state=None):
+        self.path = path
+        self.file_in = os.path.abspath(file_in)
+        self.input_size = os.path.getsize(file_in)
+        self.out_files = out_files
+        self.offset = None
+        self.last_element = None
+        self.elements = 0
+        if state is not None:
+            self.offset = state['offset']
+            self.last_element = state['last_element']
+            self.elements = state['elements']
+
+    def save(self, offset, last_element, elements, complete=False):
+        """Record that everything before offset has been written"""
+        for out_file in self.out_files:
+            out_file.flush()
+            os.fsync(out_file.fileno())
+
+        self.offset = offset
+        self.elements += elements
+        if last_element is not None:
+            self.last_element = last_element
+        state = {
+            'input': self.file_in,
+            'input_size': self.input_size,
+            'offset': offset,
+            'last_element': self.last_element,
+            'elements': self.elements,
+            'outputs': [[out_file.name, os.fstat(out_file.fileno()).st_size]
+                        for out_file in self.out_files],
+            'complete': complete,
+        }
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            json.dump(state, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(tmp_path, self.path)
+
+    def finish(self):
+        self.save(self.input_size, None, 0, complete=True)
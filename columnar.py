@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Columnar (Parquet) output for process_map.
+
+Every table is written as a Parquet file with typed columns (int64 / float64 / string, from the
+schema) in row groups of row_group_rows rows, so downstream loads read a fraction of the bytes of
+the csv files and never re-parse numbers from text.
+
+ways_nodes is stored as one row per way instead of one row per nd:
+
+    id (int64), node_ids (list<int64>, in position order)
+
+With delta_encode=True node_ids holds the first node id followed by the differences between
+consecutive ids, which are small numbers for most ways and compress much better.  read_way_nodes
+undoes the encoding.  Needs pyarrow.
+"""
+
+import os
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+ROW_GROUP_ROWS = 100000  # Rows per Parquet row group
+
+WAY_NODES_ENCODING_KEY = b'node_ids_encoding'
+
+
+def arrow_type(rules):
+    return {'integer': pa.int64(), 'float': pa.float64()}.get(rules.get('type'), pa.string())
+
+
+def column_array(values, rules):
+    """Typed arrow array for one column of shaped (mostly text) values"""
+    type_name = rules.get('type')
+    if type_name == 'integer':
+        return pa.array(np.array(values).astype(np.int64), type=pa.int64())
+    if type_name == 'float':
+        return pa.array(np.array(values).astype(np.float64), type=pa.float64())
+    return pa.array(values, type=pa.string())
+
+
+def delta_encode(node_ids):
+    return [node_ids[0]] + [b - a for a, b in zip(node_ids, node_ids[1:])]
+
+
+def delta_decode(deltas):
+    return np.cumsum(deltas, dtype=np.int64).tolist()
+
+
+class ColumnTableWriter(object):
+    """Row tuples in field order -> typed columns, written out a row group at a time"""
+
+    def __init__(self, path, fields, field_schema, row_group_rows=ROW_GROUP_ROWS):
+        self.path = path
+        self.fields = fields
+        self.rules = [field_schema[field] for field in fields]
+        self.row_group_rows = row_group_rows
+        self.buffer = []
+        self.rows_written = 0
+        arrow_schema = pa.schema([pa.field(field, arrow_type(rules), nullable=False)
+                                  for field, rules in zip(fields, self.rules)])
+        self.writer = pq.ParquetWriter(path, arrow_schema)
+
+    def writerow(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.row_group_rows:
+            self.flush()
+
+    def writerows(self, rows):
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.row_group_rows:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            columns = zip(*self.buffer)
+            arrays = [column_array(list(values), rules)
+                      for values, rules in zip(columns, self.rules)]
+            self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.writer.schema))
+            self.rows_written += len(self.buffer)
+            del self.buffer[:]
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class WayNodesColumnWriter(object):
+    """(id, node_id, position) rows -> one (id, node_ids) row per way"""
+
+    def __init__(self, path, row_group_rows=ROW_GROUP_ROWS, delta_encode=False):
+        self.path = path
+        self.row_group_rows = row_group_rows
+        self.delta_encode = delta_encode
+        self.way_ids = []
+        self.node_ids = []
+        self.rows_written = 0
+        arrow_schema = pa.schema([pa.field('id', pa.int64(), nullable=False),
+                                  pa.field('node_ids', pa.list_(pa.int64()), nullable=False)],
+                                 metadata={WAY_NODES_ENCODING_KEY:
+                                           b'delta' if delta_encode else b'plain'})
+        self.writer = pq.ParquetWriter(path, arrow_schema)
+
+    def writerow(self, row):
+        self.writerows((row,))
+
+    def writerows(self, rows):
+        # write_elements passes all of a way's nd rows, in position order, in one call
+        for way_id, node_id, position in rows:
+            way_id = int(way_id)
+            if not self.way_ids or self.way_ids[-1] != way_id:
+                if len(self.way_ids) >= self.row_group_rows:
+                    self.flush()
+                self.way_ids.append(way_id)
+                self.node_ids.append([])
+            self.node_ids[-1].append(int(node_id))
+
+    def flush(self):
+        if self.way_ids:
+            node_ids = self.node_ids
+            if self.delta_encode:
+                node_ids = [delta_encode(ids) for ids in node_ids]
+            table = pa.Table.from_arrays(
+                [pa.array(self.way_ids, type=pa.int64()),
+                 pa.array(node_ids, type=pa.list_(pa.int64()))],
+                schema=self.writer.schema)
+            self.writer.write_table(table)
+            self.rows_written += sum(len(ids) for ids in self.node_ids)
+            self.way_ids = []
+            self.node_ids = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class ColumnarOutput(object):
+    """One Parquet file per table in output_dir
+
+    tables is a list of (table, fields, field_schema, primary_key) in write_elements order;
+    the table called 'ways_nodes' gets the per-way layout.
+    """
+
+    def __init__(self, output_dir, tables, row_group_rows=ROW_GROUP_ROWS, delta_encode=False):
+        if pa is None:
+            raise ImportError("Parquet output needs pyarrow (pip install pyarrow)")
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        self.writers = []
+        for table, fields, field_schema, _ in tables:
+            path = os.path.join(output_dir, table + '.parquet')
+            if table == 'ways_nodes':
+                writer = WayNodesColumnWriter(path, row_group_rows, delta_encode)
+            else:
+                writer = ColumnTableWriter(path, fields, field_schema, row_group_rows)
+            self.writers.append(writer)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+def read_way_nodes(path):
+    """{way id: [node ids in position order]} from a ways_nodes.parquet file"""
+    parquet_file = pq.ParquetFile(path)
+    metadata = parquet_file.schema.to_arrow_schema().metadata or {}
+    delta = metadata.get(WAY_NODES_ENCODING_KEY) == b'delta'
+    way_nodes = {}
+    for group in range(parquet_file.num_row_groups):
+        table = parquet_file.read_row_group(group)
+        for way_id, node_ids in zip(table.column('id').to_pylist(),
+                                    table.column('node_ids').to_pylist()):
+            way_nodes[way_id] = delta_decode(node_ids) if delta else node_ids
+    return way_nodes
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Streaming access to compressed OSM files.
+
+Extracts are published as .osm.bz2 (and the sample for this project ships as a .zip); open_input
+decompresses them on the fly so get_element, the audits and process_map can read them without an
+uncompressed copy on disk:
+
+    .bz2  every stream of the file (pbzip2 / lbzip2 write many), not just the first one
+    .gz   every member of the file
+    .zip  the .osm member (or the only member) of the archive
+
+Anything else is opened as a plain file.  With workers > 1 a .bz2 file is split on its stream
+boundaries and the streams are decompressed in a process pool, a few batches ahead of the reader.
+A file written by plain bzip2 is one stream and is always decompressed in this process.
+
+open_output gives a gzip file for csv output when asked for one.
+"""
+
+import bz2
+import collections
+import gzip
+import multiprocessing
+import os
+import re
+import zipfile
+import zlib
+
+READ_SIZE = 1024 * 1024
+BZ2_BATCH_BYTES = 8 * 1024 * 1024  # Compressed bytes of bz2 streams per worker task
+GZIP_LEVEL = 6  # zlib's default; 9 is several times slower for a few % smaller files
+
+COMPRESSED_EXTENSIONS = ('.bz2', '.gz', '.zip')
+
+# Stream header ("BZh" + block size) followed by the first block's magic number
+BZ2_STREAM_RE = re.compile(br'BZh[1-9]1AY&SY')
+
+
+def is_compressed(path):
+    return isinstance(path, basestring) and path.lower().endswith(COMPRESSED_EXTENSIONS)
+
+
+def new_gzip_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+class DecompressingReader(object):
+    """File-like reader over a file of concatenated bz2 streams / gzip members"""
+
+    def __init__(self, f, new_decompressor):
+        self.file = f
+        self.new_decompressor = new_decompressor
+        self.decompressor = None
+        self.pending = b''
+        self.at_end = False
+
+    def _decompress_block(self):
+        block = self.file.read(READ_SIZE)
+        if not block:
+            if isinstance(self.decompressor, bz2.BZ2Decompressor):
+                raise IOError("{0} ends in the middle of a compressed stream".format(
+                    getattr(self.file, 'name', 'input')))
+            self.at_end = True
+            return b''
+        out = []
+        while block:
+            if self.decompressor is None:
+                self.decompressor = self.new_decompressor()
+            out.append(self.decompressor.decompress(block))
+            block = self.decompressor.unused_data
+            if block or bz2_stream_end(self.decompressor):
+                self.decompressor = None
+        return b''.join(out)
+
+    def read(self, size=-1):
+        chunks = [self.pending]
+        length = len(self.pending)
+        while (size < 0 or length < size) and not self.at_end:
+            data = self._decompress_block()
+            chunks.append(data)
+            length += len(data)
+        data = b''.join(chunks)
+        if size < 0:
+            self.pending = b''
+            return data
+        self.pending = data[size:]
+        return data[:size]
+
+    def close(self):
+        self.file.close()
+
+
+#True once a bz2 decompressor has seen the whole of its stream. (A zlib decompressor can't tell
+#in Python 2; a finished gzip member shows up as unused_data once the next one is fed in.)
+def bz2_stream_end(decompressor):
+    if not isinstance(decompressor, bz2.BZ2Decompressor):
+        return False
+    try:
+        decompressor.decompress(b'')
+    except EOFError:
+        return True
+    return False
+
+
+# ================================================== #
+#               Parallel bz2                         #
+# ================================================== #
+#Byte offsets at which the bz2 streams of path start.
+def bz2_stream_offsets(path):
+    offsets = []
+    with open(path, 'rb') as f:
+        pos = 0
+        overlap = b''
+        while True:
+            block = f.read(READ_SIZE)
+            if not block:
+                break
+            data = overlap + block
+            base = pos - len(overlap)
+            for m in BZ2_STREAM_RE.finditer(data):
+                offset = base + m.start()
+                if not offsets or offset > offsets[-1]:
+                    offsets.append(offset)
+            pos += len(block)
+            overlap = data[-9:]
+    return offsets
+
+
+#Decompress the whole bz2 streams in path[start:end].
+def decompress_streams(args):
+    path, start, end = args
+    with open(path, 'rb') as f:
+        f.seek(start)
+        block = f.read(end - start)
+    out = []
+    while block:
+        decompressor = bz2.BZ2Decompressor()
+        out.append(decompressor.decompress(block))
+        block = decompressor.unused_data
+        if not block and not bz2_stream_end(decompressor):
+            raise IOError("{0}: bytes {1}-{2} do not end on a bz2 stream boundary".format(
+                path, start, end))
+    return b''.join(out)
+
+
+class ParallelBz2Reader(object):
+    """File-like reader decompressing batches of bz2 streams in a process pool"""
+
+    def __init__(self, path, workers, offsets=None, batch_bytes=BZ2_BATCH_BYTES):
+        if offsets is None:
+            offsets = bz2_stream_offsets(path)
+        offsets = offsets + [os.path.getsize(path)]
+        batches = []
+        start = offsets[0] if offsets else 0
+        for offset in offsets[1:]:
+            if offset - start >= batch_bytes or offset == offsets[-1]:
+                batches.append((path, start, offset))
+                start = offset
+        self.batches = collections.deque(batches)
+        self.pool = multiprocessing.Pool(workers)
+        self.results = collections.deque()
+        self.ahead = workers * 2
+        self.pending = b''
+
+    def _next_batch(self):
+        while self.batches and len(self.results) < self.ahead:
+            self.results.append(self.pool.apply_async(decompress_streams,
+                                                      (self.batches.popleft(),)))
+        if not self.results:
+            return b''
+        return self.results.popleft().get()
+
+    def read(self, size=-1):
+        chunks = [self.pending]
+        length = len(self.pending)
+        while size < 0 or length < size:
+            data = self._next_batch()
+            if not data and not self.results and not self.batches:
+                break
+            chunks.append(data)
+            length += len(data)
+        data = b''.join(chunks)
+        if size < 0:
+            self.pending = b''
+            return data
+        self.pending = data[size:]
+        return data[:size]
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+# ================================================== #
+#               Opening Files                        #
+# ================================================== #
+#Member of a zip archive holding the OSM data.
+def zip_member(archive):
+    names = [name for name in archive.namelist() if not name.endswith('/')]
+    for name in names:
+        if name.lower().endswith(('.osm', '.osc', '.xml')):
+            return name
+    if len(names) == 1:
+        return names[0]
+    raise ValueError("Cannot tell which member of {0} is the OSM file: {1}".format(
+        archive.filename, ', '.join(names)))
+
+
+class ZipMemberReader(object):
+    """The OSM member of a zip archive, closing the archive with it"""
+
+    def __init__(self, path):
+        self.archive = zipfile.ZipFile(path)
+        self.member = self.archive.open(zip_member(self.archive))
+
+    def read(self, size=-1):
+        return self.member.read(size)
+
+    def close(self):
+        self.member.close()
+        self.archive.close()
+
+
+def open_input(path, workers=1):
+    """Open an OSM file for reading, decompressing .bz2 / .gz / .zip files as they are read"""
+    name = path.lower()
+    if name.endswith('.bz2'):
+        if workers > 1:
+            offsets = bz2_stream_offsets(path)
+            if len(offsets) > 1:
+                return ParallelBz2Reader(path, workers, offsets)
+        return DecompressingReader(open(path, 'rb'), bz2.BZ2Decompressor)
+    if name.endswith('.gz'):
+        return DecompressingReader(open(path, 'rb'), new_gzip_decompressor)
+    if name.endswith('.zip'):
+        return ZipMemberReader(path)
+    return open(path, 'rb')
+
+
+def open_output(path, mode='wb', compress=False):
+    """Open a csv output file, gzip compressed (path + '.gz') when compress is True"""
+    if compress:
+        return gzip.open(path + '.gz', mode, GZIP_LEVEL)
+    return open(path, mode)
@@ -1,34 +1,258 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import xml.etree.ElementTree as ET  # Use cElementTree or lxml if too slow
+"""
+Write a small, referentially complete sample of an OSM file.
+
+Three ways of picking the sample:
+
+    every-k    every k-th top level element (the original behaviour)
+    reservoir  exactly n top level elements, chosen uniformly at random (seeded)
+    bbox       nodes inside a bounding box, ways with at least one node inside it and relations
+               with at least one member in the sample
+
+The file is read twice.  The first pass picks the elements and collects the ids of the nodes the
+picked ways reference, the second writes every picked element plus those nodes, so each way in
+the sample carries all of its nodes.  Relation members that are not in the sample are dropped.
+Ids are kept in sorted int64 arrays, so memory stays at 8 bytes per sampled id whatever the size
+of the input.
+
+    python createsamplefile.py Lasvegas.osm.bz2 sample.osm --mode reservoir --size 20000
+    python createsamplefile.py Lasvegas.osm sample.osm --mode bbox --bbox=-115.2,36.1,-115.1,36.2
+"""
+
+import argparse
+import random
+import xml.etree.cElementTree as ET
+
+import numpy as np
+
+import compressed
 
 OSM_FILE = "Lasvegas.osm"  # Replace this with your osm file
 SAMPLE_FILE = "sample.osm"
 
 k = 50 # Parameter: take every k-th top level element
 
+TOP_LEVEL_TAGS = ('node', 'way', 'relation')
+CHUNK_IDS = 65536  # Ids added to an IdSet before they are moved into an int64 array
+
+
 def get_element(osm_file, tags=('node', 'way', 'relation')):
     """Yield element if it is the right type of tag
 
     Reference:
     http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
     """
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    source = compressed.open_input(osm_file)  # .bz2 / .gz / .zip are read without extracting
+    try:
+        context = iter(ET.iterparse(source, events=('start', 'end')))
+        _, root = next(context)
+        for event, elem in context:
+            if event == 'end' and elem.tag in tags:
+                yield elem
+                root.clear()
+    finally:
+        source.close()
+
+
+class IdSet(object):
+    """Set of element ids in int64 numpy arrays, sorted (by freeze) before the first lookup
+
+    Added ids are collected in a list and moved into an int64 array every CHUNK_IDS ids, so
+    only that many are held as Python ints.  numpy's int64 is 8 bytes on every platform, unlike
+    array('l'), which is 4 bytes on Windows and too small for current node ids.
+    """
+
+    def __init__(self):
+        self.ids = np.empty(0, dtype=np.int64)  # Sorted, unique
+        self.chunks = []
+        self.pending = []
+        self.frozen = True
+
+    def add(self, element_id):
+        self.pending.append(element_id)
+        self.frozen = False
+        if len(self.pending) >= CHUNK_IDS:
+            self._flush()
+
+    def extend(self, element_ids):
+        self.pending.extend(element_ids)
+        self.frozen = False
+        if len(self.pending) >= CHUNK_IDS:
+            self._flush()
+
+    def _flush(self):
+        self.chunks.append(np.array(self.pending, dtype=np.int64))
+        self.pending = []
+
+    def freeze(self):
+        """Merge the added ids into the sorted array and remove duplicates"""
+        if not self.frozen:
+            if self.pending:
+                self._flush()
+            self.ids = np.unique(np.concatenate([self.ids] + self.chunks))
+            self.chunks = []
+            self.frozen = True
+
+    def __contains__(self, element_id):
+        if not self.frozen:
+            self.freeze()
+        ids = self.ids
+        i = ids.searchsorted(element_id)
+        return i < len(ids) and ids[i] == element_id
+
+    def __len__(self):
+        if not self.frozen:
+            self.freeze()
+        return len(self.ids)
 
 
-with open(SAMPLE_FILE, 'wb') as output:
-    output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    output.write('<osm>\n  ')
+def node_refs(element):
+    return [int(nd.attrib['ref']) for nd in element.iter('nd')]
 
-    # Write every kth top level element
-    for i, element in enumerate(get_element(OSM_FILE)):
-        if i % k == 0:
+
+#Members of a relation as (type, id) pairs.
+def members(element):
+    return [(member.attrib['type'], int(member.attrib['ref']))
+            for member in element.iter('member')]
+
+
+# ================================================== #
+#               First Pass: Selection                #
+# ================================================== #
+#Ids of every k-th top level element, plus the nodes of the selected ways.
+def select_every_k(osm_file, every):
+    selected = dict((tag, IdSet()) for tag in TOP_LEVEL_TAGS)
+    way_nodes = IdSet()
+    for i, element in enumerate(get_element(osm_file)):
+        if i % every == 0:
+            selected[element.tag].add(int(element.attrib['id']))
+            if element.tag == 'way':
+                way_nodes.extend(node_refs(element))
+    return selected, way_nodes
+
+
+#Ids of exactly size top level elements drawn uniformly (reservoir sampling, Algorithm R), plus the
+#nodes of the selected ways.
+def select_reservoir(osm_file, size, seed=0):
+    rng = random.Random(seed)
+    reservoir = []
+    for i, element in enumerate(get_element(osm_file)):
+        if i < size:
+            slot = i
+        else:
+            slot = rng.randint(0, i)
+            if slot >= size:
+                continue
+        refs = node_refs(element) if element.tag == 'way' else None
+        entry = (element.tag, int(element.attrib['id']), refs)
+        if slot < len(reservoir):
+            reservoir[slot] = entry
+        else:
+            reservoir.append(entry)
+
+    selected = dict((tag, IdSet()) for tag in TOP_LEVEL_TAGS)
+    way_nodes = IdSet()
+    for tag, element_id, refs in reservoir:
+        selected[tag].add(element_id)
+        if refs:
+            way_nodes.extend(refs)
+    return selected, way_nodes
+
+
+#Ids of the nodes inside bbox (min_lon, min_lat, max_lon, max_lat), the ways with a node inside it
+#and the relations with a member among those, plus all the nodes of the selected ways.
+def select_bbox(osm_file, bbox):
+    min_lon, min_lat, max_lon, max_lat = bbox
+    selected = dict((tag, IdSet()) for tag in TOP_LEVEL_TAGS)
+    way_nodes = IdSet()
+    for element in get_element(osm_file):
+        element_id = int(element.attrib['id'])
+        if element.tag == 'node':
+            if min_lat <= float(element.attrib['lat']) <= max_lat and \
+                    min_lon <= float(element.attrib['lon']) <= max_lon:
+                selected['node'].add(element_id)
+        elif element.tag == 'way':
+            refs = node_refs(element)
+            if any(ref in selected['node'] for ref in refs):
+                selected['way'].add(element_id)
+                way_nodes.extend(refs)
+        else:
+            if any(member_id in selected[member_type]
+                   for member_type, member_id in members(element)):
+                selected['relation'].add(element_id)
+    return selected, way_nodes
+
+
+# ================================================== #
+#               Second Pass: Writing                 #
+# ================================================== #
+def write_sample(osm_file, sample_file, selected, way_nodes):
+    """Write the selected elements and the nodes of the selected ways to sample_file
+
+    Returns the number of elements written per type.
+    """
+    for ids in selected.values() + [way_nodes]:
+        ids.freeze()
+    written = dict((tag, 0) for tag in TOP_LEVEL_TAGS)
+
+    with open(sample_file, 'wb') as output:
+        output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write('<osm>\n  ')
+
+        for element in get_element(osm_file):
+            element_id = int(element.attrib['id'])
+            if element_id not in selected[element.tag] and \
+                    not (element.tag == 'node' and element_id in way_nodes):
+                continue
+            if element.tag == 'relation':
+                # Keep the sample closed: drop members that were not sampled
+                for member in list(element.iter('member')):
+                    member_id = int(member.attrib['ref'])
+                    member_type = member.attrib['type']
+                    if member_id not in selected[member_type] and \
+                            not (member_type == 'node' and member_id in way_nodes):
+                        element.remove(member)
             output.write(ET.tostring(element, encoding='utf-8'))
+            written[element.tag] += 1
+
+        output.write('</osm>')
+    return written
+
+
+def create_sample(osm_file=OSM_FILE, sample_file=SAMPLE_FILE, mode='every-k', every=k, size=None,
+                  bbox=None, seed=0):
+    """Sample osm_file into sample_file, see the module docstring for the modes"""
+    if mode == 'every-k':
+        selected, way_nodes = select_every_k(osm_file, every)
+    elif mode == 'reservoir':
+        selected, way_nodes = select_reservoir(osm_file, size, seed)
+    elif mode == 'bbox':
+        selected, way_nodes = select_bbox(osm_file, bbox)
+    else:
+        raise ValueError("Unknown sampling mode '{0}'".format(mode))
+    return write_sample(osm_file, sample_file, selected, way_nodes)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Write a referentially complete OSM sample")
+    arg_parser.add_argument('osm_file', nargs='?', default=OSM_FILE)
+    arg_parser.add_argument('sample_file', nargs='?', default=SAMPLE_FILE)
+    arg_parser.add_argument('--mode', choices=('every-k', 'reservoir', 'bbox'), default='every-k')
+    arg_parser.add_argument('-k', type=int, default=k, help="every-k: take every k-th element")
+    arg_parser.add_argument('--size', type=int, help="reservoir: number of elements to sample")
+    arg_parser.add_argument('--seed', type=int, default=0, help="reservoir: random seed")
+    arg_parser.add_argument('--bbox', help="bbox: min_lon,min_lat,max_lon,max_lat")
+    args = arg_parser.parse_args()
+
+    if args.mode == 'reservoir' and args.size is None:
+        arg_parser.error("--mode reservoir needs --size")
+    if args.mode == 'bbox' and args.bbox is None:
+        arg_parser.error("--mode bbox needs --bbox")
+    bbox = [float(value) for value in args.bbox.split(',')] if args.bbox else None
 
-    output.write('</osm>')
\ No newline at end of file
+    written = create_sample(args.osm_file, args.sample_file, args.mode, args.k, args.size, bbox,
+                            args.seed)
+    print "Wrote {0} nodes, {1} ways and {2} relations to {3}".format(
+        written['node'], written['way'], written['relation'], args.sample_file)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compiled cross references for street and city cleaning.
+
+The cross references are maintained as pandas DataFrames (see createStCR and createCityCR in
+data.py) so they can be extended with addmappings / buildcitiescrossreference and saved back to
+csv.  Looking values up in a DataFrame with a boolean mask scans every row, which is far too slow
+to do once per tag.  A CrossReference is built once from the DataFrames (or straight from the csv
+files) and answers the same questions with dictionary lookups.
+"""
+
+import csv
+import re
+
+street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
+
+
+class CrossReference(object):
+    """Dictionary backed street and city cross reference"""
+
+    def __init__(self, street_rows=(), city_rows=()):
+        self.common_names = {}
+        self.usps_names = {}
+        self.street_values = set()
+        self.city_names = {}
+
+        # The DataFrame lookups always return the first matching row, so keep the first mapping
+        # seen for each name.
+        for common_name, full_name, usps_name in street_rows:
+            self.common_names.setdefault(common_name, full_name)
+            self.usps_names.setdefault(usps_name, full_name)
+            self.street_values.update((common_name, full_name, usps_name))
+
+        for original_name, new_name in city_rows:
+            self.city_names.setdefault(original_name, new_name)
+
+    @classmethod
+    def from_frames(cls, street_cr, city_cr=None):
+        """Compile the USPS street and cities DataFrames"""
+        street_rows = ()
+        city_rows = ()
+        if street_cr is not None and len(street_cr):
+            street_rows = zip(street_cr["CommonName"].values, street_cr["FullName"].values,
+                              street_cr["USPSName"].values)
+        if city_cr is not None and len(city_cr):
+            city_rows = zip(city_cr["OriginalName"].values, city_cr["NewName"].values)
+        return cls(street_rows, city_rows)
+
+    @classmethod
+    def from_files(cls, street_file, city_file):
+        """Compile the USPS street and cities csv files without going through pandas"""
+        with open(street_file, "rb") as f:
+            street_rows = [(row["CommonName"], row["FullName"], row["USPSName"])
+                           for row in csv.DictReader(f)]
+        with open(city_file, "rb") as f:
+            city_rows = [(row["OriginalName"], row["NewName"]) for row in csv.DictReader(f)]
+        return cls(street_rows, city_rows)
+
+    def is_known_street_type(self, street_type):
+        """True if the street type appears anywhere in the USPS cross reference"""
+        return street_type.upper() in self.street_values
+
+    def update_name(self, name):
+        """Same result as data.update_name, one dictionary lookup per name"""
+        m = street_type_re.search(name)
+        if m:
+            street_type_upper = m.group().upper()
+            full_name = self.common_names.get(street_type_upper)
+            if full_name is None:
+                full_name = self.usps_names.get(street_type_upper)
+            if full_name is not None:
+                return name.replace(street_type_upper, full_name).upper()
+        return name.upper()
+
+    def update_city_name(self, name):
+        """Same result as data.update_city_name, one dictionary lookup per name"""
+        return self.city_names.get(name, name)
+
+
+class RawValues(CrossReference):
+    """Leaves street and city values as they are, for process_map(normalize='deferred')"""
+
+    def update_name(self, name):
+        return name.upper()
+
+    def update_city_name(self, name):
+        return name
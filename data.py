@@ -155,16 +155,35 @@ The final return value for a "way" element should look something like:
 """
 
 import csv
-import codecs
 import collections
+import itertools
 import pprint
 import re
-import xml.etree.cElementTree as ET
+import time
 import pandas as pd
 
-import cerberus
-
+import audits
+import checkpoints
+import columnar
+import compressed
+import crossref
+import documents
+import elementindex
+import fastvalidator
+import geometry
+import instrumentation
+import osmchunks
+import parsers
+import pbf
+import pipeline
 import schema
+import shapecache
+import spatialindex
+import sqlitedb
+import suggestions
+import tagprofile
+import tagvalues
+import writers
 
 OSM_PATH = "sample.osm"
 USPS_STREET = "USPS Street Abbrev.csv"
@@ -175,6 +194,19 @@ NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+DB_PATH = "osm.db"
+DOCUMENTS_PATH = "osm.json"
+COLUMNAR_DIR = "parquet"
+CHECKPOINT_PATH = "process_map.checkpoint"
+GEOMETRY_DIR = "geometry"
+WAYS_GEOMETRY_PATH = "ways_geometry.csv"
+STREET_SUGGESTIONS = "street_suggestions.csv"
+CITY_SUGGESTIONS = "city_suggestions.csv"
+TAG_PROFILE_PATH = "tag_profile.csv"
+SHAPE_CACHE_PATH = "shape_cache.db"
+ELEMENT_INDEX_DIR = "element_index"
+
+NORMALIZE_MODES = ('inline', 'deferred')  # Clean street / city values while shaping or afterwards
 
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
@@ -182,6 +214,9 @@ street_type_re=re.compile(r'\b\S+\.?$',re.IGNORECASE)
 
 Cross_Reference = pd.DataFrame()
 Cross_Reference_Cities = pd.DataFrame()
+Compiled_Cross_Reference = None
+
+KeyValueType = collections.namedtuple("key_value_type", ["key", "value", "type"])
 
 SCHEMA = schema.schema
 
@@ -192,6 +227,24 @@ WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
 
+# Shaped rows, in the field orders above. Being tuples they go straight to the csv, SQLite and
+# Parquet writers, and they carry no per-instance dict.
+NodeRecord = collections.namedtuple("NodeRecord", NODE_FIELDS)
+NodeTagRecord = collections.namedtuple("NodeTagRecord", NODE_TAGS_FIELDS)
+WayRecord = collections.namedtuple("WayRecord", WAY_FIELDS)
+WayTagRecord = collections.namedtuple("WayTagRecord", WAY_TAGS_FIELDS)
+WayNodeRecord = collections.namedtuple("WayNodeRecord", WAY_NODES_FIELDS)
+
+# Tables in the order write_elements writes them: (table, fields, field schema, primary key)
+TABLES = [
+    ('nodes', NODE_FIELDS, SCHEMA['node']['schema'], 'id'),
+    ('nodes_tags', NODE_TAGS_FIELDS, SCHEMA['node_tags']['schema']['schema'], None),
+    ('ways', WAY_FIELDS, SCHEMA['way']['schema'], 'id'),
+    ('ways_nodes', WAY_NODES_FIELDS, SCHEMA['way_nodes']['schema']['schema'], None),
+    ('ways_tags', WAY_TAGS_FIELDS, SCHEMA['way_tags']['schema']['schema'], None),
+]
+SQL_INDEXES = [('nodes_tags', 'id'), ('ways_tags', 'id'), ('ways_nodes', 'id'), ('ways_nodes', 'node_id')]
+
 
 # ================================================== #
 #               Audit Functions                      #
@@ -215,6 +268,21 @@ def createStCR():
 def createCityCR():
     CityCR=readindata(CITIES_LIST)
     return CityCR
+
+#Compile the cross reference DataFrames into dictionary lookups for cleaning.
+def compileCR(StCR=None,CityCR=None):
+    global Compiled_Cross_Reference
+    if StCR is None and CityCR is None:
+        Compiled_Cross_Reference=crossref.CrossReference.from_files(USPS_STREET,CITIES_LIST)
+    else:
+        Compiled_Cross_Reference=crossref.CrossReference.from_frames(StCR,CityCR)
+    return Compiled_Cross_Reference
+
+#Compiled cross reference used by handle_tags, loaded from the csv files on first use.
+def compiled_cross_reference():
+    if Compiled_Cross_Reference is None:
+        return compileCR()
+    return Compiled_Cross_Reference
     
 #Determine street names (from case study)
 def is_street_name(elem):
@@ -225,18 +293,20 @@ def audit_street_type(street_types, street_name,CR):
     m = street_type_re.search(street_name)
     if m:
         street_type = m.group()
-        if str.upper(street_type) not in CR.values:
+        if isinstance(CR, crossref.CrossReference):
+            known = CR.is_known_street_type(street_type)
+        else:
+            known = str.upper(street_type) in CR.values
+        if not known:
            street_types[street_type].add(street_name)
         return street_types
 
 #Test the dataset to see how many variations appear (Aimee's function)        
 def count_street_name():
-    namecount = 0
-    for event, elem in ET.iterparse(OSM_PATH,events=('start',)):
-        if elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    namecount = namecount +1
+    runner = audits.AuditRunner()
+    counter = runner.register(audits.StreetNameCounter())
+    runner.run(OSM_PATH)
+    namecount = counter.result()
     print "Total Name Count: ", namecount
 
 #Function to see how many "weirdo" names are generated in auditing. (Aimee's function)
@@ -248,21 +318,23 @@ def count_street_type(st):
 
 #Audit function for street types (from case study with slight modification)
 def audit(osmfile,CR):
-    osm_file = open(osmfile, "r")
-    street_types = collections.defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'],CR)
-                    
-    osm_file.close()   
-    return street_types
+    runner = audits.AuditRunner()
+    auditor = runner.register(audits.StreetTypeAuditor(crossref.CrossReference.from_frames(CR)))
+    runner.run(osmfile)
+    return auditor.result()
 
 
 #Cycle through list of 'weirdos' and add to cross-reference with better name. (Aimee's function)
-def addmappings(st_list,CR):
+#batch=True asks nothing: it writes suggestions for every street type to STREET_SUGGESTIONS for
+#review (see suggestions.py) and returns CR unchanged; applymappings adds the accepted ones.
+def addmappings(st_list,CR,batch=False):
+    if batch:
+        suggester = suggestions.street_type_suggester(crossref.CrossReference.from_frames(CR))
+        rows = suggestions.suggestion_rows(suggester, st_list, st_list)
+        suggestions.write_suggestions(STREET_SUGGESTIONS, rows)
+        print "Wrote {0} street type suggestions to {1}".format(len(rows), STREET_SUGGESTIONS)
+        return CR
+
     addedmappings=pd.DataFrame(columns=['FullName', 'CommonName', 'USPSName'])
     
     for st in st_list:
@@ -284,8 +356,20 @@ def addmappings(st_list,CR):
     return CR
 
 
+#Add the accepted rows of a reviewed street suggestions file to CR, as addmappings would.
+def applymappings(CR, path=STREET_SUGGESTIONS):
+    addedmappings=pd.DataFrame([(st_upper, newvalue, st_upper)
+                                for st_upper, newvalue in suggestions.read_accepted(path)],
+                               columns=['CommonName', 'FullName', 'USPSName'])
+    CR=CR.append(addedmappings).reset_index(drop=True)
+    savedata(CR,USPS_STREET)
+    return CR
+
+
 #Function to update "weirdo" street names (Aimee's function - all forced to upper per my preference).  
 def update_name(name, CR):
+    if isinstance(CR, crossref.CrossReference):
+        return CR.update_name(name)
     m = street_type_re.search(name)
     new_name=""
     if m:        
@@ -310,17 +394,10 @@ def update_name(name, CR):
 
 #Helper function for testing to view results of street name updates without running full process map. (Aimee's function)
 def dispnewnames(osmfile,CR):
-    osm_file = open(osmfile, "r")
-    new_names = collections.defaultdict(set)
-    
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    street_name=tag.attrib['v']
-                    new_names[street_name].add(update_name(street_name,CR))  
-    osm_file.close()
+    runner = audits.AuditRunner()
+    auditor = runner.register(audits.NewStreetNameAuditor(crossref.CrossReference.from_frames(CR)))
+    runner.run(osmfile)
+    new_names = auditor.result()
     print new_names
     print len(new_names)
     return new_names
@@ -329,26 +406,34 @@ def dispnewnames(osmfile,CR):
 
 #What do the cities look like - are they fairly normalized?
 def citieslist(osmfile):
-    osm_file = open(osmfile, "r")
-    attriblist = collections.defaultdict(set)
-    
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if tag.attrib["k"]=="addr:city":
-                    attriblist[tag.attrib["k"]].add(tag.attrib["v"])
+    runner = audits.AuditRunner()
+    auditor = runner.register(audits.CityAuditor())
+    runner.run(osmfile)
+    attriblist = auditor.result()
 
     pprint.pprint(attriblist)
-                    
-    osm_file.close()   
     return attriblist
 
 
 
 #Function to cycle through all listed cities, identify ones that need changing, and desired replacement values.
-def buildcitiescrossreference(cities):
+#batch=True asks nothing: it writes suggestions for the cities not in CITIES_LIST to
+#CITY_SUGGESTIONS for review and returns the cross reference unchanged; applycitymappings adds the
+#accepted ones.
+def buildcitiescrossreference(cities,batch=False):
     citiescrossreference = readindata(CITIES_LIST)
+    if batch:
+        known = set(citiescrossreference["OriginalName"].values)
+        spellings = collections.defaultdict(set)
+        for city in cities["addr:city"]:
+            if city.upper() not in known:
+                spellings[city.upper()].add(city)
+        suggester = suggestions.city_suggester(
+            crossref.CrossReference.from_frames(None, citiescrossreference))
+        rows = suggestions.suggestion_rows(suggester, spellings, spellings)
+        suggestions.write_suggestions(CITY_SUGGESTIONS, rows)
+        print "Wrote {0} city suggestions to {1}".format(len(rows), CITY_SUGGESTIONS)
+        return citiescrossreference
   
     for city in cities["addr:city"]:
         if str.upper(city) not in citiescrossreference:
@@ -373,8 +458,18 @@ def buildcitiescrossreference(cities):
     
     return citiescrossreference
 
+#Add the accepted rows of a reviewed city suggestions file to the cities cross reference and save it.
+def applycitymappings(path=CITY_SUGGESTIONS):
+    citiescrossreference = readindata(CITIES_LIST)
+    new_rows = pd.DataFrame(suggestions.read_accepted(path), columns=['OriginalName', 'NewName'])
+    citiescrossreference = citiescrossreference.append(new_rows, ignore_index=True)
+    savedata(citiescrossreference,CITIES_LIST)
+    return citiescrossreference
+
 #update city names with new name from DataFrame build in buildcitiescrossreference function.
 def update_city_name(name, CR):
+    if isinstance(CR, crossref.CrossReference):
+        return CR.update_city_name(name)
     
     new_city_name=""
          
@@ -390,21 +485,39 @@ def update_city_name(name, CR):
 
 #Function to run all city names through the update process and display results (to ensure they are as desired).
 def dispnewcitynames(osmfile,CR):
-    osm_file = open(osmfile, "r")
-    new_city_names = collections.defaultdict(set)
-    
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                 if tag.attrib["k"]=="addr:city":
-                    city_name=tag.attrib['v']
-                    new_city_names[city_name].add(update_city_name(city_name,CR))  
-    osm_file.close()
+    runner = audits.AuditRunner()
+    auditor = runner.register(audits.NewCityNameAuditor(crossref.CrossReference.from_frames(None,CR)))
+    runner.run(osmfile)
+    new_city_names = auditor.result()
     print new_city_names
     print len(new_city_names)
     return new_city_names
 
+#Run every audit report in a single pass over the file instead of one parse per report.
+def runallaudits(osmfile,CR,CityCR):
+    CCR = crossref.CrossReference.from_frames(CR,CityCR)
+    runner = audits.AuditRunner()
+    reports = {
+        'street_types': runner.register(audits.StreetTypeAuditor(CCR)),
+        'street_name_count': runner.register(audits.StreetNameCounter()),
+        'new_names': runner.register(audits.NewStreetNameAuditor(CCR)),
+        'cities': runner.register(audits.CityAuditor()),
+        'new_city_names': runner.register(audits.NewCityNameAuditor(CCR)),
+    }
+    runner.run(osmfile)
+    return dict((name, auditor.result()) for name, auditor in reports.items())
+
+#Which keys need cleaning rules? Counts, distinct values, top values and PROBLEMCHARS rates for
+#every tag key, in fixed memory per key (see tagprofile.py), written to path.
+def profile_tags(osmfile,path=TAG_PROFILE_PATH):
+    runner = audits.AuditRunner()
+    profiler = runner.register(tagprofile.TagProfiler(PROBLEMCHARS))
+    runner.run(osmfile)
+    profile = profiler.result()
+    tagprofile.write_profile(path, profile)
+    print "Profiled {0} tag keys, written to {1}".format(len(profile), path)
+    return profile
+
 #Function to handle processing of subtags in shape_element. (Aimee's function)
 def handle_tags(key_name,value_name,problem_chars=PROBLEMCHARS, default_tag_type='regular'):
     value_name=value_name.upper()           
@@ -417,96 +530,267 @@ def handle_tags(key_name,value_name,problem_chars=PROBLEMCHARS, default_tag_type
             
             if type_name=="street":
             
-               value_name=update_name(value_name, Cross_Reference) 
+               value_name=compiled_cross_reference().update_name(value_name) 
                                         
             elif type_name=="city":
                
-               value_name=update_city_name(value_name,Cross_Reference_Cities)
+               value_name=compiled_cross_reference().update_city_name(value_name)
                
                
         elif ":" not in key_name:
             
             type_name=default_tag_type
             
-    key_value_type = collections.namedtuple("key_value_type", ["key", "value", "type"])
-    return key_value_type(key_name,value_name,type_name)   
+    return KeyValueType(key_name,value_name,type_name)   
  
-#Shape element function from case study, finished by Aimee.      
+class ShapedElement(object):
+    """A shaped node or way: its record and lists of tag (and way node) records
+
+    el['node_tags'] still works, and as_dict() gives the nested dicts of the case study format.
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, table):
+        try:
+            return getattr(self, table)
+        except AttributeError:
+            raise KeyError(table)
+
+    def __contains__(self, table):
+        return table in self.__slots__
+
+    def tables(self):
+        """(table, record or list of records) for each part of the element"""
+        return [(table, getattr(self, table)) for table in self.__slots__]
+
+    def as_dict(self):
+        doc = {}
+        for table, rows in self.tables():
+            if isinstance(rows, list):
+                doc[table] = [dict(zip(row._fields, row)) for row in rows]
+            else:
+                doc[table] = dict(zip(rows._fields, rows))
+        return doc
+
+
+class ShapedNode(ShapedElement):
+    __slots__ = ('node', 'node_tags')
+    tag = 'node'
+
+    def __init__(self, node, node_tags):
+        self.node = node
+        self.node_tags = node_tags
+
+    def row_lists(self):
+        """The rows of each csv file, in csv order"""
+        return [self.node], self.node_tags
+
+    def row_counts(self):
+        return 1, len(self.node_tags)
+
+    def cache_tables(self):
+        """The rows as plain tuples (see shapecache.py)"""
+        return tuple(self.node), tuple(tuple(tag) for tag in self.node_tags)
+
+    @classmethod
+    def from_cache(cls, tables):
+        node, tags = tables
+        return cls(tuple.__new__(NodeRecord, node),
+                   [tuple.__new__(NodeTagRecord, tag) for tag in tags])
+
+
+class ShapedWay(ShapedElement):
+    __slots__ = ('way', 'way_nodes', 'way_tags')
+    tag = 'way'
+
+    def __init__(self, way, way_nodes, way_tags):
+        self.way = way
+        self.way_nodes = way_nodes
+        self.way_tags = way_tags
+
+    def row_lists(self):
+        """The rows of each csv file, in csv order"""
+        return [self.way], self.way_nodes, self.way_tags
+
+    def row_counts(self):
+        return 1, len(self.way_nodes), len(self.way_tags)
+
+    def cache_tables(self):
+        """The rows as plain tuples, way nodes as their node ids only (see shapecache.py)"""
+        return (tuple(self.way), tuple(way_node[1] for way_node in self.way_nodes),
+                tuple(tuple(tag) for tag in self.way_tags))
+
+    @classmethod
+    def from_cache(cls, tables):
+        way, node_ids, tags = tables
+        wayid = way[0]
+        return cls(tuple.__new__(WayRecord, way),
+                   [tuple.__new__(WayNodeRecord, (wayid, node_id, position))
+                    for position, node_id in enumerate(node_ids)],
+                   [tuple.__new__(WayTagRecord, tag) for tag in tags])
+
+
+SHAPED_TYPES = {'node': ShapedNode, 'way': ShapedWay}
+
+
+class FormattedElement(collections.namedtuple('FormattedElement', ['tag', 'tables'])):
+    """A shaped node or way as csv text: (text, number of rows) for each of its csv files
+
+    What the shape cache keeps for csv output (see shapecache.py); write_elements writes the text
+    as it is.
+    """
+
+    __slots__ = ()
+
+    def row_counts(self):
+        return [rows for _, rows in self.tables]
+
+    @classmethod
+    def from_shaped(cls, shaped_elements):
+        """FormattedElements for a list of ShapedNodes / ShapedWays, formatted in one pass"""
+        element_lists = [el.row_lists() for el in shaped_elements]
+        row_lists = [rows for rows_of_element in element_lists for rows in rows_of_element]
+        tables = iter(zip(writers.format_row_lists(row_lists), map(len, row_lists)))
+        new = tuple.__new__
+        return [new(cls, (el.tag, tuple([next(tables) for _ in rows_of_element])))
+                for el, rows_of_element in zip(shaped_elements, element_lists)]
+
+
+#Integer attribute values are kept as ints; anything that isn't one is left (upper cased) for the
+#validator to report.
+def integer_value(text):
+    try:
+        return int(text)
+    except ValueError:
+        return text.upper()
+
+
+#Shape element function from case study, finished by Aimee.
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
                   problem_chars=PROBLEMCHARS, default_tag_type='regular'):
-    """Clean and shape node or way XML element to Python dict"""
-
-    node_attribs = {}
-    way_attribs = {}
-    way_nodes = []
-    tags = []  # Handle secondary tags the same way for both node and way elements
-
-    # YOUR CODE
-    nodeid=""
-    wayid=""
-    index=0
-    tag_values={}
-    way_node_values={}
-    
+    """Clean and shape node or way XML element to a ShapedNode / ShapedWay
+
+    Ids, uids, changesets and positions are ints, lat / lon keep the text of the file (so the csv
+    output has the coordinates exactly as written) and the other attributes are upper cased.
+    """
+    attrib = element.attrib
+
     if element.tag == 'node':
+        nodeid = integer_value(attrib['id'])
+        # In NODE_FIELDS order
+        node = NodeRecord(nodeid, attrib['lat'], attrib['lon'], attrib['user'].upper(),
+                          integer_value(attrib['uid']), attrib['version'].upper(),
+                          integer_value(attrib['changeset']), attrib['timestamp'].upper())
+        # <tag> / <nd> are direct children: iterating them avoids cElementTree's (pure Python)
+        # recursive Element.iter
+        tags = [NodeTagRecord(nodeid, *handle_tags(child.attrib['k'], child.attrib['v']))
+                for child in element if child.tag == 'tag']
+        return ShapedNode(node, tags)
 
-        for field in NODE_FIELDS:
-            node_attribs[field]=element.attrib[field].upper()
-            if field =="id":
-                nodeid=element.attrib[field]
-                        
-        for element in element.iter('tag'):
-            tag_values['id']=nodeid
-            key_value_type=handle_tags(element.attrib['k'],element.attrib['v'])
-            tag_values['key']=key_value_type.key
-            tag_values['value']=key_value_type.value
-            tag_values['type']=key_value_type.type
-            tag_values_c=tag_values.copy()
-            tags.append(tag_values_c)
-                               
-        return {'node': node_attribs, 'node_tags': tags}
-    
     if element.tag == 'way':
-        for field in WAY_FIELDS:
-            way_attribs[field]=element.attrib[field].upper()
-            if field=="id":
-                wayid=element.attrib[field]
-            
-            
-        for element in element.iter('tag'):
-            tag_values['id']=wayid
-            key_value_type=handle_tags(element.attrib['k'],element.attrib['v'])
-            tag_values['key']=key_value_type.key
-            tag_values['value']=key_value_type.value
-            tag_values['type']=key_value_type.type 
-            tag_values_c=tag_values.copy()
-            tags.append(tag_values_c)
-        
-            
-        for element in element.iter('nd'):
-            way_node_values['id']=wayid
-            way_node_values['node_id']=element.attrib['ref'].upper()
-            way_node_values['position']=index
-            index=index+1
-            way_node_values_c=way_node_values.copy()
-            way_nodes.append(way_node_values_c)
-            
-        return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
+        wayid = integer_value(attrib['id'])
+        # In WAY_FIELDS order
+        way = WayRecord(wayid, attrib['user'].upper(), integer_value(attrib['uid']),
+                        attrib['version'].upper(), integer_value(attrib['changeset']),
+                        attrib['timestamp'].upper())
+        tags = []
+        way_nodes = []
+        for child in element:
+            if child.tag == 'nd':
+                way_nodes.append(WayNodeRecord(wayid, integer_value(child.attrib['ref']),
+                                               len(way_nodes)))
+            elif child.tag == 'tag':
+                tags.append(WayTagRecord(wayid, *handle_tags(child.attrib['k'],
+                                                             child.attrib['v'])))
+        return ShapedWay(way, way_nodes, tags)
+
+
+#shape_element done in the expat tag callbacks: the records are built as the tags arrive, so no
+#LightChild is made for the <tag> / <nd> children. Yields the (element, shaped element) pairs of
+#shaped_elements for an open XML file, the elements as parsers.BareElements. The records are made
+#with tuple.__new__, skipping the (pure Python) namedtuple constructors.
+def expat_shaped_elements(source):
+    shaped = []
+    # The element being shaped and the lists its <tag> / <nd> rows go to (None outside a node or
+    # way, so the tags of relations and other top level elements are skipped)
+    state = {'id': None, 'pair': None, 'tags': None, 'tag_record': None, 'way_nodes': None}
+    new = tuple.__new__
+
+    def start(name, attrs):
+        if name == 'tag':
+            tags = state['tags']
+            if tags is not None:
+                if parser.CurrentByteIndex < reader.non_ascii_end:
+                    attrs = parsers.decoded(attrs)
+                key, value, tag_type = handle_tags(attrs['k'], attrs['v'])
+                tags.append(new(state['tag_record'], (state['id'], key, value, tag_type)))
+        elif name == 'nd':
+            way_nodes = state['way_nodes']
+            if way_nodes is not None:
+                way_nodes.append(new(WayNodeRecord, (state['id'], integer_value(attrs['ref']),
+                                                     len(way_nodes))))
+        elif name == 'node':
+            if parser.CurrentByteIndex < reader.non_ascii_end:
+                attrs = parsers.decoded(attrs)
+            nodeid = state['id'] = integer_value(attrs['id'])
+            tags = state['tags'] = []
+            state['tag_record'] = NodeTagRecord
+            state['way_nodes'] = None
+            # In NODE_FIELDS order
+            node = new(NodeRecord, (nodeid, attrs['lat'], attrs['lon'], attrs['user'].upper(),
+                                    integer_value(attrs['uid']), attrs['version'].upper(),
+                                    integer_value(attrs['changeset']),
+                                    attrs['timestamp'].upper()))
+            state['pair'] = (new(parsers.BareElement, (name, attrs)), ShapedNode(node, tags))
+        elif name == 'way':
+            if parser.CurrentByteIndex < reader.non_ascii_end:
+                attrs = parsers.decoded(attrs)
+            wayid = state['id'] = integer_value(attrs['id'])
+            tags = state['tags'] = []
+            state['tag_record'] = WayTagRecord
+            way_nodes = state['way_nodes'] = []
+            # In WAY_FIELDS order
+            way = new(WayRecord, (wayid, attrs['user'].upper(), integer_value(attrs['uid']),
+                                  attrs['version'].upper(), integer_value(attrs['changeset']),
+                                  attrs['timestamp'].upper()))
+            state['pair'] = (new(parsers.BareElement, (name, attrs)),
+                             ShapedWay(way, way_nodes, tags))
+
+    def end(name):
+        if name in SHAPED_TYPES:
+            shaped.append(state['pair'])
+            state['tags'] = state['way_nodes'] = None
+
+    reader = parsers.ExpatReader(start, end)
+    parser = reader.parser
+    return reader.parse(source, shaped)
 
 
 # ================================================== #
 #               Helper Functions                     #
 # ================================================== #
 #Function from case study.
-def get_element(osm_file, tags=('node', 'way', 'relation')):
+#Paths to .bz2 / .gz / .zip files are decompressed as they are read (see compressed.py), .pbf
+#files are decoded with pbf.PbfReader. XML is parsed with the parser backend named by parser
+#('iterparse' or 'expat', see parsers.py).
+def get_element(osm_file, tags=('node', 'way', 'relation'), parser=parsers.DEFAULT_PARSER):
     """Yield element if it is the right type of tag"""
 
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
+    if pbf.is_pbf(osm_file):
+        osm_file = pbf.PbfReader(osm_file)
+    if isinstance(osm_file, pbf.PbfReader):
+        for elem in osm_file.iter_elements(tags):
             yield elem
-            root.clear()
+        return
+
+    source = compressed.open_input(osm_file) if isinstance(osm_file, basestring) else osm_file
+    try:
+        for elem in parsers.iter_elements(source, tags, parser):
+            yield elem
+    finally:
+        if source is not osm_file:
+            source.close()
 
 #Helper function to show results of processing ways and nodes tags without running full program. (Aimee's function)            
 def showdictionaryvalues(osmfile):
@@ -519,9 +803,39 @@ def showdictionaryvalues(osmfile):
    return el
 
 
+#The element index of osmfile in directory (see elementindex.py), indexing the file first if it
+#hasn't been or has changed since.
+def open_element_index(osmfile, directory=ELEMENT_INDEX_DIR, parser=parsers.DEFAULT_PARSER):
+    if not elementindex.is_current(osmfile, directory):
+        elementindex.build_index(osmfile, directory)
+    return elementindex.ElementIndex.open(osmfile, directory, parser)
+
+
+#showdictionaryvalues for one node or way, read by id through the element index instead of
+#parsing the file up to it.
+def showelement(osmfile, element_type, element_id, directory=ELEMENT_INDEX_DIR):
+    index = open_element_index(osmfile, directory)
+    try:
+        el = shape_element(index.element(element_type, element_id))
+    finally:
+        index.close()
+    pprint.pprint(el.as_dict())
+    return el
+
+
+#Shaped elements of element_type with ids from first_id to last_id, in file order, read through an
+#open ElementIndex.
+def shaped_id_range(index, element_type, first_id, last_id):
+    for element in index.id_range(element_type, first_id, last_id):
+        yield shape_element(element)
+
+
 #Function from case study.
 def validate_element(element, validator, schema=SCHEMA):
     """Raise ValidationError if element does not match schema"""
+    if isinstance(element, ShapedElement) and \
+            not isinstance(validator, fastvalidator.FastValidator):
+        element = element.as_dict()  # cerberus only takes mappings
     if validator.validate(element, schema) is not True:
         field, errors = next(validator.errors.iteritems())
         message_string = "\nElement of type '{0}' has the following errors:\n{1}"
@@ -529,6 +843,18 @@ def validate_element(element, validator, schema=SCHEMA):
         
         raise Exception(message_string.format(field, error_string))
 
+#Validate a list of shaped elements at once with a FastValidator, raising for the first bad one.
+def validate_elements(elements, validator, schema=SCHEMA):
+    """Raise ValidationError if any element does not match schema"""
+    invalid = validator.validate_batch(elements, schema)
+    if invalid:
+        index, errors = invalid[0]
+        field, errors = next(errors.iteritems())
+        message_string = "\nElement of type '{0}' has the following errors:\n{1}"
+        error_string = pprint.pformat(errors)
+
+        raise Exception(message_string.format(field, error_string))
+
 #Function from case study.
 class UnicodeDictWriter(csv.DictWriter, object):
     """Extend csv.DictWriter to handle Unicode input"""
@@ -546,47 +872,579 @@ class UnicodeDictWriter(csv.DictWriter, object):
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-    with codecs.open(NODES_PATH, 'wb') as nodes_file, \
-          codecs.open(NODE_TAGS_PATH, 'wb') as nodes_tags_file, \
-          codecs.open(WAYS_PATH, 'wb') as ways_file, \
-          codecs.open(WAY_NODES_PATH, 'wb') as way_nodes_file, \
-          codecs.open(WAY_TAGS_PATH, 'wb') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node', 'way')):
+#Yield (element, shaped element) for each node and way in file_in, validated if validate is True.
+#With the expat parser an XML file is shaped in the parser callbacks (see expat_shaped_elements).
+def shaped_elements(file_in, validate, parser=parsers.DEFAULT_PARSER, metrics=None):
+    if metrics is not None:
+        for element, el in timed_shaped_elements(file_in, validate, parser, metrics):
+            yield element, el
+        return
+
+    validator = fastvalidator.FastValidator(SCHEMA)
+    if parser == 'expat' and not (isinstance(file_in, pbf.PbfReader) or pbf.is_pbf(file_in)):
+        source = compressed.open_input(file_in) if isinstance(file_in, basestring) else file_in
+        try:
+            for element, el in expat_shaped_elements(source):
+                if validate is True:
+                    validate_element(el, validator)
+                yield element, el
+        finally:
+            if source is not file_in:
+                source.close()
+        return
+
+    for element in get_element(file_in, tags=('node', 'way'), parser=parser):
+        el = shape_element(element)
+        if el:
+            if validate is True:
+                validate_element(el, validator)
+            yield element, el
+
+
+#shaped_elements, timing each stage into an instrumentation.Metrics. The time the caller takes
+#between elements is counted as writing.
+def timed_shaped_elements(file_in, validate, parser, metrics):
+    validator = fastvalidator.FastValidator(SCHEMA)
+    stages = metrics.stages
+    source = file_in
+    if isinstance(file_in, basestring) and not pbf.is_pbf(file_in):
+        source = compressed.open_input(file_in)
+    metrics.position_reader = instrumentation.position_reader(source)
+    clock = time.time
+
+    try:
+        elements = get_element(source, tags=('node', 'way'), parser=parser)
+        last = clock()
+        for element in elements:
+            parsed = clock()
+            stages['parse'] += parsed - last
             el = shape_element(element)
+            shaped = clock()
+            stages['shape'] += shaped - parsed
             if el:
                 if validate is True:
                     validate_element(el, validator)
-
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+                validated = clock()
+                stages['validate'] += validated - shaped
+                metrics.count(element.tag, el)
+                yield element, el
+                last = clock()
+                stages['write'] += last - validated
+            else:
+                last = shaped
+            metrics.progress()
+    finally:
+        metrics.position_reader = None
+        if source is not file_in:
+            source.close()
+
+
+#Shape (and validate, if validate is True) a batch of elements. With cache, a shapecache.ShapeCache,
+#the elements it has up to date rows for are taken from it and the others are stored in it. Returns
+#the (element, shaped element) pairs and the seconds spent validating; with a csv output cache the
+#shaped elements are FormattedElements.
+def shape_batch(elements, validate, validator, cache=None):
+    if cache is None:
+        shaped = []
+        for element in elements:
+            el = shape_element(element)
+            if el:
+                shaped.append((element, el))
+        if validate is not True:
+            return shaped, 0.0
+        start = time.time()
+        validate_elements([shaped_el for _, shaped_el in shaped], validator)
+        return shaped, time.time() - start
+
+    recorder = compiled_cross_reference()
+    recorder.take()
+    keys = dict((element_type, []) for element_type in SHAPED_TYPES)
+    ids = []
+    for element in elements:
+        element_id = integer_value(element.attrib['id'])
+        ids.append(element_id)
+        if isinstance(element_id, (int, long)):
+            keys[element.tag].append((element_id, element.attrib['version']))
+    found = {}
+    for element_type, type_keys in keys.items():
+        found[element_type] = cache.lookup(element_type, type_keys, validate is True)
+
+    formatted = cache.output == 'csv'
+    shaped = []
+    new = []
+    for element, element_id in itertools.izip(elements, ids):
+        tables = found[element.tag].get(element_id)
+        if tables is not None:
+            if formatted:
+                shaped.append((element, tuple.__new__(FormattedElement, (element.tag, tables))))
+            else:
+                shaped.append((element, SHAPED_TYPES[element.tag].from_cache(tables)))
+            continue
+        el = shape_element(element)
+        if el:
+            new.append((len(shaped), element, element_id, el, recorder.take()))
+            shaped.append((element, el))
+
+    new_els = [new_el for _, _, _, new_el, _ in new]
+    validate_seconds = 0.0
+    if validate is True:
+        start = time.time()
+        validate_elements(new_els, validator)
+        validate_seconds = time.time() - start
+    if formatted:
+        # Written and stored as csv text from here on
+        new_els = FormattedElement.from_shaped(new_els)
+        for (index, new_element, _, _, _), text_el in zip(new, new_els):
+            shaped[index] = (new_element, text_el)
+        new_tables = [text_el.tables for text_el in new_els]
+    else:
+        new_tables = [new_el.cache_tables() for new_el in new_els]
+    for element_type in SHAPED_TYPES:
+        entries = [(new_id, new_element.attrib['version'], dependencies, new_el_tables,
+                    validate is True)
+                   for (_, new_element, new_id, _, dependencies), new_el_tables
+                   in zip(new, new_tables)
+                   if new_element.tag == element_type and isinstance(new_id, (int, long))]
+        if entries:
+            cache.store(element_type, entries)
+    return shaped, validate_seconds
+
+
+#shaped_elements a batch at a time through shape_batch, taking what it can from cache.
+def cached_shaped_elements(file_in, validate, parser, cache, metrics=None):
+    validator = fastvalidator.FastValidator(SCHEMA)
+    source = file_in
+    if isinstance(file_in, basestring) and not pbf.is_pbf(file_in):
+        source = compressed.open_input(file_in)
+    if metrics is not None:
+        metrics.position_reader = instrumentation.position_reader(source)
+    clock = time.time
+
+    try:
+        elements = get_element(source, tags=('node', 'way'), parser=parser)
+        while True:
+            start = clock()
+            batch = list(itertools.islice(elements, shapecache.LOOKUP_IDS))
+            if not batch:
+                break
+            parsed = clock()
+            shaped, validate_seconds = shape_batch(batch, validate, validator, cache)
+            if metrics is not None:
+                written = clock()
+                metrics.stages['parse'] += parsed - start
+                metrics.stages['shape'] += written - parsed - validate_seconds
+                metrics.stages['validate'] += validate_seconds
+                for element, el in shaped:
+                    metrics.count(element.tag, el)
+            for element, el in shaped:
+                yield element, el
+            if metrics is not None:
+                metrics.stages['write'] += clock() - written
+                metrics.progress()
+    finally:
+        if metrics is not None:
+            metrics.position_reader = None
+        if source is not file_in:
+            source.close()
+
+
+#shaped_elements with parsing and shaping (and validating) on the threads of pipe, a
+#pipeline.Pipeline, a batch of elements at a time; what the caller does between elements is the
+#write stage.
+def pipelined_shaped_elements(file_in, validate, parser, pipe, metrics=None, cache=None):
+    validator = fastvalidator.FastValidator(SCHEMA)
+    source = file_in
+    if isinstance(file_in, basestring) and not pbf.is_pbf(file_in):
+        source = compressed.open_input(file_in)
+    validate_seconds = [0.0]
+
+    def shape_stage(elements):
+        shaped, seconds = shape_batch(elements, validate, validator, cache)
+        validate_seconds[0] += seconds
+        if metrics is not None:
+            for element, el in shaped:
+                metrics.count(element.tag, el)
+        return shaped
+
+    if metrics is not None:
+        metrics.position_reader = instrumentation.position_reader(source)
+        busy_before = dict((name, stats['busy']) for name, stats in pipe.stages.items())
+    try:
+        batches = pipe.run(get_element(source, tags=('node', 'way'), parser=parser),
+                           [('shape', shape_stage)])
+        for batch in batches:
+            for element, el in batch:
+                yield element, el
+            if metrics is not None:
+                metrics.progress()
+    finally:
+        if source is not file_in:
+            source.close()
+        if metrics is not None:
+            metrics.position_reader = None
+            busy = dict((name, stats['busy'] - busy_before.get(name, 0.0))
+                        for name, stats in pipe.stages.items())
+            metrics.stages['parse'] += busy['parse']
+            metrics.stages['shape'] += busy['shape'] - validate_seconds[0]
+            metrics.stages['validate'] += validate_seconds[0]
+            metrics.stages['write'] += busy['write']
+
+
+#The shaped_elements generator for the options: on the threads of pipe (a pipeline.Pipeline) if
+#one is given, through cache (a shapecache.ShapeCache) if one is given.
+def element_stream(file_in, validate, parser, metrics=None, pipe=None, cache=None):
+    if pipe is not None:
+        return pipelined_shaped_elements(file_in, validate, parser, pipe, metrics, cache)
+    if cache is not None:
+        return cached_shaped_elements(file_in, validate, parser, cache, metrics)
+    return shaped_elements(file_in, validate, parser, metrics)
+
+
+#Shape each node and way in file_in and write the row tuples with the five csv writers (see
+#element_stream for pipe and cache). Returns the number of elements written and the (tag, id) of
+#the last one.
+def write_elements(file_in, writers, validate, parser=parsers.DEFAULT_PARSER, metrics=None,
+                   pipe=None, cache=None):
+    nodes_writer, node_tags_writer, ways_writer, way_nodes_writer, way_tags_writer = writers
+
+    count = 0
+    last_element = None
+
+    for element, el in element_stream(file_in, validate, parser, metrics, pipe, cache):
+        if el.__class__ is FormattedElement:
+            if element.tag == 'node':
+                node, node_tags = el.tables
+                nodes_writer.writetext(*node)
+                node_tags_writer.writetext(*node_tags)
+            else:
+                way, way_nodes, way_tags = el.tables
+                ways_writer.writetext(*way)
+                way_nodes_writer.writetext(*way_nodes)
+                way_tags_writer.writetext(*way_tags)
+        elif element.tag == 'node':
+            nodes_writer.writerow(el.node)
+            node_tags_writer.writerows(el.node_tags)
+        elif element.tag == 'way':
+            ways_writer.writerow(el.way)
+            way_nodes_writer.writerows(el.way_nodes)
+            way_tags_writer.writerows(el.way_tags)
+        count += 1
+        last_element = (element.tag, element.attrib['id'])
+
+    flush_start = time.time()
+    for writer in writers:
+        writer.flush()
+    if metrics is not None:
+        metrics.stages['write'] += time.time() - flush_start
+    return count, last_element
+
+
+#Shape file_in one element aligned segment at a time, saving a checkpoint after each segment.
+def write_checkpointed(file_in, writers, validate, checkpointer, parser=parsers.DEFAULT_PARSER,
+                       metrics=None, pipe=None, cache=None):
+    for start, end in osmchunks.find_chunks(file_in, checkpoints.CHECKPOINT_BYTES,
+                                            checkpointer.offset):
+        reader = osmchunks.ChunkReader(file_in, start, end)
+        try:
+            count, last_element = write_elements(reader, writers, validate, parser, metrics, pipe,
+                                                 cache)
+        finally:
+            reader.close()
+        checkpointer.save(end, last_element, count)
+    checkpointer.finish()
+
+
+#Shape each node and way in file_in into a nested document and hand it to every sink.
+def write_documents(file_in, sinks, validate, parser=parsers.DEFAULT_PARSER, metrics=None,
+                    pipe=None, cache=None):
+    shaper = documents.DocumentShaper(SCHEMA)
+
+    for element, el in element_stream(file_in, validate, parser, metrics, pipe, cache):
+        doc = shaper.shape_document(el)
+        for sink in sinks:
+            sink.write(doc)
+
+    flush_start = time.time()
+    for sink in sinks:
+        sink.flush()
+    if metrics is not None:
+        metrics.stages['write'] += time.time() - flush_start
+
+
+#The body of process_map. metrics is an instrumentation.Metrics to record into, or None, pipe a
+#pipeline.Pipeline to run the stages on, or None, and cache a shapecache.ShapeCache, or None.
+def run_process_map(file_in, validate, workers, buffer_rows, target, collection, checkpoint, resume,
+                    compress_output, parser, metrics=None, pipe=None, cache=None,
+                    row_group_rows=columnar.ROW_GROUP_ROWS, delta_encode=False,
+                    chunk_size=osmchunks.CHUNK_SIZE):
+    compressed_input = compressed.is_compressed(file_in)
+    pbf_input = pbf.is_pbf(file_in)
+    if (checkpoint or resume) and (compressed_input or pbf_input or compress_output):
+        raise ValueError("checkpoint and resume need an uncompressed XML input and csv output")
+    if pipe is not None and workers > 1 and not compressed_input:
+        raise ValueError("pipelined=True can't be combined with workers > 1 on an uncompressed "
+                         "XML or a PBF file, which is shaped in worker processes")
+    if cache is not None and workers > 1 and not compressed_input:
+        raise ValueError("shape_cache can't be combined with workers > 1 on an uncompressed XML "
+                         "or a PBF file, which is shaped in worker processes")
+    if target == 'sqlite':
+        if workers > 1:
+            raise ValueError("workers > 1 is only supported for csv output")
+        loader = sqlitedb.SqliteLoader(DB_PATH, TABLES, SQL_INDEXES, buffer_rows)
+        write_elements(file_in, loader.writers, validate, parser, metrics, pipe, cache)
+        stats = loader.finish()
+        print "Loaded {0} rows into {1} in {2:.1f}s ({3:.0f} rows/sec), indexes {4:.1f}s".format(
+            stats['total_rows'], DB_PATH, stats['load_seconds'], stats['rows_per_sec'],
+            stats['index_seconds'])
+        return stats
+    elif target == 'parquet':
+        if workers > 1:
+            raise ValueError("workers > 1 is only supported for csv output")
+        output = columnar.ColumnarOutput(COLUMNAR_DIR, TABLES, row_group_rows, delta_encode)
+        write_elements(file_in, output.writers, validate, parser, metrics, pipe, cache)
+        output.close()
+        return
+    elif target in ('json', 'mongodb'):
+        if workers > 1:
+            raise ValueError("workers > 1 is only supported for csv output")
+        if target == 'json':
+            with open(DOCUMENTS_PATH, 'wb') as documents_file:
+                write_documents(file_in, [documents.DocumentWriter(documents_file, buffer_rows)],
+                                validate, parser, metrics, pipe, cache)
+        else:
+            write_documents(file_in, [documents.InsertManySink(collection, buffer_rows)], validate,
+                            parser, metrics, pipe, cache)
+        return
+    elif target != 'csv':
+        raise ValueError("Unknown process_map target '{0}'".format(target))
+
+    state = None
+    if resume:
+        state = checkpoints.load_checkpoint(CHECKPOINT_PATH, file_in)
+        if state is not None:
+            if state['complete']:
+                print "Nothing to resume, {0} was processed completely".format(file_in)
+                return
+            checkpoints.truncate_outputs(state)
+            if metrics is not None:
+                metrics.start_position = metrics.position = state['offset']
+            print "Resuming {0} at byte {1} after {2} {3}".format(file_in, state['offset'],
+                                                                  *state['last_element'])
+    mode = 'ab' if state is not None else 'wb'
+
+    with compressed.open_output(NODES_PATH, mode, compress_output) as nodes_file, \
+          compressed.open_output(NODE_TAGS_PATH, mode, compress_output) as nodes_tags_file, \
+          compressed.open_output(WAYS_PATH, mode, compress_output) as ways_file, \
+          compressed.open_output(WAY_NODES_PATH, mode, compress_output) as way_nodes_file, \
+          compressed.open_output(WAY_TAGS_PATH, mode, compress_output) as way_tags_file:
+
+        nodes_writer = writers.BufferedCsvWriter(nodes_file, NODE_FIELDS, buffer_rows)
+        node_tags_writer = writers.BufferedCsvWriter(nodes_tags_file, NODE_TAGS_FIELDS, buffer_rows)
+        ways_writer = writers.BufferedCsvWriter(ways_file, WAY_FIELDS, buffer_rows)
+        way_nodes_writer = writers.BufferedCsvWriter(way_nodes_file, WAY_NODES_FIELDS, buffer_rows)
+        way_tags_writer = writers.BufferedCsvWriter(way_tags_file, WAY_TAGS_FIELDS, buffer_rows)
+
+        if state is None:
+            nodes_writer.writeheader()
+            node_tags_writer.writeheader()
+            ways_writer.writeheader()
+            way_nodes_writer.writeheader()
+            way_tags_writer.writeheader()
+
+        out_files = (nodes_file, nodes_tags_file, ways_file, way_nodes_file, way_tags_file)
+        csv_writers = (nodes_writer, node_tags_writer, ways_writer, way_nodes_writer,
+                       way_tags_writer)
+        checkpointer = None
+        if checkpoint or resume:
+            checkpointer = checkpoints.Checkpointer(CHECKPOINT_PATH, file_in, out_files, state)
+
+        if workers > 1 and compressed_input:
+            source = compressed.open_input(file_in, workers)
+            try:
+                write_elements(source, csv_writers, validate, parser, metrics, pipe, cache)
+            finally:
+                source.close()
+        elif workers > 1:
+            import parallel
+            parallel.write_chunks(file_in, out_files, validate, workers, compiled_cross_reference(),
+                                  chunk_size=chunk_size, buffer_rows=buffer_rows,
+                                  checkpointer=checkpointer, parser=parser, metrics=metrics)
+        elif checkpointer is not None:
+            write_checkpointed(file_in, csv_writers, validate, checkpointer, parser, metrics,
+                               pipe, cache)
+        else:
+            write_elements(file_in, csv_writers, validate, parser, metrics, pipe, cache)
+
+
+#(stage, seconds) in pipeline order, the post-processing stages last.
+def stage_seconds(stages):
+    order = instrumentation.STAGES + ('normalize', 'geometry', 'spatial_index')
+    return [(stage, stages[stage]) for stage in order if stage in stages]
+
+
+def process_map(file_in, validate, workers=1, buffer_rows=writers.BUFFER_ROWS, target='csv',
+                collection=None, checkpoint=False, resume=False, compress_output=False,
+                parser=parsers.DEFAULT_PARSER, metrics=None, normalize='inline',
+                way_geometry=False, spatial_index=False, pipelined=False,
+                queue_batches=pipeline.QUEUE_BATCHES, shape_cache=None,
+                shape_cache_bytes=shapecache.MAX_BYTES, row_group_rows=columnar.ROW_GROUP_ROWS,
+                delta_encode=False, chunk_size=osmchunks.CHUNK_SIZE):
+    """Iteratively process each XML element and write to csv(s)
+
+    Rows are buffered buffer_rows at a time per csv file (see writers.py).
+
+    With workers > 1 the file is split into element aligned chunks of about chunk_size bytes
+    which are shaped in a process pool (see parallel.py). A file smaller than chunk_size is one
+    chunk, shaped by one worker. The csv files are identical to a single process run.
+
+    target='sqlite' loads the rows straight into the tables of a new SQLite database at DB_PATH
+    instead of writing csv files (see sqlitedb.py).
+
+    target='parquet' writes typed Parquet files to COLUMNAR_DIR in row groups of row_group_rows
+    rows, with ways_nodes stored as one array of node ids per way (see columnar.py).
+    delta_encode=True stores each way's node ids as the first id followed by the differences
+    between consecutive ids (columnar.read_way_nodes decodes them).
+
+    target='json' writes one document per node/way to DOCUMENTS_PATH as newline delimited JSON,
+    target='mongodb' inserts the same documents into collection with batched insert_many calls
+    (see documents.py).
+
+    checkpoint=True saves a checkpoint to CHECKPOINT_PATH every few tens of MB of input. After a
+    failure, resume=True truncates the csv files to the last checkpoint and continues from there
+    (see checkpoints.py).
+
+    file_in may be a .osm.bz2, .osm.gz or .zip file, which is decompressed as it is read (see
+    compressed.py), or a .osm.pbf file (see pbf.py). Chunking and checkpoints need byte offsets
+    into the XML, so for compressed files workers > 1 decompresses multi-stream bz2 in parallel
+    instead of shaping in parallel. A PBF file is chunked on whole blobs of about chunk_size
+    bytes, which the workers decode and shape. Checkpoint / resume are not available for either.
+
+    compress_output=True writes the csv files gzip compressed, as nodes.csv.gz etc.
+
+    parser picks the XML parser backend: 'iterparse' (cElementTree) or 'expat', which shapes the
+    rows in the parser's tag callbacks instead of building element trees (see parsers.py and
+    expat_shaped_elements), a few percent faster. With metrics, shape_cache or pipelined, which
+    need the parsed elements, expat builds them and they are shaped with shape_element, which is
+    slower than iterparse. The output is the same with either.
+
+    metrics='metrics.json' times the parse / shape / validate / write stages, counts elements,
+    tags, way nodes and cross reference hits and misses, prints progress with an ETA every few
+    seconds and writes the totals to that file as JSON (see instrumentation.py).
+
+    normalize='deferred' writes the street and city values uncleaned and cleans the nodes_tags /
+    ways_tags values afterwards, each distinct value once (csv and sqlite targets, see
+    tagvalues.py). The output is the same as with the default normalize='inline'. With metrics,
+    the cross reference counts are then per distinct value and the time taken is the 'normalize'
+    stage.
+
+    way_geometry=True then builds a node coordinate store in GEOMETRY_DIR from nodes.csv and
+    ways_nodes.csv, resolves every way's nodes into coordinates and writes each way's node count,
+    length and bounding box to WAYS_GEOMETRY_PATH (csv target, see geometry.py).
+
+    spatial_index=True (which implies way_geometry) also builds a grid index of the nodes and ways
+    in GEOMETRY_DIR for bounding box queries and extracts (see spatialindex.py).
+
+    pipelined=True parses, shapes and writes on separate threads joined by queues of at most
+    queue_batches batches of elements, so that reading, decompressing and writing overlap with
+    the shaping, and prints how busy each stage was (see pipeline.py). With metrics the stage
+    times then overlap, and the stage utilization is added as 'pipeline'. The output is the same.
+
+    shape_cache='shape_cache.db' keeps the shaped rows of every element in that SQLite file (as csv
+    text for csv output, which a hit writes out as it is), and takes them from it on later runs
+    for the elements whose version and street / city mappings haven't changed; the least
+    recently used entries are evicted past shape_cache_bytes (see shapecache.py). The hit rate is
+    printed, and added as 'shape_cache' with metrics, whose cross reference counts then only cover
+    the elements shaped. Not available with normalize='deferred'. The output is the same.
+    """
+    if normalize not in NORMALIZE_MODES:
+        raise ValueError("Unknown normalize mode '{0}'".format(normalize))
+    if normalize == 'deferred' and target not in ('csv', 'sqlite'):
+        raise ValueError("normalize='deferred' is only supported for csv and sqlite output")
+    if shape_cache is not None and normalize != 'inline':
+        raise ValueError("shape_cache is only supported with normalize='inline'")
+    if delta_encode and target != 'parquet':
+        raise ValueError("delta_encode is only supported for parquet output")
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be positive")
+    way_geometry = way_geometry or spatial_index
+    if way_geometry and target != 'csv':
+        raise ValueError("way_geometry and spatial_index are only supported for csv output")
+
+    global Compiled_Cross_Reference
+    cross_reference = compiled_cross_reference()
+    cleaning = cross_reference
+    run_metrics = None
+    if metrics is not None:
+        cleaning = instrumentation.CountingCrossReference(cross_reference)
+        run_metrics = instrumentation.for_input(file_in)
+    pipe = pipeline.Pipeline(queue_batches) if pipelined else None
+    Compiled_Cross_Reference = cleaning if normalize == 'inline' else crossref.RawValues()
+    cache = None
+    if shape_cache is not None:
+        # Record the mappings each element is shaped with, to store along with its rows
+        Compiled_Cross_Reference = shapecache.RecordingCrossReference(cleaning)
+        cache = shapecache.ShapeCache(shape_cache, cross_reference, shape_cache_bytes,
+                                      'csv' if target == 'csv' else 'rows')
+    try:
+        result = run_process_map(file_in, validate, workers, buffer_rows, target, collection,
+                                 checkpoint, resume, compress_output, parser, run_metrics, pipe,
+                                 cache, row_group_rows, delta_encode, chunk_size)
+    finally:
+        Compiled_Cross_Reference = cross_reference
+        if cache is not None:
+            cache_stats = cache.close()
+    if pipe is not None:
+        print pipe.report()
+        if run_metrics is not None:
+            run_metrics.pipeline = pipe.summary()
+    if cache is not None:
+        print "Shape cache: {0} hits ({1:.1%}), {2} misses ({3} stale), {4} stored, {5} " \
+              "evicted".format(cache_stats['hits'], cache_stats['hit_rate'],
+                               cache_stats['misses'], cache_stats['stale'],
+                               cache_stats['stored'], cache_stats['evicted'])
+        if run_metrics is not None:
+            run_metrics.shape_cache = cache_stats
+
+    if normalize == 'deferred':
+        stats = tagvalues.normalize_outputs(target, cleaning, (NODE_TAGS_PATH, WAY_TAGS_PATH),
+                                            DB_PATH, ('nodes_tags', 'ways_tags'), compress_output)
+        print "Normalized {0} street and city values ({1} distinct) in {2:.1f}s".format(
+            stats['values'], stats['distinct_values'], stats['seconds'])
+        if run_metrics is not None:
+            run_metrics.stages['normalize'] = stats['seconds']
+
+    if way_geometry:
+        start = time.time()
+        stats = geometry.build_geometry(NODES_PATH, WAY_NODES_PATH, GEOMETRY_DIR, WAYS_GEOMETRY_PATH,
+                                        compress_output)
+        seconds = time.time() - start
+        print "Resolved {0} ways over {1} nodes ({2} with missing nodes) in {3:.1f}s".format(
+            stats['ways'], stats['nodes'], stats['incomplete_ways'], seconds)
+        if run_metrics is not None:
+            run_metrics.stages['geometry'] = seconds
+
+    if spatial_index:
+        start = time.time()
+        index = spatialindex.GridIndex.build(GEOMETRY_DIR)
+        seconds = time.time() - start
+        print "Indexed {0} nodes and {1} ways in {2:.1f}s".format(len(index.node_store),
+                                                                len(index.way_store), seconds)
+        if run_metrics is not None:
+            run_metrics.stages['spatial_index'] = seconds
+
+    if run_metrics is None:
+        return result
+    run_metrics.add_counts(cleaning.counts)
+    run_metrics.progress(run_metrics.input_size, force=True)
+    summary = run_metrics.dump(metrics)
+    print "Stage seconds: " + ", ".join("{0} {1:.1f}".format(stage, seconds)
+                                        for stage, seconds in stage_seconds(summary['stages']))
+    return result
 
 
 if __name__ == '__main__':
-#     # Note: Validation is ~ 10X slower. For the project consider using a small
-#     # sample of the map when validating.
+#     # Note: Validation uses the compiled validator in fastvalidator.py and only adds a
+#     # small fraction to the shaping time, so it can stay on for the full map.
 #     #Build cross references for cleaning.
     
     Cross_Reference_Cities=createCityCR()
@@ -598,6 +1456,7 @@ if __name__ == '__main__':
     if str.upper(AddtoCR)=="Y":
         Cross_Reference=addmappings(audit(OSM_PATH,Cross_Reference),Cross_Reference)
         Cross_Reference_Cities= buildcitiescrossreference(citieslist(OSM_PATH))
+    compileCR(Cross_Reference,Cross_Reference_Cities)
 #    showdictionaryvalues(OSM_PATH)    
 #     #Run full data/file processing subroutine.
-    process_map(OSM_PATH, validate=False)
+    process_map(OSM_PATH, validate=True)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Document output for process_map, for loading into MongoDB.
+
+shape_element produces flat table rows; a document keeps everything about one node or way
+together:
+
+{'id': 209809850,
+ 'type': 'way',
+ 'user': 'chicago-buildings',
+ 'uid': 674454,
+ 'version': '1',
+ 'changeset': 15353317,
+ 'timestamp': '2013-03-13T15:58:04Z',
+ 'tags': {'regular': {'building': 'yes'},
+          'street': {'addr': 'WEST LEXINGTON STREET'}},
+ 'node_refs': [2199822281, 2199822390, 2199822392]}
+
+Nodes carry 'lat' and 'lon' instead of 'node_refs'.  Numeric attributes are coerced with the
+coerce functions from the schema, tags are grouped by their "type" and node_refs are in position
+order.  Documents are written as newline delimited JSON (DocumentWriter) and/or handed to
+anything with a pymongo style insert_many (InsertManySink), in large batches either way.
+"""
+
+import json
+
+BATCH_SIZE = 5000  # Documents per write / insert_many call
+
+
+#Coerce function for each attribute of a dict schema (identity for fields without one).
+def attribute_coercers(field_schema):
+    return [(field, rules.get('coerce')) for field, rules in field_schema.items()]
+
+
+class DocumentShaper(object):
+    """Turn shaped elements into nested documents"""
+
+    def __init__(self, schema):
+        self.node_attributes = attribute_coercers(schema['node']['schema'])
+        self.way_attributes = attribute_coercers(schema['way']['schema'])
+        self.way_node_id = schema['way_nodes']['schema']['schema']['node_id'].get('coerce', int)
+
+    def shape_document(self, el):
+        if el.tag == 'node':
+            attributes, coercers, doc_type = el.node, self.node_attributes, 'node'
+            tags = el.node_tags
+        else:
+            attributes, coercers, doc_type = el.way, self.way_attributes, 'way'
+            tags = el.way_tags
+
+        doc = {'type': doc_type}
+        for field, coerce in coercers:
+            value = getattr(attributes, field)
+            doc[field] = coerce(value) if coerce is not None else value
+
+        grouped = {}
+        for tag in tags:
+            grouped.setdefault(tag.type, {})[tag.key] = tag.value
+        doc['tags'] = grouped
+
+        if doc_type == 'way':
+            way_nodes = sorted(el.way_nodes, key=lambda way_node: way_node.position)
+            doc['node_refs'] = [self.way_node_id(way_node.node_id) for way_node in way_nodes]
+        return doc
+
+
+class DocumentWriter(object):
+    """Newline delimited JSON, batch_size documents per write"""
+
+    def __init__(self, f, batch_size=BATCH_SIZE):
+        self.file = f
+        self.batch_size = batch_size
+        self.buffer = []
+        self.documents_written = 0
+
+    def write(self, doc):
+        self.buffer.append(json.dumps(doc, separators=(',', ':'), sort_keys=True))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.buffer.append('')
+            self.file.write('\n'.join(self.buffer))
+            self.documents_written += len(self.buffer) - 1
+            del self.buffer[:]
+
+
+class InsertManySink(object):
+    """Batched collection.insert_many(documents, ordered=False) calls"""
+
+    def __init__(self, collection, batch_size=BATCH_SIZE):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.buffer = []
+        self.documents_written = 0
+
+    def write(self, doc):
+        self.buffer.append(doc)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.collection.insert_many(self.buffer, ordered=False)
+            self.documents_written += len(self.buffer)
+            self.buffer = []
+
+
+class MemoryCollection(object):
+    """In-memory stand-in for a pymongo collection, for trying InsertManySink without a server"""
+
+    def __init__(self):
+        self.documents = []
+        self.insert_calls = 0
+
+    def insert_many(self, documents, ordered=True):
+        self.documents.extend(documents)
+        self.insert_calls += 1
+
+    def find(self, query=None):
+        query = query or {}
+        return [doc for doc in self.documents
+                if all(doc.get(field) == value for field, value in query.items())]
+
+    def count(self, query=None):
+        return len(self.find(query))
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Random access to the nodes and ways of an OSM XML file by id.
+
+Looking at one element (an id an audit flagged, or what showdictionaryvalues prints for it) would
+otherwise mean parsing the file up to it.  build_index makes one pass over the raw bytes, finding
+the top level element starts the way osmchunks.py does without parsing anything, and saves for
+each of node and way three arrays sorted by id:
+
+    node_ids.bin      int64   element id
+    node_offsets.bin  int64   byte offset of the element's start tag
+    node_lengths.bin  uint32  bytes up to the next top level element (or the closing </osm>)
+
+20 bytes an element, with element_index.json recording the size and modification time of the
+file they were built from.  ElementIndex memory-maps the arrays and the OSM file itself, so a
+lookup is a searchsorted on the ids and one element's bytes given to the parser:
+
+    build_index('las-vegas_nevada.osm', 'element_index')
+    index = ElementIndex.open('las-vegas_nevada.osm', 'element_index')
+    data.shape_element(index.element('way', 12345678))
+    for element in index.id_range('node', 1000, 2000):
+        ...
+
+Only uncompressed XML can be indexed: the offsets are into the file as it is on disk.
+"""
+
+import io
+import mmap
+import os
+import re
+import xml.etree.cElementTree as ET
+
+import numpy as np
+
+import compressed
+import geometry
+import osmchunks
+import parsers
+import pbf
+
+INDEXED_TYPES = ('node', 'way')
+CHUNK_ELEMENTS = 1000000  # Element starts collected in lists before they go into the arrays
+RUN_BYTES = 4 * 1024 * 1024  # Most bytes of adjacent elements parsed in one go by elements()
+
+# A top level element start (as osmchunks.ELEMENT_START_RE) and the id in its start tag, if any
+ELEMENT_ID_RE = re.compile(br'<(node|way|relation)(?=[\s/>])(?:[^>]*?\sid=["\'](-?\d+)["\'])?')
+
+TYPE_CODES = {b'node': 0, b'way': 1, b'relation': 2}
+
+FILES = ('ids', 'offsets', 'lengths')
+DTYPES = (np.int64, np.int64, np.uint32)
+
+
+def file_stamp(file_in):
+    stat = os.stat(file_in)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def array_path(directory, element_type, name):
+    return os.path.join(directory, '{0}_{1}.bin'.format(element_type, name))
+
+
+#True if directory has an index built from file_in as it is now.
+def is_current(file_in, directory):
+    if not os.path.exists(os.path.join(directory, 'element_index.json')):
+        return False
+    meta = geometry.load_meta(directory, 'element_index')
+    stamp = file_stamp(file_in)
+    return meta['size'] == stamp['size'] and meta['mtime'] == stamp['mtime']
+
+
+#(type codes, ids, offsets) of the top level elements of data (a string or mmap), in file order,
+#CHUNK_ELEMENTS at a time. Elements without an id get -1.
+def element_starts(data, start, end, chunk_elements=CHUNK_ELEMENTS):
+    types, ids, offsets = [], [], []
+    for m in ELEMENT_ID_RE.finditer(data, start, end):
+        element_type, element_id = m.groups()
+        types.append(TYPE_CODES[element_type])
+        ids.append(int(element_id) if element_id is not None else -1)
+        offsets.append(m.start())
+        if len(offsets) == chunk_elements:
+            yield (np.array(types, dtype=np.int8), np.array(ids, dtype=np.int64),
+                   np.array(offsets, dtype=np.int64))
+            types, ids, offsets = [], [], []
+    if offsets:
+        yield (np.array(types, dtype=np.int8), np.array(ids, dtype=np.int64),
+               np.array(offsets, dtype=np.int64))
+
+
+def build_index(file_in, directory, chunk_elements=CHUNK_ELEMENTS):
+    """Index the nodes and ways of file_in into directory; returns the number of each
+
+    The element starts are written out in file order as they are found, so only chunk_elements
+    of them are in memory during the pass; the arrays of one type are then sorted by id.
+    """
+    if compressed.is_compressed(file_in) or pbf.is_pbf(file_in):
+        raise ValueError("Only an uncompressed OSM XML file can be indexed")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    stamp = file_stamp(file_in)
+    scan_paths = [os.path.join(directory, 'scan_{0}.bin'.format(name))
+                  for name in ('types', 'ids', 'offsets')]
+    scan_dtypes = (np.int8, np.int64, np.int64)
+    with open(file_in, 'rb') as osm_file:
+        end = osmchunks.document_end_offset(osm_file, stamp['size']) if stamp['size'] else 0
+        files = [open(path, 'wb') for path in scan_paths]
+        try:
+            if end:
+                data = mmap.mmap(osm_file.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for chunk in element_starts(data, 0, end, chunk_elements):
+                        for f, values, dtype in zip(files, chunk, scan_dtypes):
+                            geometry.append_array(f, values, dtype)
+                finally:
+                    data.close()
+        finally:
+            for f in files:
+                f.close()
+
+    types, ids, offsets = [geometry.load_array(path, dtype, False)
+                           for path, dtype in zip(scan_paths, scan_dtypes)]
+    # Each element runs up to the start of the next one
+    lengths = np.diff(np.append(offsets, end))
+    counts = {}
+    for element_type in INDEXED_TYPES:
+        selected = (types == TYPE_CODES[element_type]) & (ids >= 0)
+        columns = [ids[selected], offsets[selected], lengths[selected]]
+        if len(columns[0]) > 1 and (np.diff(columns[0]) <= 0).any():
+            order = np.argsort(columns[0], kind='mergesort')
+            columns = [values[order] for values in columns]
+        for name, values, dtype in zip(FILES, columns, DTYPES):
+            np.ascontiguousarray(values, dtype=dtype).tofile(
+                array_path(directory, element_type, name))
+        counts[element_type + 's'] = len(columns[0])
+    for path in scan_paths:
+        os.remove(path)
+    meta = dict(stamp, file=os.path.abspath(file_in), **counts)
+    geometry.save_meta(directory, 'element_index', meta)
+    return counts
+
+
+class ElementIndex(object):
+    """Nodes and ways of a memory-mapped OSM file found by id through the build_index arrays"""
+
+    def __init__(self, file_in, arrays, parser=parsers.DEFAULT_PARSER):
+        self.file_in = file_in
+        self.arrays = arrays  # element type -> (ids, offsets, lengths)
+        self.parser = parser
+        self.osm_file = open(file_in, 'rb')
+        self.data = b''
+        if os.path.getsize(file_in):
+            self.data = mmap.mmap(self.osm_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def open(cls, file_in, directory, parser=parsers.DEFAULT_PARSER, mmap=True):
+        """The index of file_in saved in directory, memory-mapped unless mmap is False
+
+        parser is the parsers.py backend elements() parses runs of adjacent elements with.
+        """
+        if not is_current(file_in, directory):
+            raise ValueError("{0} has no index of {1} as it is now; run build_index".format(
+                directory, file_in))
+        arrays = {}
+        for element_type in INDEXED_TYPES:
+            arrays[element_type] = tuple(
+                geometry.load_array(array_path(directory, element_type, name), dtype, mmap)
+                for name, dtype in zip(FILES, DTYPES))
+        return cls(file_in, arrays, parser)
+
+    def __len__(self):
+        return sum(len(ids) for ids, _, _ in self.arrays.values())
+
+    def ids(self, element_type):
+        return self.arrays[element_type][0]
+
+    def positions(self, element_type, element_ids):
+        """(positions in the arrays, found) for an array of ids"""
+        ids = self.arrays[element_type][0]
+        element_ids = np.asarray(element_ids, dtype=np.int64)
+        if not len(ids):
+            return np.zeros(len(element_ids), dtype=np.int64), np.zeros(len(element_ids), bool)
+        positions = np.minimum(np.searchsorted(ids, element_ids), len(ids) - 1)
+        return positions, np.asarray(ids[positions] == element_ids)
+
+    def raw(self, element_type, element_id):
+        """The bytes of one element, from its start tag to the next element"""
+        ids, offsets, lengths = self.arrays[element_type]
+        i = np.searchsorted(ids, element_id)
+        if i == len(ids) or ids[i] != element_id:
+            raise KeyError((element_type, element_id))
+        offset = int(offsets[i])
+        return self.data[offset:offset + int(lengths[i])]
+
+    def element(self, element_type, element_id):
+        """One node or way as an Element, for shape_element; KeyError if it isn't in the file"""
+        return ET.fromstring(self.raw(element_type, element_id))
+
+    def elements(self, element_type, element_ids):
+        """The elements of the ids found (missing ids are skipped), in file order
+
+        Elements next to each other in the file are parsed together, up to RUN_BYTES at a time,
+        so a range of ids from a sorted file costs about what streaming that part of it does.
+        """
+        ids, offsets, lengths = self.arrays[element_type]
+        positions, found = self.positions(element_type, element_ids)
+        positions = np.unique(positions[found])
+        starts = np.asarray(offsets[positions])
+        ends = starts + np.asarray(lengths[positions])
+        # A run breaks where an element doesn't start where the one before ended
+        breaks = np.flatnonzero(starts[1:] != ends[:-1]) + 1
+        for run_starts, run_ends in zip(np.split(starts, breaks), np.split(ends, breaks)):
+            first = 0
+            while first < len(run_starts):
+                last = first + np.searchsorted(run_ends[first:], run_starts[first] + RUN_BYTES)
+                last = min(max(last, first + 1), len(run_starts))
+                span = self.data[int(run_starts[first]):int(run_ends[last - 1])]
+                if last - first == 1:
+                    yield ET.fromstring(span)
+                else:
+                    source = io.BytesIO(b'<osm>' + span + osmchunks.DOCUMENT_END)
+                    for element in parsers.iter_elements(source, (element_type,), self.parser):
+                        yield element
+                first = last
+
+    def id_range(self, element_type, first_id, last_id):
+        """The elements with ids from first_id to last_id inclusive, in file order"""
+        ids = self.arrays[element_type][0]
+        start = np.searchsorted(ids, first_id, side='left')
+        end = np.searchsorted(ids, last_id, side='right')
+        return self.elements(element_type, ids[start:end])
+
+    def close(self):
+        if not isinstance(self.data, bytes):
+            self.data.close()
+        self.osm_file.close()
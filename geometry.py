@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Node coordinate store and way geometry for process_map.
+
+nodes.csv has the coordinates and ways_nodes.csv the ordered node ids of every way, but a dict of
+node id -> (lat, lon) takes well over 100 bytes a node.  A NodeStore keeps the node ids in a sorted
+int64 array with parallel lat / lon arrays (float64, or float32 at about a metre of precision),
+24 or 16 bytes a node, saved as flat binary files that are memory-mapped when opened, so a region
+bigger than memory can still be looked up.  Node ids of a whole batch are found with one
+numpy.searchsorted call.
+
+build_geometry reads the csv files back in chunks (after process_map has written them, however it
+wrote them) to build the store, then resolves every way's nodes into coordinates in the same
+chunks and writes, per way,
+
+    ways_geometry.csv  id, nodes, missing_nodes, length_m, min_lat, min_lon, max_lat, max_lon
+
+and the coordinate sequences themselves to a WayStore:
+
+    store = WayStore.open('geometry')
+    lats, lons = store.coordinates(12345678)
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import compressed
+
+CHUNK_ROWS = 1000000  # csv rows read at a time
+EARTH_RADIUS_M = 6371008.8  # Mean earth radius, metres
+
+GEOMETRY_FIELDS = ['id', 'nodes', 'missing_nodes', 'length_m', 'min_lat', 'min_lon', 'max_lat',
+                   'max_lon']
+
+
+def read_chunks(path, columns, dtypes, compress=False, chunk_rows=CHUNK_ROWS):
+    """Chunks of a csv file written by process_map (path + '.gz' if compress) as DataFrames"""
+    return pd.read_csv(path + '.gz' if compress else path, usecols=columns, dtype=dtypes,
+                       compression='gzip' if compress else None, float_precision='round_trip',
+                       chunksize=chunk_rows)
+
+
+def append_array(f, values, dtype):
+    np.ascontiguousarray(values, dtype=dtype).tofile(f)
+
+
+def load_array(path, dtype, mmap):
+    if not os.path.getsize(path):
+        return np.zeros(0, dtype=dtype)
+    if mmap:
+        return np.memmap(path, dtype=dtype, mode='r')
+    return np.fromfile(path, dtype=dtype)
+
+
+def save_meta(directory, name, meta):
+    with open(os.path.join(directory, name + '.json'), 'wb') as f:
+        json.dump(meta, f, indent=1, sort_keys=True)
+
+
+def load_meta(directory, name):
+    with open(os.path.join(directory, name + '.json'), 'rb') as f:
+        return json.load(f)
+
+
+# ================================================== #
+#               Node Coordinates                     #
+# ================================================== #
+class NodeStore(object):
+    """Sorted node ids with parallel latitude and longitude arrays"""
+
+    FILES = ('node_ids', 'node_lat', 'node_lon')
+
+    def __init__(self, ids, lats, lons):
+        self.ids = ids
+        self.lats = lats
+        self.lons = lons
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, directory, chunks, coordinate_dtype='float64'):
+        """Save (ids, lats, lons) array chunks to directory and open the result
+
+        The chunks are written out as they come, so only one is in memory at a time.  Nodes in an
+        OSM file are sorted by id; if they were not, the arrays are sorted in memory at the end.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        paths = [os.path.join(directory, name + '.bin') for name in cls.FILES]
+        dtypes = (np.int64, coordinate_dtype, coordinate_dtype)
+        ordered = True
+        last_id = None
+        count = 0
+        files = [open(path, 'wb') for path in paths]
+        try:
+            for ids, lats, lons in chunks:
+                if len(ids) == 0:
+                    continue
+                if (last_id is not None and ids[0] <= last_id) or (np.diff(ids) <= 0).any():
+                    ordered = False
+                last_id = ids[-1]
+                count += len(ids)
+                for f, values, dtype in zip(files, (ids, lats, lons), dtypes):
+                    append_array(f, values, dtype)
+        finally:
+            for f in files:
+                f.close()
+
+        if not ordered:
+            ids, lats, lons = [load_array(path, dtype, False) for path, dtype in zip(paths, dtypes)]
+            order = np.argsort(ids, kind='mergesort')
+            for path, values in zip(paths, (ids[order], lats[order], lons[order])):
+                values.tofile(path)
+        save_meta(directory, 'node_store', {'nodes': count, 'coordinate_dtype': coordinate_dtype})
+        return cls.open(directory)
+
+    @classmethod
+    def open(cls, directory, mmap=True):
+        """The store saved in directory, memory-mapped unless mmap is False"""
+        meta = load_meta(directory, 'node_store')
+        dtypes = (np.int64, meta['coordinate_dtype'], meta['coordinate_dtype'])
+        return cls(*[load_array(os.path.join(directory, name + '.bin'), dtype, mmap)
+                     for name, dtype in zip(cls.FILES, dtypes)])
+
+    def lookup(self, node_ids):
+        """(lats, lons, found) for an array of node ids; missing nodes get NaN coordinates"""
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        if not len(self.ids):
+            return (np.full(len(node_ids), np.nan), np.full(len(node_ids), np.nan),
+                    np.zeros(len(node_ids), dtype=bool))
+        positions = np.minimum(np.searchsorted(self.ids, node_ids), len(self.ids) - 1)
+        found = np.asarray(self.ids[positions] == node_ids)
+        lats = np.where(found, self.lats[positions], np.nan)
+        lons = np.where(found, self.lons[positions], np.nan)
+        return lats, lons, found
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great circle distances in metres between arrays of points in degrees"""
+    lat1, lon1, lat2, lon2 = [np.radians(values) for values in (lat1, lon1, lat2, lon2)]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+# ================================================== #
+#               Way Geometry                         #
+# ================================================== #
+class WayStore(object):
+    """Coordinate sequences of the ways: way ids, offsets into the coordinate arrays and the
+    coordinates of every way node in order"""
+
+    FILES = ('way_ids', 'way_offsets', 'way_lat', 'way_lon')
+
+    def __init__(self, ids, offsets, lats, lons):
+        self.ids = ids
+        self.offsets = offsets
+        self.lats = lats
+        self.lons = lons
+        # Ways are written in file order, which is normally by id
+        self.order = None
+        self.sorted_ids = ids
+        if len(ids) > 1 and (np.diff(ids) < 0).any():
+            self.order = np.argsort(ids, kind='mergesort')
+            self.sorted_ids = ids[self.order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def open(cls, directory, mmap=True):
+        meta = load_meta(directory, 'way_store')
+        dtypes = (np.int64, np.int64, meta['coordinate_dtype'], meta['coordinate_dtype'])
+        return cls(*[load_array(os.path.join(directory, name + '.bin'), dtype, mmap)
+                     for name, dtype in zip(cls.FILES, dtypes)])
+
+    def index(self, way_id):
+        ids = self.sorted_ids
+        i = np.searchsorted(ids, way_id)
+        if i == len(ids) or ids[i] != way_id:
+            raise KeyError(way_id)
+        return i if self.order is None else self.order[i]
+
+    def coordinates(self, way_id):
+        """(lats, lons) of the way's nodes in order, NaN where a node is missing"""
+        i = self.index(way_id)
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return np.asarray(self.lats[start:end]), np.asarray(self.lons[start:end])
+
+
+class WayGeometryWriter(object):
+    """Resolves chunks of ways_nodes rows and writes the WayStore files and ways_geometry.csv"""
+
+    def __init__(self, node_store, directory, geometry_file, coordinate_dtype='float64'):
+        self.node_store = node_store
+        self.directory = directory
+        self.coordinate_dtype = coordinate_dtype
+        self.geometry_file = geometry_file
+        self.files = [open(os.path.join(directory, name + '.bin'), 'wb')
+                      for name in WayStore.FILES]
+        self.offset = 0
+        self.ways = 0
+        self.incomplete_ways = 0
+        append_array(self.files[1], [0], np.int64)
+        geometry_file.write(','.join(GEOMETRY_FIELDS) + '\r\n')
+
+    def write(self, way_ids, node_ids):
+        """Resolve rows of ways_nodes (way id, node id), every way's rows complete and in order"""
+        if len(way_ids) == 0:
+            return
+        lats, lons, found = self.node_store.lookup(node_ids)
+        starts = np.flatnonzero(np.r_[True, way_ids[1:] != way_ids[:-1]])
+        counts = np.diff(np.r_[starts, len(way_ids)])
+
+        # Segment i runs from way node i - 1 to way node i, when both are in the same way
+        segments = np.zeros(len(way_ids))
+        if len(way_ids) > 1:
+            lengths = haversine(lats[:-1], lons[:-1], lats[1:], lons[1:])
+            same_way = way_ids[1:] == way_ids[:-1]
+            segments[1:] = np.where(same_way & ~np.isnan(lengths), lengths, 0.0)
+
+        missing = counts - np.add.reduceat(found.astype(np.int64), starts)
+        frame = pd.DataFrame({
+            'id': way_ids[starts],
+            'nodes': counts,
+            'missing_nodes': missing,
+            'length_m': np.round(np.add.reduceat(segments, starts), 2),
+            'min_lat': np.round(np.fmin.reduceat(lats, starts), 7),
+            'min_lon': np.round(np.fmin.reduceat(lons, starts), 7),
+            'max_lat': np.round(np.fmax.reduceat(lats, starts), 7),
+            'max_lon': np.round(np.fmax.reduceat(lons, starts), 7),
+        }, columns=GEOMETRY_FIELDS)
+        frame.to_csv(self.geometry_file, index=False, header=False, line_terminator='\r\n')
+
+        ids_file, offsets_file, lat_file, lon_file = self.files
+        append_array(ids_file, way_ids[starts], np.int64)
+        append_array(offsets_file, self.offset + np.cumsum(counts), np.int64)
+        append_array(lat_file, lats, self.coordinate_dtype)
+        append_array(lon_file, lons, self.coordinate_dtype)
+        self.offset += len(way_ids)
+        self.ways += len(starts)
+        self.incomplete_ways += int((missing > 0).sum())
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        save_meta(self.directory, 'way_store', {'ways': self.ways, 'way_nodes': self.offset,
+                                                'coordinate_dtype': self.coordinate_dtype})
+
+
+#(way ids, node ids) chunks of ways_nodes rows, holding back the last way of each chunk until the
+#next one so that no way is split between chunks.
+def complete_ways(chunks):
+    held_ways = np.zeros(0, dtype=np.int64)
+    held_nodes = np.zeros(0, dtype=np.int64)
+    for frame in chunks:
+        way_ids = np.r_[held_ways, frame['id'].values]
+        node_ids = np.r_[held_nodes, frame['node_id'].values]
+        if len(way_ids) == 0:
+            continue
+        last_start = np.flatnonzero(way_ids != way_ids[-1])
+        split = last_start[-1] + 1 if len(last_start) else 0
+        held_ways, held_nodes = way_ids[split:], node_ids[split:]
+        yield way_ids[:split], node_ids[:split]
+    yield held_ways, held_nodes
+
+
+def build_geometry(nodes_path, way_nodes_path, directory, geometry_path, compress=False,
+                   coordinate_dtype='float64', chunk_rows=CHUNK_ROWS):
+    """Build the NodeStore and WayStore in directory and write geometry_path from the nodes and
+    ways_nodes csv files. Returns the number of nodes and ways and the ways with missing nodes."""
+    node_chunks = ((frame['id'].values, frame['lat'].values, frame['lon'].values)
+                   for frame in read_chunks(nodes_path, ['id', 'lat', 'lon'],
+                                            {'id': np.int64, 'lat': np.float64,
+                                             'lon': np.float64}, compress, chunk_rows))
+    node_store = NodeStore.build(directory, node_chunks, coordinate_dtype)
+
+    way_chunks = read_chunks(way_nodes_path, ['id', 'node_id'],
+                             {'id': np.int64, 'node_id': np.int64}, compress, chunk_rows)
+    with compressed.open_output(geometry_path, 'wb', compress) as geometry_file:
+        writer = WayGeometryWriter(node_store, directory, geometry_file, coordinate_dtype)
+        try:
+            for way_ids, node_ids in complete_ways(way_chunks):
+                writer.write(way_ids, node_ids)
+        finally:
+            writer.close()
+    return {'nodes': len(node_store), 'ways': writer.ways,
+            'incomplete_ways': writer.incomplete_ways}
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Opt-in instrumentation for process_map.
+
+With process_map(..., metrics='metrics.json') every element is timed through four stages:
+
+    parse     getting the next element from the parser (including reading / decompressing)
+    shape     shape_element, including the cross reference lookups
+    validate  the schema check
+    write     handing the rows to the writers and flushing them
+
+along with counts of elements, tags and way nodes and of cross reference hits and misses.  A
+progress line with elements/sec and an ETA (from the byte position in the input) is printed
+every PROGRESS_SECONDS, and the totals are written as JSON at the end:
+
+{'elapsed_seconds': 81.2,
+ 'elements': {'node': 1500000, 'way': 250000},
+ 'tags': 912000,
+ 'way_nodes': 2100000,
+ 'stages': {'parse': 30.1, 'shape': 38.5, 'validate': 4.9, 'write': 6.7},
+ 'elements_per_sec': 21551.7,
+ 'cross_reference': {'street_hits': 40125, 'street_misses': 1250,
+                     'city_hits': 3100, 'city_misses': 21000},
+ ...}
+
+With workers > 1 each worker instruments its own chunks and the totals are merged, so the stage
+times are summed over the workers.
+"""
+
+import json
+import os
+import time
+
+import crossref
+
+PROGRESS_SECONDS = 10.0  # Seconds between progress lines
+
+STAGES = ('parse', 'shape', 'validate', 'write')
+CROSS_REFERENCE_COUNTS = ('street_hits', 'street_misses', 'city_hits', 'city_misses')
+
+
+class CountingCrossReference(crossref.CrossReference):
+    """A CrossReference (sharing the tables of another one) that counts its hits and misses"""
+
+    def __init__(self, cross_reference):
+        self.common_names = cross_reference.common_names
+        self.usps_names = cross_reference.usps_names
+        self.street_values = cross_reference.street_values
+        self.city_names = cross_reference.city_names
+        self.counts = dict.fromkeys(CROSS_REFERENCE_COUNTS, 0)
+
+    def update_name(self, name):
+        m = crossref.street_type_re.search(name)
+        street_type = m.group().upper() if m else None
+        if street_type in self.common_names or street_type in self.usps_names:
+            self.counts['street_hits'] += 1
+        else:
+            self.counts['street_misses'] += 1
+        return crossref.CrossReference.update_name(self, name)
+
+    def update_city_name(self, name):
+        if name in self.city_names:
+            self.counts['city_hits'] += 1
+        else:
+            self.counts['city_misses'] += 1
+        return crossref.CrossReference.update_city_name(self, name)
+
+
+#Callable giving the current byte position of an input file object, None if it has none.
+def position_reader(source):
+    for holder in (getattr(source, 'osm_file', None), getattr(source, 'file', None), source):
+        if holder is not None and hasattr(holder, 'tell'):
+            return holder.tell
+    return None
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+
+
+class Metrics(object):
+    """Stage timings, counts and progress reporting for one process_map run"""
+
+    def __init__(self, input_size=None, start_position=0, progress_seconds=PROGRESS_SECONDS,
+                 report=True):
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.elements = {'node': 0, 'way': 0}
+        self.tags = 0
+        self.way_nodes = 0
+        self.cross_reference = dict.fromkeys(CROSS_REFERENCE_COUNTS, 0)
+        self.pipeline = None  # pipeline.Pipeline.summary() of a pipelined run
+        self.shape_cache = None  # shapecache.ShapeCache.summary() of a run with a shape cache
+        self.input_size = input_size
+        self.start_position = start_position
+        self.position = start_position
+        self.position_reader = None  # Set while reading a file whose position can be asked for
+        self.progress_seconds = progress_seconds
+        self.report = report
+        self.start = time.time()
+        self.next_report = self.start + progress_seconds
+
+    def count(self, element_tag, el):
+        self.elements[element_tag] += 1
+        counts = el.row_counts()
+        if element_tag == 'node':
+            self.tags += counts[1]
+        else:
+            self.way_nodes += counts[1]
+            self.tags += counts[2]
+
+    def total_elements(self):
+        return sum(self.elements.values())
+
+    def progress(self, position=None, force=False):
+        """Record the input byte position and print a progress line if one is due"""
+        if position is not None:
+            self.position = position
+        now = time.time()
+        if not self.report or (now < self.next_report and not force):
+            return
+        if position is None and self.position_reader is not None:
+            self.position = self.position_reader()
+        self.next_report = now + self.progress_seconds
+        elapsed = now - self.start
+        elements = self.total_elements()
+        line = "{0} elements, {1:.0f} elements/sec".format(elements,
+                                                           elements / elapsed if elapsed else 0)
+        if self.input_size:
+            done = self.position - self.start_position
+            line = "{0:5.1f}% ".format(100.0 * self.position / self.input_size) + line
+            if done > 0:
+                remaining = (self.input_size - self.position) * elapsed / done
+                line += ", ETA {0}".format(format_duration(remaining))
+        print line
+
+    def add_counts(self, counts):
+        for name, value in counts.items():
+            self.cross_reference[name] += value
+
+    def merge(self, summary):
+        """Add the totals of another run's summary() (a worker's)"""
+        for stage, seconds in summary['stages'].items():
+            self.stages[stage] += seconds
+        for element_tag, count in summary['elements'].items():
+            self.elements[element_tag] += count
+        self.tags += summary['tags']
+        self.way_nodes += summary['way_nodes']
+        self.add_counts(summary['cross_reference'])
+
+    def summary(self):
+        elapsed = time.time() - self.start
+        elements = self.total_elements()
+        return {
+            'elapsed_seconds': elapsed,
+            'elements': dict(self.elements),
+            'tags': self.tags,
+            'way_nodes': self.way_nodes,
+            'stages': dict(self.stages),
+            'elements_per_sec': elements / elapsed if elapsed else 0.0,
+            'input_bytes': self.input_size,
+            'cross_reference': dict(self.cross_reference),
+            'pipeline': self.pipeline,
+            'shape_cache': self.shape_cache,
+        }
+
+    def dump(self, path):
+        """Write summary() to path as JSON and return it"""
+        summary = self.summary()
+        with open(path, 'wb') as f:
+            json.dump(summary, f, indent=1, sort_keys=True)
+        return summary
+
+
+#Metrics for reading file_in (a path), starting at byte start_position.
+def for_input(file_in, start_position=0, report=True):
+    input_size = os.path.getsize(file_in) if isinstance(file_in, basestring) else None
+    return Metrics(input_size, start_position or 0, report=report)
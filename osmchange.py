@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Incremental updates from OSM change files (.osc).
+
+An osmChange file lists the nodes and ways that were created, modified or deleted since an
+extract was taken:
+
+<osmChange version="0.6">
+  <create> <node id="..." ...> <tag .../> </node> </create>
+  <modify> <way id="..." ...> <nd .../> <tag .../> </way> </modify>
+  <delete> <node id="..." .../> </delete>
+</osmChange>
+
+apply_change streams the file and applies it to a database built by
+process_map(..., target='sqlite'): created and modified elements are shaped (and cleaned) with
+shape_element and replace any existing row plus its tags / way nodes, deleted elements are
+removed with their tags / way nodes.  Changes are applied in file order, so an element modified
+twice ends up with its last version.  Relations are skipped like everywhere else.
+
+    python osmchange.py changes.osc[.gz] [osm.db]
+"""
+
+import sqlite3
+import sys
+import xml.etree.cElementTree as ET
+
+import compressed
+import data
+import fastvalidator
+
+ACTIONS = ('create', 'modify', 'delete')
+COMMIT_ELEMENTS = 50000  # Elements applied per transaction
+
+
+class ChangeApplier(object):
+    """Upserts and deletes of shaped elements against the process_map tables"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        inserts = {}
+        for table, fields, _, primary_key in data.TABLES:
+            verb = 'INSERT OR REPLACE' if primary_key else 'INSERT'
+            inserts[table] = '{0} INTO "{1}" VALUES ({2})'.format(verb, table,
+                                                                   ', '.join('?' * len(fields)))
+        self.inserts = inserts
+
+    def _delete_rows(self, tag, element_id):
+        execute = self.connection.execute
+        if tag == 'node':
+            execute('DELETE FROM nodes_tags WHERE id = ?', (element_id,))
+        else:
+            execute('DELETE FROM ways_tags WHERE id = ?', (element_id,))
+            execute('DELETE FROM ways_nodes WHERE id = ?', (element_id,))
+
+    def upsert(self, el):
+        if el.tag == 'node':
+            self._delete_rows('node', int(el.node.id))
+            self.connection.execute(self.inserts['nodes'], el.node)
+            self.connection.executemany(self.inserts['nodes_tags'], el.node_tags)
+        else:
+            self._delete_rows('way', int(el.way.id))
+            self.connection.execute(self.inserts['ways'], el.way)
+            self.connection.executemany(self.inserts['ways_nodes'], el.way_nodes)
+            self.connection.executemany(self.inserts['ways_tags'], el.way_tags)
+
+    def delete(self, tag, element_id):
+        element_id = int(element_id)
+        self._delete_rows(tag, element_id)
+        table = 'nodes' if tag == 'node' else 'ways'
+        self.connection.execute('DELETE FROM "{0}" WHERE id = ?'.format(table), (element_id,))
+
+
+def iter_changes(osc_file):
+    """Yield (action, element) for every node and way in an osmChange file (.osc or .osc.gz)"""
+    source = compressed.open_input(osc_file) if isinstance(osc_file, basestring) else osc_file
+    try:
+        context = ET.iterparse(source, events=('start', 'end'))
+        _, root = next(context)
+        action = None
+        for event, elem in context:
+            if event == 'start':
+                if elem.tag in ACTIONS:
+                    action = elem
+                continue
+            if elem.tag in ('node', 'way') and action is not None:
+                yield action.tag, elem
+                action.clear()
+            elif elem.tag in ACTIONS:
+                action = None
+                root.clear()
+    finally:
+        if source is not osc_file:
+            source.close()
+
+
+def apply_change(osc_file, db_path=None, validate=True, commit_elements=COMMIT_ELEMENTS):
+    """Apply an osmChange file to the SQLite database written by process_map
+
+    Returns the number of elements applied per action and element type, e.g.
+    {'create': {'node': 120, 'way': 4}, 'modify': {...}, 'delete': {...}}.
+    """
+    connection = sqlite3.connect(db_path or data.DB_PATH)
+    applier = ChangeApplier(connection)
+    validator = fastvalidator.FastValidator(data.SCHEMA)
+    stats = dict((action, {'node': 0, 'way': 0}) for action in ACTIONS)
+    pending = 0
+
+    try:
+        for action, element in iter_changes(osc_file):
+            if action == 'delete':
+                applier.delete(element.tag, element.attrib['id'])
+            else:
+                el = data.shape_element(element)
+                if validate is True:
+                    data.validate_element(el, validator)
+                applier.upsert(el)
+            stats[action][element.tag] += 1
+
+            pending += 1
+            if pending >= commit_elements:
+                connection.commit()
+                pending = 0
+        connection.commit()
+    finally:
+        connection.close()
+    return stats
+
+
+if __name__ == '__main__':
+    stats = apply_change(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+    for action in ACTIONS:
+        print "{0}: {1} nodes, {2} ways".format(action, stats[action]['node'], stats[action]['way'])
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Element aligned byte ranges of an OSM XML file.
+
+A range starts on a top level <node>, <way> or <relation> tag and ends where the next range starts
+(or at the closing </osm>), so it can be parsed on its own once it is wrapped in an <osm> root,
+which is what ChunkReader does.  Used to shape a file in parallel (parallel.py) and to checkpoint
+and resume process_map (checkpoint.py).
+"""
+
+import os
+import re
+
+READ_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024 * 1024  # Bytes of XML per chunk handed to a worker by parallel.py
+
+ELEMENT_START_RE = re.compile(br'<(?:node|way|relation)[\s/>]')
+DOCUMENT_END = b'</osm>'
+
+
+#Offset of the first top level element start at or after pos, None if there is none.
+def next_element_offset(osm_file, pos):
+    osm_file.seek(pos)
+    overlap = b''
+    while True:
+        block = osm_file.read(READ_SIZE)
+        if not block:
+            return None
+        m = ELEMENT_START_RE.search(overlap + block)
+        if m:
+            return pos - len(overlap) + m.start()
+        pos += len(block)
+        overlap = block[-16:]
+
+
+#Offset of the closing </osm> tag (or the end of the file if it is missing).
+def document_end_offset(osm_file, size):
+    tail = min(size, READ_SIZE)
+    osm_file.seek(size - tail)
+    end = osm_file.read(tail).rfind(DOCUMENT_END)
+    if end == -1:
+        return size
+    return size - tail + end
+
+
+def find_chunks(file_in, chunk_size, start=None):
+    """Split file_in into (start, end) byte ranges aligned on top level element starts
+
+    start is the offset of an element to begin at, the first element of the file by default.
+    """
+    size = os.path.getsize(file_in)
+    with open(file_in, 'rb') as osm_file:
+        if start is None:
+            start = next_element_offset(osm_file, 0)
+        end = document_end_offset(osm_file, size)
+        if start is None or start >= end:
+            return []
+
+        boundaries = [start]
+        while True:
+            offset = next_element_offset(osm_file, boundaries[-1] + chunk_size)
+            if offset is None or offset >= end:
+                break
+            boundaries.append(offset)
+        boundaries.append(end)
+
+    return zip(boundaries[:-1], boundaries[1:])
+
+
+class ChunkReader(object):
+    """File-like view of one byte range of an OSM file, wrapped in its own <osm> root"""
+
+    def __init__(self, file_in, start, end):
+        self.osm_file = open(file_in, 'rb')
+        self.osm_file.seek(start)
+        self.remaining = end - start
+        self.pending = [b'<?xml version="1.0" encoding="UTF-8"?>\n<osm>\n']
+        self.done = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.remaining + 1024
+        out = []
+        have = 0
+        while have < size:
+            if self.pending:
+                piece = self.pending.pop(0)
+            elif self.remaining > 0:
+                piece = self.osm_file.read(min(self.remaining, max(size - have, 1)))
+                if not piece:
+                    self.remaining = 0
+                    continue
+                self.remaining -= len(piece)
+            elif not self.done:
+                self.done = True
+                piece = b'\n' + DOCUMENT_END + b'\n'
+            else:
+                break
+            if have + len(piece) > size:
+                self.pending.insert(0, piece[size - have:])
+                piece = piece[:size - have]
+            out.append(piece)
+            have += len(piece)
+        return b''.join(out)
+
+    def close(self):
+        self.osm_file.close()
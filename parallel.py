@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Multi-process shaping for process_map.
+
+The OSM file is split into byte ranges that start on a top level <node>, <way> or <relation>
+tag (see osmchunks.py).  Each range is parsed in a worker process as if it were a small OSM file
+of its own, shaped (and optionally validated) with the same code as the single process path, and
+written to a set of part files.  A .osm.pbf file is split into ranges of whole blobs instead (see
+pbf.find_blocks), which the workers decode as well as shape.  The parent appends the part files to the five csv outputs in input order, so the
+result is byte for byte the same as process_map(file_in, validate) with one process.
+"""
+
+import collections
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import crossref
+import data
+import instrumentation
+import osmchunks
+import parsers
+import pbf
+import writers
+
+COPY_SIZE = 1024 * 1024
+JOBS_AHEAD = 2  # Chunks in flight per worker process
+
+PART_FIELDS = (data.NODE_FIELDS, data.NODE_TAGS_FIELDS, data.WAY_FIELDS, data.WAY_NODES_FIELDS,
+               data.WAY_TAGS_FIELDS)
+
+
+# ================================================== #
+#               Worker Processes                     #
+# ================================================== #
+def init_worker(CCR):
+    data.Compiled_Cross_Reference = CCR
+
+
+#Shape one chunk into five part files. Returns their paths in csv order, the number of elements,
+#the last element written and (when instrument is True) the chunk's instrumentation summary.
+def shape_chunk(args):
+    file_in, start, end, part_dir, index, validate, buffer_rows, parser, instrument = args
+    paths = [os.path.join(part_dir, '%06d.%d.csv' % (index, table)) for table in range(5)]
+    part_files = [open(path, 'wb') for path in paths]
+    pbf_input = pbf.is_pbf(file_in)
+    if pbf_input:
+        reader = pbf.PbfReader(file_in, start, end)
+    else:
+        reader = osmchunks.ChunkReader(file_in, start, end)
+    metrics = None
+    cross_reference = data.compiled_cross_reference()
+    # With normalize='deferred' the values are cleaned (and counted) after shaping
+    counting = instrument and not isinstance(cross_reference, crossref.RawValues)
+    if instrument:
+        metrics = instrumentation.Metrics(report=False)
+    if counting:
+        data.Compiled_Cross_Reference = instrumentation.CountingCrossReference(cross_reference)
+    try:
+        part_writers = [writers.BufferedCsvWriter(part_file, fields, buffer_rows)
+                        for part_file, fields in zip(part_files, PART_FIELDS)]
+        count, last_element = data.write_elements(reader, part_writers, validate, parser, metrics)
+    finally:
+        if not pbf_input:
+            reader.close()
+        for part_file in part_files:
+            part_file.close()
+        if counting:
+            metrics.add_counts(data.Compiled_Cross_Reference.counts)
+            data.Compiled_Cross_Reference = cross_reference
+    return paths, count, last_element, metrics.summary() if instrument else None
+
+
+#Like pool.imap(func, jobs), but with at most limit jobs submitted and not yet returned, so a slow
+#chunk holds back the ones after it instead of letting all of their part files pile up.
+def imap_bounded(pool, func, jobs, limit):
+    results = collections.deque()
+    for job in jobs:
+        results.append(pool.apply_async(func, (job,)))
+        if len(results) >= limit:
+            yield results.popleft().get()
+    while results:
+        yield results.popleft().get()
+
+
+def write_chunks(file_in, out_files, validate, workers=None, CCR=None,
+                 chunk_size=osmchunks.CHUNK_SIZE,
+                 buffer_rows=writers.BUFFER_ROWS, checkpointer=None, parser=parsers.DEFAULT_PARSER,
+                 metrics=None):
+    """Shape file_in in a process pool and append the rows to the five open csv files
+
+    CCR is the compiled cross reference the workers clean with (data.compiled_cross_reference()
+    by default).
+
+    Part files are appended and removed as soon as their chunk (and every chunk before it) is
+    done.  At most JOBS_AHEAD * workers chunks are in flight at a time, so the temporary space
+    used stays within that many chunks' worth of csv rows even when an early chunk is slow.
+
+    With a checkpoints.Checkpointer, shaping starts at its offset and a checkpoint is saved
+    after each chunk is appended.
+
+    With an instrumentation.Metrics, each worker instruments its chunks and the totals are merged
+    into it as the chunks are appended.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    part_dir = tempfile.mkdtemp(prefix='process_map_', dir=os.path.dirname(os.path.abspath(
+        out_files[0].name)))
+    if pbf.is_pbf(file_in):
+        chunks = pbf.find_blocks(file_in, chunk_size)
+    else:
+        start_offset = checkpointer.offset if checkpointer is not None else None
+        chunks = osmchunks.find_chunks(file_in, chunk_size, start_offset)
+    jobs = [(file_in, start, end, part_dir, index, validate, buffer_rows, parser,
+             metrics is not None)
+            for index, (start, end) in enumerate(chunks)]
+
+    pool = multiprocessing.Pool(workers, initializer=init_worker,
+                                initargs=(CCR or data.compiled_cross_reference(),))
+    try:
+        results = imap_bounded(pool, shape_chunk, jobs, JOBS_AHEAD * workers)
+        for index, (paths, count, last_element, summary) in enumerate(results):
+            for out_file, path in zip(out_files, paths):
+                with open(path, 'rb') as part_file:
+                    shutil.copyfileobj(part_file, out_file, COPY_SIZE)
+                os.remove(path)
+            if checkpointer is not None:
+                checkpointer.save(chunks[index][1], last_element, count)
+            if metrics is not None:
+                metrics.merge(summary)
+                metrics.progress(chunks[index][1])
+        pool.close()
+        if checkpointer is not None:
+            checkpointer.finish()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        shutil.rmtree(part_dir, ignore_errors=True)
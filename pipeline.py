@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Pipelined parse / shape / write stages for process_map.
+
+process_map normally reads, shapes and writes one element at a time on one thread, so the time
+spent waiting for the disk (and in bz2 / zlib, which run without holding the GIL) is never
+overlapped with the Python work.  With process_map(..., pipelined=True) each stage runs on its own
+thread:
+
+    parse   (thread)       the parser, handing on elements in batches of batch_items
+    shape   (thread)       shape_element and validation of a whole batch
+    write   (main thread)  the csv / SQLite / Parquet writers or the document sinks
+
+connected by queues of at most queue_batches batches, so a stage that gets ahead blocks until the
+next one catches up and memory stays bounded.  The writers stay on the calling thread (an SQLite
+connection can only be used on the thread that opened it).  The output is the same as without
+pipelining.
+
+The GIL still allows one stage at a time to run Python code, so what is gained is the I/O (and
+decompression / compression) time of one stage hidden behind the others.  Pipeline.summary()
+gives each stage's utilization: the fraction of the run it was busy, waiting for input (starved)
+or waiting for room downstream (blocked).
+
+    pipeline = Pipeline(queue_batches=4)
+    for batch in pipeline.run(elements, [('shape', shape_batch)]):
+        write(batch)
+    pipeline.summary()['stages']['shape']['busy_fraction']
+"""
+
+import collections
+import Queue
+import sys
+import threading
+import time
+
+QUEUE_BATCHES = 2  # Batches a queue between two stages holds before the stage feeding it blocks
+BATCH_ITEMS = 64  # Elements handed from one stage to the next at a time
+
+TIMES = ('busy', 'starved', 'blocked')
+
+
+class Failure(object):
+    """An exception raised in a stage thread, passed down the queues to be raised by run()"""
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class Pipeline(object):
+    """Runs a source and batch functions on threads joined by bounded queues"""
+
+    def __init__(self, queue_batches=QUEUE_BATCHES, batch_items=BATCH_ITEMS):
+        if queue_batches < 1 or batch_items < 1:
+            raise ValueError("queue_batches and batch_items must be at least 1")
+        self.queue_batches = queue_batches
+        self.batch_items = batch_items
+        self.stages = collections.OrderedDict()  # name -> {'busy': seconds, ..., 'batches': n}
+        self.elapsed = 0.0
+
+    def _stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = dict.fromkeys(TIMES, 0.0)
+            self.stages[name]['batches'] = 0
+        return self.stages[name]
+
+    def _put(self, queue, item, stats):
+        start = time.time()
+        queue.put(item)
+        stats['blocked'] += time.time() - start
+
+    def _get(self, queue, stats):
+        start = time.time()
+        item = queue.get()
+        stats['starved'] += time.time() - start
+        return item
+
+    def _read(self, items, out, stats):
+        """Source thread: items in lists of batch_items"""
+        try:
+            iterator = iter(items)
+            while not self.stopping.is_set():
+                start = time.time()
+                batch = []
+                for item in iterator:
+                    batch.append(item)
+                    if len(batch) == self.batch_items:
+                        break
+                stats['busy'] += time.time() - start
+                if not batch:
+                    break
+                stats['batches'] += 1
+                self._put(out, batch, stats)
+            self._put(out, None, stats)
+        except Exception:
+            out.put(Failure(sys.exc_info()))
+        finally:
+            close = getattr(items, 'close', None)
+            if close is not None:
+                close()
+
+    def _work(self, function, source, out, stats):
+        """Stage thread: function(batch) for every batch from source"""
+        try:
+            while True:
+                batch = self._get(source, stats)
+                if batch is None or isinstance(batch, Failure) or self.stopping.is_set():
+                    out.put(batch)
+                    return
+                start = time.time()
+                result = function(batch)
+                stats['busy'] += time.time() - start
+                stats['batches'] += 1
+                self._put(out, result, stats)
+        except Exception:
+            out.put(Failure(sys.exc_info()))
+
+    def run(self, items, stages, source_name='parse', sink_name='write'):
+        """Yield function(...) of each stage applied in turn to batches of items, in order
+
+        stages is a list of (name, function of a batch returning a batch). items is iterated on
+        a thread of its own (and closed when done); the time the caller takes between batches
+        is counted as the sink_name stage.
+        """
+        self.stopping = threading.Event()
+        queues = [Queue.Queue(self.queue_batches) for _ in range(len(stages) + 1)]
+        threads = [threading.Thread(target=self._read,
+                                    args=(items, queues[0], self._stage(source_name)))]
+        for (name, function), source, out in zip(stages, queues, queues[1:]):
+            threads.append(threading.Thread(target=self._work,
+                                            args=(function, source, out, self._stage(name))))
+        sink = self._stage(sink_name)
+        run_start = time.time()
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                batch = self._get(queues[-1], sink)
+                if batch is None:
+                    break
+                if isinstance(batch, Failure):
+                    raise batch.exc_info[0], batch.exc_info[1], batch.exc_info[2]
+                sink['batches'] += 1
+                start = time.time()
+                yield batch
+                sink['busy'] += time.time() - start
+        finally:
+            # Stop the stages (the caller may have stopped early or failed), emptying the queues
+            # so that none of them stays blocked on a full one
+            self.stopping.set()
+            while any(thread.is_alive() for thread in threads):
+                for queue in queues:
+                    try:
+                        while True:
+                            queue.get_nowait()
+                    except Queue.Empty:
+                        pass
+                for thread in threads:
+                    thread.join(0.01)
+            self.elapsed += time.time() - run_start
+
+    def summary(self):
+        """Seconds of the run and, per stage, seconds busy / starved / blocked, the fractions of
+        the run they make up and the number of batches"""
+        stages = collections.OrderedDict()
+        for name, stats in self.stages.items():
+            stages[name] = dict(stats)
+            for key in TIMES:
+                stages[name][key + '_fraction'] = stats[key] / self.elapsed if self.elapsed else 0.0
+        return {'elapsed_seconds': self.elapsed, 'stages': stages}
+
+    def report(self):
+        """One line: each stage's busy / starved / blocked percentages"""
+        return "Pipeline: " + ", ".join(
+            "{0} {1:.0f}% busy {2:.0f}% starved {3:.0f}% blocked".format(
+                name, 100 * stats['busy_fraction'], 100 * stats['starved_fraction'],
+                100 * stats['blocked_fraction'])
+            for name, stats in self.summary()['stages'].items())
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Persistent cache of shaped elements for process_map reruns.
+
+In OSM a (type, id, version) always has the same attributes and tags, so what shape_element makes
+of an element only changes when the street / city cross references it looked values up in do.
+With process_map(..., shape_cache='shape_cache.db') the shaped rows of every element are kept in
+a SQLite database along with those lookups: the street types and city names the element's values
+were looked up under and what each mapped to at the time.  On a rerun an element is taken from
+the cache when its version is the same and each of its lookups still maps to the same thing in
+the current cross references, so an edit to the cross reference csvs only re-shapes the elements
+that use the changed mappings.  Cached rows were validated when they were stored.
+
+For csv output (output='csv') the rows are kept as the csv text of each of the element's files,
+so a hit is written out as it is, without building the row tuples or formatting them again.
+For the other outputs (output='rows') they are kept as tuples.  A database holds one kind; opening
+it for the other empties it.
+
+Lookups are done a batch of elements at a time.  Entries record the last run that used them and
+when the database grows past max_bytes of rows the least recently used ones are evicted.
+
+    cache = ShapeCache('shape_cache.db', data.compiled_cross_reference(), output='csv')
+    found = cache.lookup('node', [(node_id, version), ...])   # {id: tables}
+    cache.store('node', [(node_id, version, dependencies, tables, validated), ...])
+    cache.close()   # evicts, commits and returns the hit / miss counts
+"""
+
+import marshal
+import os
+import sqlite3
+
+import crossref
+
+CACHE_FORMAT = 2  # Stored with the entries; change it when shape_element's rows change
+MAX_BYTES = 1024 * 1024 * 1024  # Bytes of stored rows kept before the oldest entries are evicted
+LOOKUP_IDS = 500  # Ids per SELECT (SQLite allows 999 parameters)
+RANGE_SPREAD = 16  # Batches of ids spread over at most this many ids per id are read as a range
+OUTPUTS = ('csv', 'rows')
+
+
+#Whichever mapping CrossReference.update_name would apply to street_type (None if none applies).
+def street_mapping(cross_reference, street_type):
+    full_name = cross_reference.common_names.get(street_type)
+    if full_name is None:
+        full_name = cross_reference.usps_names.get(street_type)
+    return full_name
+
+
+def city_mapping(cross_reference, name):
+    return cross_reference.city_names.get(name)
+
+
+MAPPINGS = {'street': street_mapping, 'city': city_mapping}
+
+
+class RecordingCrossReference(crossref.CrossReference):
+    """A CrossReference (cleaning with another one) that records the mappings each lookup used
+
+    take() returns and clears the (kind, name looked up, mapping) of the lookups since the last
+    call, which are the dependencies of the element just shaped.
+    """
+
+    def __init__(self, cross_reference):
+        self.cross_reference = cross_reference
+        self.common_names = cross_reference.common_names
+        self.usps_names = cross_reference.usps_names
+        self.street_values = cross_reference.street_values
+        self.city_names = cross_reference.city_names
+        self.lookups = []
+
+    def update_name(self, name):
+        m = crossref.street_type_re.search(name)
+        if m:
+            street_type = m.group().upper()
+            self.lookups.append(('street', street_type, street_mapping(self, street_type)))
+        return self.cross_reference.update_name(name)
+
+    def update_city_name(self, name):
+        self.lookups.append(('city', name, city_mapping(self, name)))
+        return self.cross_reference.update_city_name(name)
+
+    def take(self):
+        lookups = tuple(self.lookups)
+        del self.lookups[:]
+        return lookups
+
+
+class ShapeCache(object):
+    """Shaped rows by (element type, id), valid for one version and set of mappings"""
+
+    def __init__(self, path, cross_reference, max_bytes=MAX_BYTES, output='rows'):
+        if output not in OUTPUTS:
+            raise ValueError("Unknown shape cache output '{0}'".format(output))
+        self.path = path
+        self.cross_reference = cross_reference
+        self.max_bytes = max_bytes
+        self.output = output
+        # stale counts the misses that had an entry for another version or other mappings (or
+        # one that wasn't validated)
+        self.stats = dict.fromkeys(('hits', 'misses', 'stale', 'stored', 'evicted'), 0)
+        # The pipelined shape stage uses the cache from a thread of its own
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.text_factory = str
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS shapes (type TEXT, id INTEGER, version TEXT, entry BLOB, '
+            'size INTEGER, used INTEGER, PRIMARY KEY (type, id))')
+        meta = dict(self.connection.execute('SELECT key, value FROM meta'))
+        if meta.get('format') != CACHE_FORMAT or meta.get('output') != output:
+            self.connection.execute('DELETE FROM shapes')
+        self.run = meta.get('run', 0) + 1
+        self.connection.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                    [('format', CACHE_FORMAT), ('output', output),
+                                     ('run', self.run)])
+        # Mappings already checked against the current cross reference
+        self.unchanged = dict((kind, {}) for kind in MAPPINGS)
+
+    def _unchanged(self, dependencies):
+        for kind, name, mapping in dependencies:
+            checked = self.unchanged[kind]
+            current = checked.get(name, checked)
+            if current is checked:
+                current = checked[name] = MAPPINGS[kind](self.cross_reference, name)
+            if current != mapping:
+                return False
+        return True
+
+    def lookup(self, element_type, keys, validated=False):
+        """{id: tables} for the (id, version) keys with a usable entry
+
+        With validated=True entries stored without validating the rows are not used.
+        """
+        versions = dict(keys)
+        found = {}
+        stale = 0
+        ids = sorted(versions)
+        for start in xrange(0, len(ids), LOOKUP_IDS):
+            batch = ids[start:start + LOOKUP_IDS]
+            # OSM files are sorted by id, so a range scan reads the batch's entries in one pass
+            if batch[-1] - batch[0] <= RANGE_SPREAD * len(batch):
+                rows = self.connection.execute(
+                    'SELECT id, version, entry FROM shapes WHERE type = ? AND id BETWEEN ? AND ?',
+                    (element_type, batch[0], batch[-1]))
+            else:
+                rows = self.connection.execute(
+                    'SELECT id, version, entry FROM shapes WHERE type = ? AND id IN ({0})'.format(
+                        ', '.join('?' * len(batch))), [element_type] + batch)
+            for element_id, version, entry in rows:
+                wanted = versions.get(element_id)
+                if wanted is None:
+                    continue
+                if version == wanted:
+                    dependencies, tables, entry_validated = marshal.loads(entry)
+                    if (entry_validated or not validated) and \
+                            (not dependencies or self._unchanged(dependencies)):
+                        found[element_id] = tables
+                        continue
+                stale += 1
+        used = list(found)
+        for start in xrange(0, len(used), LOOKUP_IDS):
+            batch = used[start:start + LOOKUP_IDS]
+            self.connection.execute(
+                'UPDATE shapes SET used = ? WHERE type = ? AND id IN ({0})'.format(
+                    ', '.join('?' * len(batch))), [self.run, element_type] + batch)
+        self.stats['hits'] += len(found)
+        self.stats['misses'] += len(keys) - len(found)
+        self.stats['stale'] += stale
+        return found
+
+    def store(self, element_type, entries):
+        """Save (id, version, dependencies, tables, validated) entries, replacing older ones"""
+        rows = []
+        for element_id, version, dependencies, tables, validated in entries:
+            entry = marshal.dumps((dependencies, tables, validated))
+            rows.append((element_type, element_id, version, buffer(entry), len(entry), self.run))
+        self.connection.executemany('INSERT OR REPLACE INTO shapes VALUES (?, ?, ?, ?, ?, ?)',
+                                    rows)
+        self.stats['stored'] += len(rows)
+
+    def evict(self):
+        """Remove the least recently used entries until at most max_bytes of rows are kept"""
+        total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM shapes').fetchone()[0]
+        excess = total - self.max_bytes
+        if excess <= 0:
+            return 0
+        evicted = []
+        for rowid, size in self.connection.execute(
+                'SELECT rowid, size FROM shapes ORDER BY used, rowid'):
+            evicted.append((rowid,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.connection.executemany('DELETE FROM shapes WHERE rowid = ?', evicted)
+        self.stats['evicted'] += len(evicted)
+        return len(evicted)
+
+    def summary(self):
+        looked_up = self.stats['hits'] + self.stats['misses']
+        summary = dict(self.stats)
+        summary['hit_rate'] = float(self.stats['hits']) / looked_up if looked_up else 0.0
+        summary['bytes'] = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        return summary
+
+    def close(self):
+        """Evict, commit and close; returns summary()"""
+        try:
+            self.evict()
+            self.connection.commit()
+        finally:
+            self.connection.close()
+        return self.summary()
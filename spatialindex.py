@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Grid spatial index over the node and way geometry stores (see geometry.py).
+
+The world is cut into square cells CELL_DEGREES on a side and each cell gets a number (row * columns
++ column).  The index is two sorted arrays of cell numbers saved next to the geometry stores: one
+entry per node, and one per cell a way's bounding box covers (ways covering more than
+MAX_WAY_CELLS cells are kept in a short list checked on every query instead).  A bounding box
+query looks up the runs of cells it covers with searchsorted, one row of cells at a time, then
+keeps the nodes inside the box and the ways with a node inside it, so nothing is read but the
+candidate cells.
+
+    index = GridIndex.open('geometry')
+    # bbox is (min_lon, min_lat, max_lon, max_lat)
+    node_ids, way_ids = index.query((-115.2, 36.1, -115.1, 36.2))
+
+extract() writes the rows of the five csv files for a bounding box (the selected ways with all of
+their nodes, like createsamplefile.py's bbox mode) to another directory:
+
+    python spatialindex.py extract lasvegas_strip --bbox=-115.2,36.1,-115.1,36.2
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+import geometry
+
+CELL_DEGREES = 0.01  # Cell side: about 1.1 km north-south
+MAX_WAY_CELLS = 256  # Ways covering more cells than this are checked on every query
+
+TABLE_FILES = ('nodes.csv', 'nodes_tags.csv', 'ways.csv', 'ways_nodes.csv', 'ways_tags.csv')
+
+
+class Grid(object):
+    """Numbering of the cells of a regular latitude / longitude grid"""
+
+    def __init__(self, cell_degrees=CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self.columns = int(np.ceil(360.0 / cell_degrees)) + 1
+
+    def row(self, lats):
+        return np.floor((np.asarray(lats, dtype=np.float64) + 90.0) / self.cell_degrees) \
+            .astype(np.int64)
+
+    def column(self, lons):
+        return np.floor((np.asarray(lons, dtype=np.float64) + 180.0) / self.cell_degrees) \
+            .astype(np.int64)
+
+    def cells(self, lats, lons):
+        return self.row(lats) * self.columns + self.column(lons)
+
+    def cell_ranges(self, bbox):
+        """(first cell, last cell) of each row of cells bbox covers"""
+        min_lon, min_lat, max_lon, max_lat = bbox
+        first_column, last_column = self.column(min_lon), self.column(max_lon)
+        return [(row * self.columns + first_column, row * self.columns + last_column)
+                for row in xrange(self.row(min_lat), self.row(max_lat) + 1)]
+
+
+def in_bbox(lats, lons, bbox):
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return (lats >= min_lat) & (lats <= max_lat) & (lons >= min_lon) & (lons <= max_lon)
+
+
+#Positions of the entries of sorted cells that fall in any of the cell ranges.
+def positions_in(cells, cell_ranges):
+    starts = np.searchsorted(cells, [first for first, _ in cell_ranges], 'left')
+    ends = np.searchsorted(cells, [last for _, last in cell_ranges], 'right')
+    if not len(starts):
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+
+
+class GridIndex(object):
+    """Nodes and ways by grid cell, over a NodeStore and WayStore"""
+
+    FILES = ('grid_node_cells', 'grid_node_positions', 'grid_way_cells', 'grid_way_positions',
+             'grid_large_ways')
+
+    def __init__(self, grid, node_store, way_store, node_cells, node_positions, way_cells,
+                 way_positions, large_ways):
+        self.grid = grid
+        self.node_store = node_store
+        self.way_store = way_store
+        self.node_cells = node_cells
+        self.node_positions = node_positions
+        self.way_cells = way_cells
+        self.way_positions = way_positions
+        self.large_ways = large_ways
+
+    @classmethod
+    def build(cls, directory, cell_degrees=CELL_DEGREES, max_way_cells=MAX_WAY_CELLS):
+        """Index the NodeStore and WayStore saved in directory and open the index"""
+        grid = Grid(cell_degrees)
+        node_store = geometry.NodeStore.open(directory)
+        way_store = geometry.WayStore.open(directory)
+
+        node_cells = grid.cells(node_store.lats, node_store.lons)
+        node_positions = np.argsort(node_cells, kind='mergesort')
+        node_cells = node_cells[node_positions]
+
+        way_cells = np.zeros(0, dtype=np.int64)
+        way_positions = np.zeros(0, dtype=np.int64)
+        large_ways = np.zeros(0, dtype=np.int64)
+        if len(way_store):
+            starts = np.asarray(way_store.offsets[:-1])
+            lats, lons = np.asarray(way_store.lats), np.asarray(way_store.lons)
+            with np.errstate(invalid='ignore'):
+                min_rows = grid.row(np.fmin.reduceat(lats, starts))
+                max_rows = grid.row(np.fmax.reduceat(lats, starts))
+                min_columns = grid.column(np.fmin.reduceat(lons, starts))
+                max_columns = grid.column(np.fmax.reduceat(lons, starts))
+            # Ways with no node found have NaN bounding boxes and can't be placed
+            placed = ~np.isnan(np.fmin.reduceat(lats, starts))
+            heights = np.where(placed, max_rows - min_rows + 1, 0)
+            widths = np.where(placed, max_columns - min_columns + 1, 0)
+            large = heights * widths > max_way_cells
+            large_ways = np.flatnonzero(large)
+            heights[large] = 0
+
+            # One entry per (way, covered cell): repeat each way over its rows, then each row
+            # over its columns
+            ways = np.repeat(np.arange(len(way_store)), heights)
+            row_starts = np.cumsum(heights) - heights
+            rows = min_rows[ways] + np.arange(len(ways)) - np.repeat(row_starts, heights)
+            entries = np.repeat(np.arange(len(ways)), widths[ways])
+            entry_starts = np.cumsum(widths[ways]) - widths[ways]
+            columns = min_columns[ways][entries] + np.arange(len(entries)) - \
+                np.repeat(entry_starts, widths[ways])
+            way_cells = rows[entries] * grid.columns + columns
+            way_positions = ways[entries]
+            order = np.argsort(way_cells, kind='mergesort')
+            way_cells, way_positions = way_cells[order], way_positions[order]
+
+        for name, values in zip(cls.FILES, (node_cells, node_positions, way_cells, way_positions,
+                                            large_ways)):
+            np.asarray(values, dtype=np.int64).tofile(os.path.join(directory, name + '.bin'))
+        geometry.save_meta(directory, 'grid_index', {
+            'cell_degrees': cell_degrees, 'max_way_cells': max_way_cells,
+            'way_entries': len(way_cells), 'large_ways': len(large_ways)})
+        return cls.open(directory)
+
+    @classmethod
+    def open(cls, directory, mmap=True):
+        meta = geometry.load_meta(directory, 'grid_index')
+        arrays = [geometry.load_array(os.path.join(directory, name + '.bin'), np.int64, mmap)
+                  for name in cls.FILES]
+        return cls(Grid(meta['cell_degrees']), geometry.NodeStore.open(directory, mmap),
+                   geometry.WayStore.open(directory, mmap), *arrays)
+
+    def query_nodes(self, bbox):
+        """Sorted ids of the nodes inside bbox (min_lon, min_lat, max_lon, max_lat)"""
+        positions = np.asarray(self.node_positions[positions_in(self.node_cells,
+                                                                self.grid.cell_ranges(bbox))])
+        store = self.node_store
+        inside = in_bbox(store.lats[positions], store.lons[positions], bbox)
+        return np.sort(np.asarray(store.ids[positions[inside]]))
+
+    def query_ways(self, bbox):
+        """Sorted ids of the ways with at least one node inside bbox"""
+        candidates = np.asarray(self.way_positions[positions_in(self.way_cells,
+                                                                self.grid.cell_ranges(bbox))])
+        candidates = np.union1d(candidates, np.asarray(self.large_ways))
+        if not len(candidates):
+            return np.zeros(0, dtype=np.int64)
+        store = self.way_store
+        starts, ends = store.offsets[candidates], store.offsets[candidates + 1]
+        lengths = ends - starts
+        # Coordinate positions of every candidate way, back to back
+        coordinate_positions = np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) +
+                                                                    lengths, lengths)
+        with np.errstate(invalid='ignore'):
+            inside = in_bbox(store.lats[coordinate_positions], store.lons[coordinate_positions],
+                             bbox)
+        way_inside = np.logical_or.reduceat(inside, np.cumsum(lengths) - lengths)
+        return np.sort(np.asarray(store.ids[candidates[way_inside]]))
+
+    def query(self, bbox):
+        """(node ids, way ids) for bbox (min_lon, min_lat, max_lon, max_lat)"""
+        return self.query_nodes(bbox), self.query_ways(bbox)
+
+
+def filter_csv(path, out_path, column, ids, chunk_rows=geometry.CHUNK_ROWS):
+    """Copy the rows of a process_map csv file whose column is in ids; returns the rows copied"""
+    copied = 0
+    with open(out_path, 'wb') as out:
+        for index, frame in enumerate(pd.read_csv(path, dtype=object, na_filter=False,
+                                                  encoding='utf-8', chunksize=chunk_rows)):
+            selected = frame[np.in1d(frame[column].values.astype(np.int64), ids)]
+            selected.to_csv(out, index=False, header=index == 0, encoding='utf-8',
+                            line_terminator='\r\n')
+            copied += len(selected)
+    return copied
+
+
+def extract(bbox, out_dir, csv_dir='.', index_dir='geometry'):
+    """Write the rows of the csv files in csv_dir for the nodes and ways in bbox to out_dir
+
+    Every node of a selected way is included.  Returns the number of rows written per file.
+    """
+    node_ids, way_ids = GridIndex.open(index_dir).query(bbox)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    paths = [(os.path.join(csv_dir, name), os.path.join(out_dir, name)) for name in TABLE_FILES]
+    nodes, nodes_tags, ways, ways_nodes, ways_tags = paths
+
+    written = {}
+    written['ways_nodes.csv'] = filter_csv(ways_nodes[0], ways_nodes[1], 'id', way_ids)
+    way_node_ids = pd.read_csv(ways_nodes[1], usecols=['node_id'], dtype=np.int64)['node_id']
+    node_ids = np.union1d(node_ids, way_node_ids.values)
+    for (path, out_path), ids in ((nodes, node_ids), (nodes_tags, node_ids), (ways, way_ids),
+                                  (ways_tags, way_ids)):
+        written[os.path.basename(path)] = filter_csv(path, out_path, 'id', ids)
+    return written
+
+
+def parse_bbox(text):
+    return tuple(float(value) for value in text.split(','))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Bounding box queries over the grid index")
+    arg_parser.add_argument('command', choices=('build', 'query', 'extract'))
+    arg_parser.add_argument('out_dir', nargs='?', help="extract: directory for the csv files")
+    arg_parser.add_argument('--bbox', type=parse_bbox, help="min_lon,min_lat,max_lon,max_lat")
+    arg_parser.add_argument('--index-dir', default='geometry')
+    arg_parser.add_argument('--csv-dir', default='.')
+    args = arg_parser.parse_args()
+
+    if args.command == 'build':
+        index = GridIndex.build(args.index_dir)
+        print "Indexed {0} nodes and {1} ways".format(len(index.node_store), len(index.way_store))
+    elif args.bbox is None:
+        arg_parser.error("{0} needs --bbox".format(args.command))
+    elif args.command == 'query':
+        node_ids, way_ids = GridIndex.open(args.index_dir).query(args.bbox)
+        print "{0} nodes and {1} ways".format(len(node_ids), len(way_ids))
+    else:
+        if args.out_dir is None:
+            arg_parser.error("extract needs an output directory")
+        written = extract(args.bbox, args.out_dir, args.csv_dir, args.index_dir)
+        print "Wrote " + ", ".join("{0} rows to {1}".format(written[name], name)
+                                   for name in TABLE_FILES)
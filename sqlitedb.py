@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Direct SQLite output for process_map.
+
+Instead of writing the csv files and importing them into SQL tables afterwards, a SqliteLoader
+creates the tables from the schema and hands process_map one writer per table.  The writers have
+the same writerow / writerows / flush interface as writers.BufferedCsvWriter; each flush is one
+executemany, rows are committed in large transactions and the secondary indexes are only built
+once everything is loaded.
+"""
+
+import os
+import sqlite3
+import time
+
+import writers
+
+COMMIT_ROWS = 500000  # Rows inserted per transaction
+
+SQL_TYPES = {'integer': 'INTEGER', 'float': 'REAL', 'string': 'TEXT'}
+
+
+def create_table_sql(table, fields, field_schema, primary_key=None):
+    """CREATE TABLE statement for fields in order, typed from the cerberus field schema"""
+    columns = []
+    for field in fields:
+        rules = field_schema[field]
+        column = '"{0}" {1}'.format(field, SQL_TYPES.get(rules.get('type'), 'TEXT'))
+        if field == primary_key:
+            column += ' PRIMARY KEY'
+        if rules.get('required'):
+            column += ' NOT NULL'
+        columns.append(column)
+    return 'CREATE TABLE "{0}" ({1})'.format(table, ', '.join(columns))
+
+
+class SqliteTableWriter(object):
+    """Buffered executemany inserts of row tuples in field order into one table"""
+
+    def __init__(self, loader, table, fields, buffer_rows=writers.BUFFER_ROWS):
+        self.loader = loader
+        self.table = table
+        self.fields = fields
+        self.buffer_rows = buffer_rows
+        self.buffer = []
+        self.rows_written = 0
+        self.sql = 'INSERT INTO "{0}" VALUES ({1})'.format(table, ', '.join('?' * len(fields)))
+
+    def writerow(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.buffer_rows:
+            self.flush()
+
+    def writerows(self, rows):
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.loader.connection.executemany(self.sql, self.buffer)
+            self.rows_written += len(self.buffer)
+            self.loader.inserted(len(self.buffer))
+            del self.buffer[:]
+
+
+class SqliteLoader(object):
+    """Bulk load shaped rows into a new SQLite database
+
+    tables is a list of (table, fields, field_schema, primary_key) in the order process_map writes
+    them, indexes a list of (table, column) built by finish().
+    """
+
+    def __init__(self, db_path, tables, indexes=(), buffer_rows=writers.BUFFER_ROWS,
+                 commit_rows=COMMIT_ROWS):
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        self.connection = sqlite3.connect(db_path)
+        # The database is rebuilt from scratch on failure, so skip the journal and fsyncs.
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('PRAGMA cache_size = -200000')
+
+        for table, fields, field_schema, primary_key in tables:
+            self.connection.execute(create_table_sql(table, fields, field_schema, primary_key))
+        self.indexes = indexes
+        self.commit_rows = commit_rows
+        self.uncommitted = 0
+        self.writers = [SqliteTableWriter(self, table, fields, buffer_rows)
+                        for table, fields, _, _ in tables]
+        self.start = time.time()
+
+    def inserted(self, rows):
+        self.uncommitted += rows
+        if self.uncommitted >= self.commit_rows:
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def finish(self):
+        """Flush and commit the remaining rows, build the indexes and return load statistics"""
+        for writer in self.writers:
+            writer.flush()
+        self.connection.commit()
+        load_seconds = time.time() - self.start
+
+        for table, column in self.indexes:
+            self.connection.execute('CREATE INDEX "{0}_{1}" ON "{0}" ("{1}")'.format(table, column))
+        self.connection.commit()
+        self.connection.close()
+
+        rows = dict((writer.table, writer.rows_written) for writer in self.writers)
+        total = sum(rows.values())
+        return {
+            'rows': rows,
+            'total_rows': total,
+            'load_seconds': load_seconds,
+            'index_seconds': time.time() - self.start - load_seconds,
+            'rows_per_sec': total / load_seconds if load_seconds else 0.0,
+        }
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Batch suggestions for extending the street and city cross references.
+
+addmappings and buildcitiescrossreference ask about every unknown street type / city with
+raw_input, which does not scale to a new region with thousands of them.  Here the known names
+(CommonName / USPSName / FullName of USPS Street Abbrev.csv, OriginalName / NewName of
+Cities_List.csv) are put in a BK-tree keyed on edit distance, and every unknown name is looked
+up in it once.  The triangle inequality lets a search skip every subtree whose distance range
+cannot reach the query, so an unknown name is compared with a small part of the known names
+rather than all of them.
+
+Each suggestion gets a confidence: 1 - distance / length of the longer name, divided by the number
+of different mappings found at that distance.  Suggestions are written to a csv file with an
+Accept column (Y when the confidence is at least ACCEPT_CONFIDENCE) for review; the accepted rows
+are then read back with read_accepted.
+
+    suggester = street_type_suggester(data.compiled_cross_reference())
+    suggester.suggest('BOULVARD')   # Suggestion(name='BOULEVARD', mapping='BOULEVARD', ...)
+"""
+
+import collections
+import csv
+import re
+
+MAX_DISTANCE = 3  # Largest edit distance searched, whatever the length of the name
+ACCEPT_CONFIDENCE = 0.8  # Suggestions at least this confident are marked accepted
+
+Suggestion = collections.namedtuple('Suggestion', ['name', 'mapping', 'distance', 'confidence'])
+NO_SUGGESTION = Suggestion('', '', None, 0.0)
+
+FIELDS = ['Name', 'Suggestion', 'MatchedName', 'Distance', 'Confidence', 'Count', 'Examples',
+          'Accept']
+
+NON_WORD = re.compile(r'[.,]')
+SPACES = re.compile(r'\s+')
+
+
+def levenshtein(a, b):
+    """Edit distance between a and b (insertions, deletions and substitutions)"""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = range(len(b) + 1)
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+class BKTree(object):
+    """Burkhard-Keller tree of words under an integer metric"""
+
+    def __init__(self, distance=levenshtein):
+        self.distance = distance
+        self.root = None  # (word, {distance: child node})
+        self.size = 0
+
+    def add(self, word):
+        if self.root is None:
+            self.root = (word, {})
+            self.size = 1
+            return
+        node = self.root
+        while True:
+            d = self.distance(word, node[0])
+            if d == 0:
+                return
+            child = node[1].get(d)
+            if child is None:
+                node[1][d] = (word, {})
+                self.size += 1
+                return
+            node = child
+
+    def search(self, word, max_distance):
+        """(distance, word) for every word within max_distance of word, closest first"""
+        found = []
+        pending = [self.root] if self.root is not None else []
+        while pending:
+            node_word, children = pending.pop()
+            d = self.distance(word, node_word)
+            if d <= max_distance:
+                found.append((d, node_word))
+            for child_distance, child in children.iteritems():
+                if d - max_distance <= child_distance <= d + max_distance:
+                    pending.append(child)
+        found.sort()
+        return found
+
+
+#Upper case, without dots / commas and with single spaces: the form names are compared in.
+def comparable(name):
+    return SPACES.sub(' ', NON_WORD.sub('', name.upper())).strip()
+
+
+class Suggester(object):
+    """Suggests the mapping of the closest known name for unknown names"""
+
+    def __init__(self, mappings, max_distance=MAX_DISTANCE):
+        """mappings: known name -> the name it maps to"""
+        self.mappings = {}
+        self.tree = BKTree()
+        self.max_distance = max_distance
+        for name, mapping in mappings.iteritems():
+            key = comparable(name)
+            if key:
+                self.mappings.setdefault(key, mapping)
+                self.tree.add(key)
+
+    def search_distance(self, key):
+        # A third of the name may differ: 1 edit for ST, 3 for BOULVARD
+        return max(1, min(self.max_distance, len(key) // 3))
+
+    def suggest(self, name):
+        """The best Suggestion for name, NO_SUGGESTION if no known name is close enough"""
+        key = comparable(name)
+        if not key:
+            return NO_SUGGESTION
+        found = self.tree.search(key, self.search_distance(key))
+        if not found:
+            return NO_SUGGESTION
+        best_distance, best_name = found[0]
+        mappings = set(self.mappings[known] for distance, known in found
+                       if distance == best_distance)
+        similarity = 1.0 - float(best_distance) / max(len(key), len(best_name))
+        return Suggestion(best_name, self.mappings[best_name], best_distance,
+                          round(similarity / len(mappings), 3))
+
+
+#Suggester for street types: every CommonName, USPSName and FullName maps to its FullName.
+def street_type_suggester(cross_reference):
+    mappings = {}
+    for names in (cross_reference.common_names, cross_reference.usps_names):
+        for name, full_name in names.iteritems():
+            mappings.setdefault(name, full_name)
+            mappings.setdefault(full_name, full_name)
+    return Suggester(mappings)
+
+
+#Suggester for cities: every OriginalName maps to its NewName, and every NewName to itself.
+def city_suggester(cross_reference):
+    mappings = dict(cross_reference.city_names)
+    for new_name in cross_reference.city_names.values():
+        mappings.setdefault(new_name, new_name)
+    return Suggester(mappings)
+
+
+def suggestion_rows(suggester, names, examples=None, accept_confidence=ACCEPT_CONFIDENCE):
+    """One row (a dict of FIELDS) per unknown name, most common first
+
+    names maps each unknown name to the number of times it was seen (or to a set of the values
+    it was seen in, see data.audit), examples optionally to a few values it appeared in.
+    """
+    rows = []
+    for name, seen in names.iteritems():
+        count = seen if isinstance(seen, (int, long)) else len(seen)
+        suggestion = suggester.suggest(name)
+        rows.append({
+            'Name': name.upper(),
+            'Suggestion': suggestion.mapping,
+            'MatchedName': suggestion.name,
+            'Distance': '' if suggestion.distance is None else suggestion.distance,
+            'Confidence': suggestion.confidence,
+            'Count': count,
+            'Examples': '; '.join(sorted(examples.get(name, ()))[:3]) if examples else '',
+            'Accept': 'Y' if suggestion.mapping and suggestion.confidence >= accept_confidence
+                      else '',
+        })
+    rows.sort(key=lambda row: (-row['Count'], row['Name']))
+    return rows
+
+
+def write_suggestions(path, rows):
+    with open(path, 'wb') as f:
+        writer = csv.DictWriter(f, FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict((field, value.encode('utf-8') if isinstance(value, unicode)
+                                  else value) for field, value in row.iteritems()))
+
+
+def read_accepted(path):
+    """(Name, Suggestion) for every row of a reviewed suggestions file marked Accept = Y
+
+    Reviewers can change the Suggestion before accepting it."""
+    with open(path, 'rb') as f:
+        return [(row['Name'], row['Suggestion'].upper()) for row in csv.DictReader(f)
+                if row['Accept'].strip().upper() == 'Y' and row['Suggestion'].strip()]
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Deterministic synthetic OSM files for benchmarking.
+
+generate() writes an OSM XML file of nodes and ways shaped like the Las Vegas extract: node
+coordinates in the Las Vegas area, ways of a few consecutive nodes, and tags drawn from a fixed
+vocabulary.  A configurable share of the tags are addr:street / addr:city values built from the
+cross reference csv files (common and USPS street type spellings, unknown street types, and city
+names in the spellings Cities_List.csv corrects), so the cleaning code does the same kind of work
+as on the real data.  The same arguments (and seed) always give the same file.
+
+    python synthetic.py synthetic.osm 100000 20000 --node-tags 0.3 --way-tags 2.0
+"""
+
+import argparse
+import csv
+import math
+import random
+from xml.sax.saxutils import quoteattr
+
+import data
+
+BBOX = (-115.35, 35.95, -114.95, 36.35)  # min_lon, min_lat, max_lon, max_lat
+FIRST_WAY_ID = 100000000
+NODE_TAGS = 0.3  # Default average tags per node
+WAY_TAGS = 2.0  # Default average tags per way
+VERSION = 2  # Goes up when the same arguments start giving a different file
+TAG_DENSITY_TOLERANCE = 0.05  # Allowed shortfall from the vocabulary capping the tags per element
+
+STREET_NAMES = ['Flamingo', 'Tropicana', 'Sahara', 'Charleston', 'Desert Inn', 'Spring Mountain',
+                'Maryland', 'Eastern', 'Rainbow', 'Decatur', 'Jones', 'Durango', 'Fort Apache',
+                'Sunset', 'Warm Springs', 'Russell', 'Paradise', 'Koval', 'Pecos', 'Lamb']
+DIRECTIONS = ['', '', '', 'N ', 'S ', 'E ', 'W ', 'North ', 'South ', 'East ', 'West ']
+UNKNOWN_STREET_TYPES = ['Strasse', 'Row', 'Xyz', '#5', 'Suite 100']
+OTHER_CITIES = ['Las Vegas', 'las vegas', 'LAS VEGAS', 'Las Vegas, NV', 'North Las Vegas']
+
+OTHER_TAGS = [
+    ('amenity', ['restaurant', 'cafe', 'fast_food', 'parking', 'fuel', 'bank', 'school']),
+    ('building', ['yes', 'house', 'residential', 'commercial', 'retail']),
+    ('highway', ['residential', 'service', 'primary', 'secondary', 'footway', 'traffic_signals']),
+    ('name', ['Bellagio', 'Caesars Palace', 'Red Rock Canyon', 'Sunset Park', 'Fremont Street']),
+    ('shop', ['supermarket', 'convenience', 'clothes', 'mall']),
+    ('source', ['Bing', 'survey', 'tiger_import_dch_v0.6_20070809']),
+    ('tiger:county', ['Clark, NV']),
+    ('tiger:cfcc', ['A41', 'A45']),
+    ('addr:housenumber', None),
+    ('addr:postcode', None),
+]
+
+
+def read_column(path, column):
+    with open(path, 'rb') as f:
+        return [row[column] for row in csv.DictReader(f)]
+
+
+class TagSource(object):
+    """Draws tag (key, value) pairs, addr:street and addr:city with the given probabilities"""
+
+    def __init__(self, rng, street_share, city_share, street_file=data.USPS_STREET,
+                 city_file=data.CITIES_LIST):
+        self.rng = rng
+        self.street_share = street_share
+        self.city_share = city_share
+        street_types = read_column(street_file, 'CommonName') + read_column(street_file, 'USPSName')
+        # The spellings found in the wild: as listed, capitalised, lower case, abbreviated with a dot
+        self.street_types = [spelling for street_type in sorted(set(street_types))
+                             for spelling in (street_type, street_type.capitalize(),
+                                              street_type.lower(), street_type.capitalize() + '.')]
+        cities = read_column(city_file, 'OriginalName')
+        self.cities = [spelling for city in cities
+                       for spelling in (city, city.title(), city.lower())] + OTHER_CITIES
+
+    def street(self):
+        rng = self.rng
+        if rng.random() < 0.05:
+            street_type = rng.choice(UNKNOWN_STREET_TYPES)
+        else:
+            street_type = rng.choice(self.street_types)
+        return '{0}{1} {2}'.format(rng.choice(DIRECTIONS), rng.choice(STREET_NAMES), street_type)
+
+    def tag(self):
+        rng = self.rng
+        draw = rng.random()
+        if draw < self.street_share:
+            return 'addr:street', self.street()
+        if draw < self.street_share + self.city_share:
+            return 'addr:city', rng.choice(self.cities)
+        key, values = rng.choice(OTHER_TAGS)
+        if key == 'addr:housenumber':
+            return key, str(rng.randint(1, 9999))
+        if key == 'addr:postcode':
+            return key, str(rng.randint(89101, 89183))
+        return key, rng.choice(values)
+
+    def tags(self, count):
+        """count tags with distinct keys (fewer if the vocabulary runs out)"""
+        tags = {}
+        for _ in range(count * 2):
+            if len(tags) >= count:
+                break
+            key, value = self.tag()
+            tags.setdefault(key, value)
+        return sorted(tags.items())
+
+
+#A geometric number of tags with the given mean: most elements have none.  Flooring an exponential
+#draw of rate r gives mean 1 / (e^r - 1), so r = log(1 + 1 / mean).
+def tag_count_draw(rng, mean):
+    return int(rng.expovariate(math.log1p(1.0 / mean)))
+
+
+def element_attributes(rng, element_id):
+    uid = rng.randint(1, 500)
+    return [('id', str(element_id)),
+            ('version', str(rng.randint(1, 9))),
+            ('timestamp', '20{0:02d}-{1:02d}-{2:02d}T{3:02d}:{4:02d}:{5:02d}Z'.format(
+                rng.randint(8, 17), rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23),
+                rng.randint(0, 59), rng.randint(0, 59))),
+            ('changeset', str(rng.randint(1000000, 50000000))),
+            ('uid', str(uid)),
+            ('user', 'mapper{0}'.format(uid))]
+
+
+def write_element(f, tag, attributes, tags, refs=()):
+    f.write('  <{0} {1}'.format(tag, ' '.join('{0}={1}'.format(name, quoteattr(value))
+                                               for name, value in attributes)))
+    if not tags and not refs:
+        f.write('/>\n')
+        return
+    f.write('>\n')
+    for ref in refs:
+        f.write('    <nd ref="{0}"/>\n'.format(ref))
+    for key, value in tags:
+        f.write('    <tag k={0} v={1}/>\n'.format(quoteattr(key), quoteattr(value)))
+    f.write('  </{0}>\n'.format(tag))
+
+
+def generate(path, nodes=100000, ways=20000, node_tags=NODE_TAGS, way_tags=WAY_TAGS,
+             nodes_per_way=8, street_share=0.15, city_share=0.1, seed=0):
+    """Write a synthetic OSM file
+
+    node_tags / way_tags are the average number of tags per node / way (a little less when they
+    come near the dozen distinct keys of the vocabulary), street_share and city_share the share
+    of those tags that are addr:street / addr:city.  Returns the number of tags written.
+    """
+    rng = random.Random(seed)
+    tag_source = TagSource(rng, street_share, city_share)
+    min_lon, min_lat, max_lon, max_lat = BBOX
+    tag_count = 0
+
+    with open(path, 'wb') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<osm version="0.6" generator="synthetic.py">\n')
+        f.write('  <bounds minlat="{0}" minlon="{1}" maxlat="{2}" maxlon="{3}"/>\n'.format(
+            min_lat, min_lon, max_lat, max_lon))
+
+        for node_id in xrange(1, nodes + 1):
+            attributes = element_attributes(rng, node_id)
+            attributes[1:1] = [('lat', '{0:.7f}'.format(rng.uniform(min_lat, max_lat))),
+                               ('lon', '{0:.7f}'.format(rng.uniform(min_lon, max_lon)))]
+            tags = tag_source.tags(tag_count_draw(rng, node_tags)) if node_tags else []
+            write_element(f, 'node', attributes, tags)
+            tag_count += len(tags)
+
+        for way_id in xrange(FIRST_WAY_ID, FIRST_WAY_ID + ways):
+            first = rng.randint(1, max(1, nodes - nodes_per_way * 2))
+            length = rng.randint(2, nodes_per_way * 2 - 2)
+            refs = [min(first + i, nodes) for i in range(length)]
+            tags = tag_source.tags(tag_count_draw(rng, way_tags)) if way_tags else []
+            write_element(f, 'way', element_attributes(rng, way_id), tags, refs)
+            tag_count += len(tags)
+
+        f.write('</osm>\n')
+    return tag_count
+
+
+#Average number of tags per node and per way in the OSM file at path.
+def tag_density(path):
+    elements = {'node': 0, 'way': 0}
+    tags = {'node': 0, 'way': 0}
+    for element in data.get_element(path, tags=('node', 'way')):
+        elements[element.tag] += 1
+        tags[element.tag] += sum(1 for child in element if child.tag == 'tag')
+    return tuple(float(tags[tag]) / elements[tag] if elements[tag] else 0.0
+                 for tag in ('node', 'way'))
+
+
+def check_tag_density(path, node_tags=NODE_TAGS, way_tags=WAY_TAGS, nodes=None, ways=None):
+    """Raise ValueError unless path has about node_tags / way_tags tags per node / way
+
+    Allows TAG_DENSITY_TOLERANCE of the mean plus three standard errors of the geometric tag
+    counts, when the number of nodes / ways is given.
+    """
+    for label, expected, actual, count in zip(('node', 'way'), (node_tags, way_tags),
+                                              tag_density(path), (nodes, ways)):
+        allowed = expected * TAG_DENSITY_TOLERANCE
+        if count:
+            allowed += 3 * math.sqrt(expected * (1 + expected) / count)
+        if abs(actual - expected) > allowed:
+            raise ValueError("{0} has {1:.3f} tags per {2}, expected {3}".format(
+                path, actual, label, expected))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Write a deterministic synthetic OSM file")
+    arg_parser.add_argument('path', nargs='?', default='synthetic.osm')
+    arg_parser.add_argument('nodes', nargs='?', type=int, default=100000)
+    arg_parser.add_argument('ways', nargs='?', type=int, help="default: nodes / 5")
+    arg_parser.add_argument('--node-tags', type=float, default=NODE_TAGS,
+                            help="average tags per node (default %(default)s)")
+    arg_parser.add_argument('--way-tags', type=float, default=WAY_TAGS,
+                            help="average tags per way (default %(default)s)")
+    arg_parser.add_argument('--nodes-per-way', type=int, default=8)
+    arg_parser.add_argument('--street-share', type=float, default=0.15,
+                            help="share of the tags that are addr:street (default %(default)s)")
+    arg_parser.add_argument('--city-share', type=float, default=0.1,
+                            help="share of the tags that are addr:city (default %(default)s)")
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+    ways = args.ways if args.ways is not None else args.nodes // 5
+
+    tag_count = generate(args.path, args.nodes, ways, args.node_tags, args.way_tags,
+                         args.nodes_per_way, args.street_share, args.city_share, args.seed)
+    check_tag_density(args.path, args.node_tags, args.way_tags, args.nodes, ways)
+    print "Wrote {0} nodes, {1} ways and {2} tags to {3}".format(args.nodes, ways, tag_count,
+                                                                 args.path)
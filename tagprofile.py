@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Streaming tag statistics in bounded memory.
+
+The audits in audits.py keep every distinct value they see (a defaultdict(set) per key), which is
+fine for addr:street but not for keys like name or addr:housenumber with a value per element.
+TagProfiler is an auditor that takes every node and way tag and keeps, for each key:
+
+    count             tags with the key (and how many were on nodes / on ways)
+    distinct values   estimated with a HyperLogLog sketch of 2 ** HLL_PRECISION one byte registers
+                      (standard error about 1.04 / sqrt(2 ** HLL_PRECISION), 3% by default)
+    top values        the heavy hitters from a space-saving summary of TOP_VALUES counters; each
+                      count is at most `error` above the true count
+    problem values    values PROBLEMCHARS finds a character in (handle_tags drops keys that have
+                      one, values are kept as they are)
+
+so the memory used depends on the number of keys (at most MAX_KEYS, later keys are pooled under
+OTHER_KEYS) and not on the size of the file or the number of values.
+
+    runner = audits.AuditRunner()
+    profiler = runner.register(TagProfiler(data.PROBLEMCHARS))
+    runner.run('las-vegas_nevada.osm')
+    write_profile('tag_profile.csv', profiler.result())
+"""
+
+import csv
+import math
+
+import audits
+
+HLL_PRECISION = 10  # Index bits of the HyperLogLog hash: 1024 registers per key
+TOP_VALUES = 16  # Counters of the space-saving summary kept per key
+MAX_KEYS = 5000  # Keys profiled separately; the tags of any further keys share one profile
+OTHER_KEYS = '(other keys)'
+SHOWN_VALUES = 5  # Top values written per key by write_profile
+
+MASK_64 = (1 << 64) - 1
+
+FIELDS = ['Key', 'Count', 'Nodes', 'Ways', 'DistinctValues', 'ProblemValues', 'ProblemRate',
+          'KeyProblemChars', 'TopValues']
+
+
+#64 bit hash of value: Python's string hash (equal for str and unicode of the same ASCII text)
+#through the MurmurHash3 finalizer, so short strings use the high bits too.
+def hash64(value):
+    h = hash(value) & MASK_64
+    h ^= h >> 33
+    h = (h * 0xff51afd7ed558ccd) & MASK_64
+    h ^= h >> 33
+    h = (h * 0xc4ceb9fe1a85ec53) & MASK_64
+    return h ^ (h >> 33)
+
+
+class HyperLogLog(object):
+    """Distinct count estimate in 2 ** precision bytes (Flajolet et al. 2007)"""
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.size = 1 << precision
+        self.rest_bits = 64 - precision
+        self.registers = bytearray(self.size)
+
+    def add(self, value):
+        h = hash64(value)
+        index = h & (self.size - 1)
+        # Position of the first 1 bit of the other bits, counting from 1
+        rank = self.rest_bits - (h >> self.precision).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def estimate(self):
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count('\0')
+        if raw <= 2.5 * m and zeros:
+            # Small cardinalities: linear counting of the empty registers is more accurate
+            return m * math.log(float(m) / zeros)
+        return raw
+
+
+class SpaceSaving(object):
+    """The most frequent values of a stream in a fixed number of counters (Metwally et al. 2005)
+
+    A value not being counted replaces the one with the lowest count and starts from that count
+    (recorded as its error), so every value seen more than total / capacity times is kept.
+    """
+
+    def __init__(self, capacity=TOP_VALUES):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.lowest = set()  # Values with the lowest count, refilled when they've all moved on
+
+    def add(self, value):
+        counts = self.counts
+        if value in counts:
+            counts[value] += 1
+            self.lowest.discard(value)
+        elif len(counts) < self.capacity:
+            counts[value] = 1
+            self.errors[value] = 0
+        else:
+            if not self.lowest:
+                floor = min(counts.itervalues())
+                self.lowest = set(known for known, count in counts.iteritems() if count == floor)
+            smallest = self.lowest.pop()
+            floor = counts.pop(smallest)
+            del self.errors[smallest]
+            counts[value] = floor + 1
+            self.errors[value] = floor
+
+    def top(self, n=None):
+        """(value, count, error) most frequent first"""
+        ranked = sorted(self.counts.iteritems(), key=lambda item: (-item[1], item[0]))
+        return [(value, count, self.errors[value]) for value, count in ranked[:n]]
+
+
+class KeyProfile(object):
+    """The statistics kept for one tag key"""
+
+    __slots__ = ('elements', 'problem_values', 'distinct', 'heavy_hitters')
+
+    def __init__(self, precision=HLL_PRECISION, capacity=TOP_VALUES):
+        self.elements = {'node': 0, 'way': 0}
+        self.problem_values = 0
+        self.distinct = HyperLogLog(precision)
+        self.heavy_hitters = SpaceSaving(capacity)
+
+    def count(self):
+        return sum(self.elements.values())
+
+
+class TagProfiler(audits.Auditor):
+    """Per key counts, distinct value estimates, top values and problem character rates"""
+
+    def __init__(self, problem_chars, max_keys=MAX_KEYS, precision=HLL_PRECISION,
+                 capacity=TOP_VALUES):
+        self.problem_chars = problem_chars
+        self.max_keys = max_keys
+        self.precision = precision
+        self.capacity = capacity
+        self.profiles = {}
+
+    def audit_tag(self, element_tag, key, value):
+        profile = self.profiles.get(key)
+        if profile is None:
+            if len(self.profiles) >= self.max_keys:
+                key = OTHER_KEYS
+                profile = self.profiles.get(key)
+            if profile is None:
+                profile = self.profiles[key] = KeyProfile(self.precision, self.capacity)
+        profile.elements[element_tag] += 1
+        if self.problem_chars.search(value):
+            profile.problem_values += 1
+        profile.distinct.add(value)
+        profile.heavy_hitters.add(value)
+
+    def result(self):
+        """One dict per key, most used key first"""
+        rows = []
+        for key, profile in self.profiles.iteritems():
+            count = profile.count()
+            rows.append({
+                'key': key,
+                'count': count,
+                'nodes': profile.elements['node'],
+                'ways': profile.elements['way'],
+                # The estimate can't be above the number of values seen
+                'distinct_values': min(count, int(round(profile.distinct.estimate()))),
+                'problem_values': profile.problem_values,
+                'problem_rate': float(profile.problem_values) / count,
+                'key_problem_chars': key != OTHER_KEYS and bool(self.problem_chars.search(key)),
+                'top_values': profile.heavy_hitters.top(),
+            })
+        rows.sort(key=lambda row: (-row['count'], row['key']))
+        return rows
+
+
+def encoded(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+def write_profile(path, rows, shown_values=SHOWN_VALUES):
+    """Write TagProfiler.result() rows to a csv file of FIELDS"""
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(FIELDS)
+        for row in rows:
+            # Overestimated counts show as the range the true count is in; values that may have
+            # been seen only once are left out
+            top_values = '; '.join(u'{0} ({1}{2})'.format(value, u'{0}-'.format(count - error)
+                                                          if error else u'', count)
+                                   for value, count, error in row['top_values'][:shown_values]
+                                   if count - error > 1)
+            writer.writerow([encoded(row['key']), row['count'], row['nodes'], row['ways'],
+                             row['distinct_values'], row['problem_values'],
+                             '{0:.4f}'.format(row['problem_rate']),
+                             'Y' if row['key_problem_chars'] else '', encoded(top_values)])
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Deferred street and city normalization for process_map.
+
+handle_tags normally cleans every addr:street / addr:city value as it is shaped: one regex search
+and a couple of dictionary lookups per tag.  With process_map(..., normalize='deferred') the
+values are written as they are (upper cased, like every tag value) and this module cleans the
+value column of nodes_tags / ways_tags afterwards.  The distinct street and city values are
+cleaned once each and mapped back onto the column, so the work grows with the number of distinct
+names rather than the number of tags.  The result is the same as cleaning inline.
+
+    normalizer = ValueNormalizer(data.compiled_cross_reference())
+    normalize_csv('nodes_tags.csv', normalizer)
+    normalize_csv('ways_tags.csv', normalizer)
+"""
+
+import sqlite3
+import time
+
+import pandas as pd
+
+import checkpoints
+import compressed
+
+CHUNK_ROWS = 500000  # Tag rows read into memory at a time
+
+# Tag type -> the CrossReference method that cleans values of that type
+NORMALIZED_TYPES = {'street': 'update_name', 'city': 'update_city_name'}
+
+
+class ValueNormalizer(object):
+    """Cleans street and city values with a CrossReference, each distinct value once"""
+
+    def __init__(self, cross_reference):
+        self.cross_reference = cross_reference
+        self.cleaned = dict((tag_type, {}) for tag_type in NORMALIZED_TYPES)
+        self.values = 0
+
+    def distinct_values(self):
+        return sum(len(cleaned) for cleaned in self.cleaned.values())
+
+    def normalize_column(self, types, values):
+        """values (a Series of tag values) with the street and city values cleaned"""
+        values = values.copy()
+        for tag_type, method in NORMALIZED_TYPES.items():
+            mask = (types == tag_type).values
+            if not mask.any():
+                continue
+            selected = values[mask]
+            cleaned = self.cleaned[tag_type]
+            clean = getattr(self.cross_reference, method)
+            for value in selected.unique():
+                if value not in cleaned:
+                    cleaned[value] = clean(value)
+            values[mask] = selected.map(cleaned)
+            self.values += len(selected)
+        return values
+
+    def normalize_frame(self, frame):
+        frame['value'] = self.normalize_column(frame['type'], frame['value'])
+        return frame
+
+
+#Clean the value column of a tags csv file (path + '.gz' if compress) in place.
+def normalize_csv(path, normalizer, compress=False, chunk_rows=CHUNK_ROWS):
+    temp_path = path + '.normalizing'
+    source_path = path + '.gz' if compress else path
+    with compressed.open_output(temp_path, 'wb', compress) as out:
+        chunks = pd.read_csv(source_path, dtype=object, na_filter=False, encoding='utf-8',
+                             compression='gzip' if compress else None, chunksize=chunk_rows)
+        for index, frame in enumerate(chunks):
+            normalizer.normalize_frame(frame).to_csv(out, index=False, header=index == 0,
+                                                     encoding='utf-8', line_terminator='\r\n')
+        written_path = out.name
+    checkpoints.replace_file(written_path, source_path)
+
+
+#Clean the value column of tag tables in a SQLite database: the cleaned distinct values go into a
+#temporary mapping table and each table is updated from it in one statement.
+def normalize_sqlite(connection, tables, normalizer):
+    connection.execute('CREATE TEMP TABLE normalized (type TEXT, value TEXT, cleaned TEXT, '
+                       'PRIMARY KEY (type, value))')
+    for table in tables:
+        for tag_type in NORMALIZED_TYPES:
+            rows = connection.execute('SELECT value, COUNT(*) FROM "{0}" WHERE type = ? '
+                                      'GROUP BY value'.format(table), (tag_type,)).fetchall()
+            if not rows:
+                continue
+            values = pd.Series([value for value, _ in rows], dtype=object)
+            types = pd.Series([tag_type] * len(rows), dtype=object)
+            cleaned = normalizer.normalize_column(types, values)
+            # normalize_column counted each distinct value once, count every row instead
+            normalizer.values += sum(count for _, count in rows) - len(rows)
+            connection.executemany('INSERT OR IGNORE INTO normalized VALUES (?, ?, ?)',
+                                   [(tag_type, value, clean)
+                                    for value, clean in zip(values, cleaned) if value != clean])
+        connection.execute(
+            'UPDATE "{0}" SET value = (SELECT cleaned FROM normalized n WHERE n.type = "{0}".type '
+            'AND n.value = "{0}".value) WHERE type IN ({1}) AND EXISTS (SELECT 1 FROM normalized n '
+            'WHERE n.type = "{0}".type AND n.value = "{0}".value)'.format(
+                table, ', '.join("'{0}'".format(tag_type) for tag_type in NORMALIZED_TYPES)))
+    connection.execute('DROP TABLE normalized')
+    connection.commit()
+
+
+def normalize_outputs(target, cross_reference, csv_paths=(), db_path=None, tables=(),
+                      compress=False):
+    """Clean the street and city values process_map wrote to csv_paths (target 'csv') or to
+    tables in db_path (target 'sqlite'). Returns the number of values and distinct values cleaned
+    and the time taken."""
+    start = time.time()
+    normalizer = ValueNormalizer(cross_reference)
+    if target == 'csv':
+        for path in csv_paths:
+            normalize_csv(path, normalizer, compress)
+    elif target == 'sqlite':
+        connection = sqlite3.connect(db_path)
+        try:
+            normalize_sqlite(connection, tables, normalizer)
+        finally:
+            connection.close()
+    else:
+        raise ValueError("Deferred normalization is only supported for csv and sqlite output")
+    return {'values': normalizer.values, 'distinct_values': normalizer.distinct_values(),
+            'seconds': time.time() - start}
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Buffered csv output for process_map.
+
+UnicodeDictWriter turns every row dict into a new dict and then into a list, and every writerow
+goes through the csv module (and a line buffered file) on its own.  BufferedCsvWriter takes rows as
+tuples already in field order (NODE_FIELDS, WAY_NODES_FIELDS, ...), keeps them in a list and
+formats a whole batch with one writerows call into memory before a single write to the file.
+The bytes written are the same as UnicodeDictWriter's.
+
+Rows already formatted by format_row_lists (the shape cache keeps them that way, see
+shapecache.py) are written with writetext and go out as they are.
+"""
+
+import csv
+import cStringIO
+
+BUFFER_ROWS = 10000  # Rows held per output file before they are written out
+
+
+def encode_row(row):
+    return tuple(v.encode('utf-8') if isinstance(v, unicode) else v for v in row)
+
+
+def format_row_lists(row_lists):
+    """The csv text of each list of rows, formatted in one pass as BufferedCsvWriter would"""
+    out = cStringIO.StringIO()
+    writer = csv.writer(out)
+    ends = []
+    for rows in row_lists:
+        row_start = out.tell()
+        try:
+            writer.writerows(rows)
+        except UnicodeEncodeError:
+            out.seek(row_start)
+            out.truncate()
+            writer.writerows([encode_row(row) for row in rows])
+        ends.append(out.tell())
+    text = out.getvalue()
+    return [text[start:end] for start, end in zip([0] + ends, ends)]
+
+
+class BufferedCsvWriter(object):
+    """csv writer for row tuples in field order, written out buffer_rows rows at a time"""
+
+    def __init__(self, f, fields, buffer_rows=BUFFER_ROWS):
+        self.file = f
+        self.fields = fields
+        self.buffer_rows = buffer_rows
+        self.buffer = []
+        self.text = []  # Formatted rows, written out before the ones in buffer
+        self.text_rows = 0
+        self.rows_written = 0
+
+    def writeheader(self):
+        self.file.write(self._format([tuple(self.fields)]))
+
+    def writerow(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.buffer_rows:
+            self.flush()
+
+    def writerows(self, rows):
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.buffer_rows:
+            self.flush()
+
+    def writetext(self, text, rows):
+        """Write rows already formatted as csv text (see format_row_lists)"""
+        if not rows:
+            return
+        if self.buffer:
+            self.flush()
+        self.text.append(text)
+        self.text_rows += rows
+        if self.text_rows >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        if self.text:
+            self.file.write(''.join(self.text))
+            self.rows_written += self.text_rows
+            del self.text[:]
+            self.text_rows = 0
+        if self.buffer:
+            try:
+                formatted = self._format(self.buffer)
+            except UnicodeEncodeError:
+                # Non-ascii unicode values need encoding first; most batches don't have any.
+                formatted = self._format([encode_row(row) for row in self.buffer])
+            self.file.write(formatted)
+            self.rows_written += len(self.buffer)
+            del self.buffer[:]
+
+    @staticmethod
+    def _format(rows):
+        out = cStringIO.StringIO()
+        csv.writer(out).writerows(rows)
+        return out.getvalue()